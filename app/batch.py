@@ -0,0 +1,243 @@
+"""
+Headless batch mode: clean many files with one CleaningConfig, in parallel.
+
+    python -m app.batch --config config.json --out cleaned/ data/*.csv exports/
+    python -m app.batch --config config.json --lookup customers.xlsx --out cleaned/ data/
+
+Inputs may be files or directories (their .csv/.xlsx/.xls files, non-recursive).
+Outputs keep the inputs' paths relative to their common folder (data/a.csv and exports/a.csv ->
+out/data/a_cleaned.csv and out/exports/a_cleaned.csv), so same-named inputs never overwrite each other.
+Earlier outputs (*_cleaned.*) found in the output folder are not picked up as inputs.
+With --lookup, every input is merged (Smart VLOOKUP) before cleaning using the config's merge keys;
+the lookup file is read and indexed once and shared with every worker process.
+Each cleaned file is written to --out as soon as it is done, followed by summary.json
+(per-file rows, merge/dedupe stats, log and timings).
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from app.config import settings
+from app.core.cache import content_hash
+from app.core.cleaner import clean_dataframe
+from app.core.match_cache import get_match_cache
+from app.core.merger import build_lookup_index, fuzzy_merge_datasets, _as_key_list
+from app.core.pipeline import merge_options, merge_message
+from app.schemas import CleaningConfig
+from app.utils.file_handler import read_file_as_df, write_df
+from app.utils.json_utils import dumps
+
+# Per-process state, set once by _init_worker (the lookup is not re-sent with every file)
+_WORKER = {}
+
+
+def _init_worker(cfg, lookup):
+    _WORKER.update(cfg=cfg, lookup=lookup)
+
+
+def _ms(start):
+    return round((time.perf_counter() - start) * 1000, 1)
+
+
+def process_file(path, out_path):
+    """Merge (optional) + clean + write one input to out_path. Returns its summary entry."""
+    cfg, lookup = _WORKER["cfg"], _WORKER["lookup"]
+    entry = {"input": path, "status": "ok", "timings_ms": {}}
+    timings = entry["timings_ms"]
+    start = time.perf_counter()
+    try:
+        # 1. READ
+        t = time.perf_counter()
+        df = read_file_as_df(path)
+        timings["read"] = _ms(t)
+        entry["rows_in"] = len(df)
+
+        # 2. MERGE (shared lookup index)
+        log, stats, exclude_list = [], {}, []
+        if lookup is not None:
+            t = time.perf_counter()
+            merge_stats = {}
+            df, merged_count, added_cols = fuzzy_merge_datasets(
+                df, lookup["df"], **merge_options(cfg),
+                lookup_hash=lookup["hash"], match_cache=get_match_cache(),
+                stats=merge_stats, lookup_index=lookup["index"]
+            )
+            timings["merge"] = _ms(t)
+            stats["merge"] = merge_stats
+            log.append(merge_message(merged_count))
+            if not cfg.get("clean_merged_columns", True):
+                exclude_list = list(added_cols)
+
+        # 3. CLEAN
+        t = time.perf_counter()
+        df_clean, clean_log = clean_dataframe(df, cfg, exclude_cols=exclude_list, stats=stats)
+        timings["clean"] = _ms(t)
+
+        # 4. WRITE
+        t = time.perf_counter()
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        write_df(df_clean, out_path)
+        timings["write"] = _ms(t)
+
+        entry.update({
+            "output": out_path,
+            "rows_out": len(df_clean),
+            "log": log + clean_log,
+            "stats": stats,
+        })
+    except Exception as e:
+        entry.update({"status": "error", "error": str(e)})
+    timings["total"] = _ms(start)
+    return entry
+
+
+def _is_batch_output(name):
+    stem, ext = os.path.splitext(name)
+    return stem.endswith("_cleaned") or stem.endswith(".partial") or name == "summary.json"
+
+
+def collect_inputs(paths, out_dir=None):
+    """
+    Expands directories into their supported files; keeps the given order, drops duplicates.
+    Files this tool wrote into out_dir (outputs, temp files, summary.json) are skipped.
+    """
+    out_dir = os.path.abspath(out_dir) if out_dir else None
+    files = []
+    for p in paths:
+        if os.path.isdir(p):
+            names = sorted(os.listdir(p))
+            own_output = out_dir == os.path.abspath(p)
+            files += [os.path.join(p, n) for n in names
+                      if os.path.splitext(n)[1].lower() in settings.ALLOWED_EXTENSIONS
+                      and not (own_output and _is_batch_output(n))]
+        else:
+            files.append(p)
+    return list(dict.fromkeys(os.path.abspath(f) for f in files))
+
+
+def output_paths(files, out_dir):
+    """
+    Output path per input: its path relative to the inputs' common folder, with a _cleaned suffix.
+    Returns (outputs, collisions); inputs that would still share an output (e.g. a.CSV and a.csv)
+    are left out of outputs and listed in collisions.
+    """
+    if not files:
+        return {}, []
+    root = os.path.commonpath([os.path.dirname(f) for f in files])
+    targets = {}
+    for f in files:
+        base, ext = os.path.splitext(os.path.relpath(f, root))
+        targets[f] = os.path.join(out_dir, f"{base}_cleaned{ext.lower()}")
+    counts = {}
+    for target in targets.values():
+        key = os.path.normcase(target).lower()
+        counts[key] = counts.get(key, 0) + 1
+    collisions = [f for f, target in targets.items() if counts[os.path.normcase(target).lower()] > 1]
+    return {f: t for f, t in targets.items() if f not in collisions}, collisions
+
+
+def load_lookup(path, cfg):
+    """Reads the lookup file and builds its key index once (persisted through the MatchCache)."""
+    df_sec = read_file_as_df(path)
+    opts = merge_options(cfg)
+    keys_sec = _as_key_list(opts["key_sec"])
+    missing = [k for k in keys_sec if k not in df_sec.columns]
+    if not keys_sec or missing:
+        raise ValueError(f"Lookup key column(s) not found: {missing or 'merge_key_sec is empty'}")
+    lookup_hash = content_hash(path)
+    index = build_lookup_index(df_sec, keys_sec, lookup_hash, get_match_cache(),
+                               opts["arabic"], opts["unicode_fold"])
+    return {"df": df_sec, "hash": lookup_hash, "index": index}
+
+
+def run_batch(inputs, cfg, out_dir, lookup_path=None, workers=None, progress=None):
+    """
+    Cleans every input with cfg (a CleaningConfig dict) and writes summary.json to out_dir.
+    workers: process count (default: CPU count); 1 runs everything in this process.
+    progress: optional callback(entry) called as each file finishes.
+    Returns the summary dict.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    start = time.perf_counter()
+    files = collect_inputs(inputs, out_dir)
+    outputs, collisions = output_paths(files, out_dir)
+
+    t = time.perf_counter()
+    lookup = load_lookup(lookup_path, cfg) if lookup_path else None
+    lookup_ms = _ms(t) if lookup_path else 0.0
+
+    entries = {}
+    for f in collisions:
+        entries[f] = {"input": f, "status": "error", "timings_ms": {},
+                      "error": "Another input has the same output name (names differ only in case)"}
+        if progress: progress(entries[f])
+
+    workers = max(1, min(workers or os.cpu_count() or 1, len(outputs) or 1))
+    if workers == 1:
+        _init_worker(cfg, lookup)
+        for f, out_path in outputs.items():
+            entries[f] = process_file(f, out_path)
+            if progress: progress(entries[f])
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(cfg, lookup)) as pool:
+            futures = {pool.submit(process_file, f, out_path): f for f, out_path in outputs.items()}
+            for future in as_completed(futures):
+                entries[futures[future]] = entry = future.result()
+                if progress: progress(entry)
+
+    results = [entries[f] for f in files]
+    summary = {
+        "files": len(files),
+        "succeeded": sum(1 for e in results if e["status"] == "ok"),
+        "failed": sum(1 for e in results if e["status"] != "ok"),
+        "rows_in": sum(e.get("rows_in", 0) for e in results),
+        "rows_out": sum(e.get("rows_out", 0) for e in results),
+        "workers": workers,
+        "lookup": lookup_path,
+        "lookup_ms": lookup_ms,
+        "total_ms": _ms(start),
+        "config": cfg,
+        "results": results,
+    }
+    with open(os.path.join(out_dir, "summary.json"), "wb") as f:
+        f.write(dumps(summary))
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.batch", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", nargs="+", help="input files and/or directories")
+    parser.add_argument("--config", required=True, help="CleaningConfig JSON file (same fields as the UI sends)")
+    parser.add_argument("--out", required=True, help="output directory")
+    parser.add_argument("--lookup", help="lookup file to merge into every input (uses the config's merge keys)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    args = parser.parse_args(argv)
+
+    with open(args.config, "r", encoding="utf-8") as f:
+        cfg = CleaningConfig.model_validate_json(f.read()).model_dump()
+    if args.lookup:
+        cfg["merge_active"] = True
+
+    def report(entry):
+        name = os.path.basename(entry["input"])
+        if entry["status"] == "ok":
+            print(f"✅ {name}: {entry['rows_in']} -> {entry['rows_out']} rows ({entry['timings_ms']['total']} ms)")
+        else:
+            print(f"❌ {name}: {entry['error']}")
+
+    try:
+        summary = run_batch(args.inputs, cfg, args.out, args.lookup, args.workers, progress=report)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    print(f"Done: {summary['succeeded']}/{summary['files']} files in {summary['total_ms']} ms "
+          f"-> {os.path.join(args.out, 'summary.json')}")
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
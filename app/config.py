@@ -4,12 +4,46 @@ import tempfile
 class Settings:
     APP_NAME = "DataForge Lite"
     VERSION = "1.0.0"
+    # Identity reported by /api/health; the launcher uses it to detect a running instance
+    HEALTH_APP_ID = "DataForg"
     # Max upload size: 100MB
     MAX_UPLOAD_SIZE = 100 * 1024 * 1024 
     # Session timeout: 1 hour
     SESSION_TIMEOUT = 3600 
+    # How often expired sessions are collected (seconds)
+    CLEANUP_INTERVAL = 60
+    # Process-wide budget for cached stage outputs (merge, cleaning steps, diff), shared by all sessions: 512MB
+    STAGE_CACHE_BUDGET = 512 * 1024 * 1024
+    # Process-wide budget for normalized key columns (merge + dedupe): 64MB
+    KEY_CACHE_BUDGET = 64 * 1024 * 1024
     # Temp directory for session files
     TEMP_DIR = os.path.join(tempfile.gettempdir(), "dataforge_lite_sessions")
+    # Content-addressed uploads (<sha256><ext>), shared by every session that uploaded the same bytes
+    BLOB_DIR = os.path.join(TEMP_DIR, "blobs")
+    # Process-wide budget for parsed upload frames (shared across sessions): 512MB
+    FRAME_CACHE_BUDGET = 512 * 1024 * 1024
+    # Admission control for preview/clean: memory budget for all running pipelines of this worker
+    WORK_MEMORY_BUDGET = int(os.environ.get("DATAFORGE_WORK_MEMORY_MB", "2048")) * 1024 * 1024
+    # How long a request may queue for budget before it is rejected with 503 (seconds)
+    ADMISSION_TIMEOUT = 30
+    # Threads running pipelines (keeps the event loop free for uploads, health checks, ...)
+    WORK_THREADS = min(4, os.cpu_count() or 1)
+    # Memory estimate of a pipeline run: parsed size of every input * live copies (cleaning copy, stage cache, output)
+    ESTIMATE_COPIES = 3
+    # Session store shared by worker processes: "sqlite" (default) or "memory" (single process)
+    SESSION_BACKEND = os.environ.get("DATAFORGE_SESSION_BACKEND", "sqlite")
+    SESSION_DB = os.path.join(TEMP_DIR, "sessions.sqlite3")
+    # Uvicorn worker processes (run.py). >1 requires a shared backend such as sqlite.
+    WORKERS = int(os.environ.get("DATAFORGE_WORKERS", "1"))
+    # Persistent cache (survives restarts): lookup key indexes + fuzzy match memo
+    CACHE_DIR = os.environ.get("DATAFORGE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".dataforge_lite", "cache"))
+    # Delta cleaning baselines of recurring exports (one directory per baseline name)
+    BASELINE_DIR = os.path.join(CACHE_DIR, "baselines")
+    # Baselines are evicted least-recently-used beyond this total size, and when unused this long
+    BASELINE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+    BASELINE_MAX_AGE = 30 * 24 * 3600
+    MATCH_CACHE_MAX_ENTRIES = 500_000
+    MATCH_CACHE_MAX_INDEXES = 50
     
     # Allowed extensions
     ALLOWED_EXTENSIONS = {".csv", ".xlsx", ".xls"}
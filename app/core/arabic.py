@@ -22,4 +22,13 @@ def normalize_arabic(text: str) -> str:
                .replace('٣', '3').replace('٤', '4').replace('٥', '5')\
                .replace('٦', '6').replace('٧', '7').replace('٨', '8').replace('٩', '9')
                
-    return text.strip()
\ No newline at end of file
+    return text.strip()
+
+def normalize_arabic_series(s):
+    """Vectorized normalize_arabic for a whole string column (missing values are left as-is)."""
+    s = s.str.replace(r'[\u064B-\u065F\u0670]', '', regex=True)
+    s = s.str.replace('\u0640', '', regex=False)
+    s = s.str.replace(r'[أإآ]', 'ا', regex=True)
+    s = s.str.replace('ى', 'ي', regex=False)
+    s = s.str.translate(str.maketrans('٠١٢٣٤٥٦٧٨٩', '0123456789'))
+    return s.str.strip()
@@ -0,0 +1,147 @@
+import glob
+import hashlib
+import os
+import uuid
+
+from python_multipart.multipart import MultipartParser, parse_options_header
+from starlette.concurrency import run_in_threadpool
+
+from app.config import settings
+from app.core.cache import remember_content_hash
+
+# Cached upload analyses live next to their blob (one per sheet/header choice) and are deleted with it
+PROFILE_SUFFIX = ".profile.json"
+
+
+# Form fields / part headers allowed on top of the file itself in an upload body
+FORM_OVERHEAD = 64 * 1024
+
+
+def _write_chunk(buffer, digest, chunk):
+    digest.update(chunk)
+    buffer.write(chunk)
+
+
+def _multipart_file(boundary, field):
+    """
+    Push parser for a multipart/form-data body that keeps only the `field` file part.
+    Returns (parser, upload): after each parser.write(), upload["data"] holds the file bytes of that
+    chunk (the caller empties it), upload["filename"] is set once the part's headers are read and
+    upload["complete"] once the part has ended.
+    """
+    upload = {"filename": None, "data": [], "complete": False}
+    part = {"headers": {}, "name": b"", "value": b"", "is_file": False}
+
+    def on_part_begin():
+        part.update(headers={}, is_file=False)
+
+    def on_header_field(data, start, end):
+        part["name"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        part["value"] += data[start:end]
+
+    def on_header_end():
+        part["headers"][part["name"].lower()] = part["value"]
+        part.update(name=b"", value=b"")
+
+    def on_headers_finished():
+        _, disposition = parse_options_header(part["headers"].get(b"content-disposition", b""))
+        part["is_file"] = (disposition.get(b"name") == field.encode() and b"filename" in disposition
+                           and upload["filename"] is None)
+        if part["is_file"]:
+            upload["filename"] = disposition[b"filename"].decode("utf-8", "replace")
+
+    def on_part_data(data, start, end):
+        if part["is_file"]:
+            upload["data"].append(data[start:end])
+
+    def on_part_end():
+        if part["is_file"]:
+            upload["complete"] = True
+            part["is_file"] = False
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin, "on_header_field": on_header_field, "on_header_value": on_header_value,
+        "on_header_end": on_header_end, "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data, "on_part_end": on_part_end,
+    })
+    return parser, upload
+
+
+async def store_upload(request, claim, field="file", max_bytes=None):
+    """
+    Streams the `field` file of a multipart/form-data request straight from the socket into the
+    content-addressed blob store (settings.BLOB_DIR), hashing while writing; nothing is spooled
+    elsewhere first. Identical uploads end up as one file: <sha256><ext>.
+    Raises ValueError for a malformed body, an unsupported file type (checked before any data is
+    written) or a file above max_bytes (checked against Content-Length up front, then as bytes arrive).
+    claim(blob_name) must register the caller's reference (see the session backend's add_blob_ref);
+    it runs before the blob is published so a concurrent cleanup can never delete it in between.
+    Returns (blob path, client file name).
+    """
+    max_bytes = max_bytes or settings.MAX_UPLOAD_SIZE
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or not params.get(b"boundary"):
+        raise ValueError("Expected a multipart/form-data upload")
+    declared = request.headers.get("content-length", "")
+    if declared.isdigit() and int(declared) > max_bytes + FORM_OVERHEAD:
+        raise ValueError("File too large")
+    os.makedirs(settings.BLOB_DIR, exist_ok=True)
+
+    parser, upload = _multipart_file(params[b"boundary"], field)
+    tmp_path = os.path.join(settings.BLOB_DIR, f".upload-{uuid.uuid4().hex}")
+    digest = hashlib.sha256()
+    ext = None
+    received = size = 0
+    try:
+        with open(tmp_path, "wb") as buffer:
+            async for chunk in request.stream():
+                received += len(chunk)
+                if received > max_bytes + FORM_OVERHEAD:
+                    raise ValueError("File too large")
+                parser.write(chunk)
+                if ext is None and upload["filename"] is not None:
+                    ext = os.path.splitext(upload["filename"])[1].lower()
+                    if ext not in settings.ALLOWED_EXTENSIONS:
+                        raise ValueError("Unsupported file type")
+                data = b"".join(upload["data"])
+                upload["data"].clear()
+                if data:
+                    size += len(data)
+                    if size > max_bytes:
+                        raise ValueError("File too large")
+                    # Hashing + disk I/O off the event loop
+                    await run_in_threadpool(_write_chunk, buffer, digest, data)
+            parser.finalize()
+        if not upload["complete"]:
+            raise ValueError(f"No '{field}' file in upload")
+
+        name = f"{digest.hexdigest()}{ext}"
+        path = os.path.join(settings.BLOB_DIR, name)
+        claim(name)
+        if os.path.exists(path):
+            # Same bytes already stored: reuse that file (and its frame/profile caches)
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    remember_content_hash(path, digest.hexdigest())
+    return path, upload["filename"]
+
+
+def remove_blob(name):
+    """Deletes an unreferenced blob and its cached profiles."""
+    path = os.path.join(settings.BLOB_DIR, name)
+    for p in [path] + glob.glob(glob.escape(path) + "*" + PROFILE_SUFFIX):
+        try:
+            os.remove(p)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            # e.g. still open by a reader on Windows; the next upload of the same bytes reuses it
+            print(f"Blob cleanup error: {e}")
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+
+def fingerprint(*parts):
+    """Stable short hash of JSON-able parts (config subsets, file fingerprints, ...)."""
+    raw = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def file_fingerprint(path):
+    """Cheap identity of a file on disk: path + size + modification time."""
+    st = os.stat(path)
+    return fingerprint(os.path.abspath(path), st.st_size, st.st_mtime_ns)
+
+
+_content_hashes = {}
+
+def content_hash(path):
+    """SHA-256 of a file's bytes, memoized per file_fingerprint so unchanged files are hashed once."""
+    fp = file_fingerprint(path)
+    if fp not in _content_hashes:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        _content_hashes[fp] = h.hexdigest()
+    return _content_hashes[fp]
+
+
+def remember_content_hash(path, digest):
+    """Records a SHA-256 computed elsewhere (e.g. while streaming an upload) so content_hash skips the re-read."""
+    _content_hashes[file_fingerprint(path)] = digest
+
+
+# A lock directory older than this was left behind by a crashed process (seconds)
+LOCK_STALE = 300
+
+
+@contextmanager
+def dir_lock(path, timeout=60, stale=LOCK_STALE):
+    """
+    Exclusive lock on `path`, shared by threads and worker processes: a `<path>.lock` directory
+    (mkdir is atomic on every platform). Raises TimeoutError after `timeout` seconds.
+    stale: age (seconds) after which a lock counts as left behind by a crashed process.
+    """
+    lock = f"{path}.lock"
+    os.makedirs(os.path.dirname(lock), exist_ok=True)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            os.mkdir(lock)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock) > stale:
+                    os.rmdir(lock)
+                    continue
+            except OSError:
+                pass
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{os.path.basename(path)} is busy")
+            time.sleep(0.02)
+    try:
+        yield
+    finally:
+        try:
+            os.rmdir(lock)
+        except OSError:
+            pass
+
+
+def swap_dir(tmp_dir, path):
+    """
+    Moves the fully written directory tmp_dir to `path` under dir_lock(path): old -> aside, new -> path,
+    then the old one is removed. Readers holding the same lock see either version, never none.
+    On failure the old directory is put back and tmp_dir removed.
+    """
+    aside = f"{path}.old-{uuid.uuid4().hex[:8]}"
+    try:
+        with dir_lock(path):
+            if os.path.exists(path):
+                os.replace(path, aside)
+            try:
+                os.replace(tmp_dir, path)
+            except BaseException:
+                if os.path.exists(aside):
+                    os.replace(aside, path)
+                raise
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    shutil.rmtree(aside, ignore_errors=True)
+
+
+def estimate_size(value):
+    """Approximate memory footprint (bytes) of a cached value."""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=True))
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_size(v) for v in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(v) for v in value.values())
+    return sys.getsizeof(value)
+
+
+class StageCache:
+    """
+    Thread-safe LRU cache bounded by an approximate memory budget.
+    Used to memoize pipeline stage outputs (load, merge, each cleaning step, diff).
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return self._items[key][0]
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def put(self, key, value):
+        size = estimate_size(value)
+        # Never let a single oversized entry flush the whole cache
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            if key in self._items:
+                self.current_bytes -= self._items.pop(key)[1]
+            self._items[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes and self._items:
+                _, (_, old_size) = self._items.popitem(last=False)
+                self.current_bytes -= old_size
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.current_bytes = 0
+
+    def __len__(self):
+        return len(self._items)
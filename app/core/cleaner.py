@@ -1,8 +1,11 @@
 import pandas as pd
 import numpy as np
 import re
-from rapidfuzz import process, fuzz
+from app.core.cache import fingerprint
+from app.core.dedupe import find_duplicates, row_hashes
+from app.core.scoring import best_matches, score_distribution
 from app.core.arabic import normalize_arabic
+from app.core.merger import normalized_keys
 
 # ==========================================
 # HELPER FUNCTIONS
@@ -78,76 +81,84 @@ def mask_general(val):
         return s[0] + "*" * 4
     return "*"
 
+
+def standardize_name(col):
+    return col.strip().lower().replace(" ", "_").replace("/", "_").replace("-", "_")
+
 # ==========================================
-# MAIN CLEANING ENGINE
+# CLEANING STEPS
 # ==========================================
-# --- MAIN ENGINE ---
-def clean_dataframe(df: pd.DataFrame, config: dict, dry_run=False, exclude_cols=None):
-    df = df.copy()
-    report_log = []
-    
-    # 1. Build Exclusion List
-    # Combines system exclusions (from merge) + User selected exclusions
-    if exclude_cols is None: exclude_cols = []
-    
-    user_ignores = config.get("ignore_columns", [])
-    
-    # Normalize user ignores to match dataframe columns
-    if config.get("standardize_columns"):
-        user_ignores = [c.strip().lower().replace(" ", "_").replace("/", "_").replace("-", "_") for c in user_ignores]
-    
-    # Combine lists
-    final_exclusions = list(set(exclude_cols + user_ignores))
+# Every step takes (df, config, state) and returns the new df.
+# state = {"exclusions": [...], "log": [...], "stats": {...}, "detected": {...}} is threaded through the steps.
+# state["detected"][step] lists the columns a content-sniffing step converted; a preset entry skips the sniffing.
 
-    # ---------------------------------------------------------
-    # STEP 0: GLOBAL SANITIZATION 
-    # ---------------------------------------------------------
-    target_cols = [c for c in df.columns if c not in final_exclusions]
+def _step_sanitize(df, config, state):
+    # STEP 0: GLOBAL SANITIZATION
+    target_cols = [c for c in df.columns if c not in state["exclusions"]]
     
     for col in target_cols:
-        if df[col].dtype == "object":
+        if df[col].dtype == "object" or pd.api.types.is_string_dtype(df[col]):
             df[col] = df[col].astype(str).str.strip()
-            df[col].replace(r'(?i)^\s*["\']?(nan|null|none|""|'')\s*$', np.nan, regex=True, inplace=True)
+            df[col] = df[col].replace(r'(?i)^\s*["\']?(nan|null|none|""|'')\s*$', np.nan, regex=True)
+    return df
 
+def _step_standardize_columns(df, config, state):
     # 1. Standardize Columns
     if config.get("standardize_columns"):
         old_cols = list(df.columns)
-        df.columns = [c.strip().lower().replace(" ", "_").replace("/", "_").replace("-", "_") for c in df.columns]
+        df.columns = [standardize_name(c) for c in df.columns]
         if list(df.columns) != old_cols:
-            report_log.append("✅ Standardized column names")
+            state["log"].append("✅ Standardized column names")
             # Re-normalize exclusions to match new names
-            final_exclusions = [c.strip().lower().replace(" ", "_").replace("/", "_").replace("-", "_") for c in final_exclusions]
+            state["exclusions"] = [standardize_name(c) for c in state["exclusions"]]
+    return df
 
+def _step_drop_empty_rows(df, config, state):
     # 2. Drop Empty Rows
     if config.get("drop_empty_rows"):
         before = len(df)
-        df.dropna(how='all', inplace=True)
-        if len(df) < before: report_log.append(f"🗑️ Dropped {before - len(df)} empty rows")
+        df = df.dropna(how='all')
+        if len(df) < before: state["log"].append(f"🗑️ Dropped {before - len(df)} empty rows")
+    return df
 
+def _step_fix_dates(df, config, state):
     # 3. Fix Dates
     if config.get("fix_dates"):
-        count = 0
+        preset = state["detected"].get("fix_dates")
+        detected = []
         for col in df.columns:
-            if col in final_exclusions: continue
-            sample = df[col].dropna().astype(str).head(15).tolist()
-            if not sample: continue
-            matches = sum(1 for x in sample if re.search(r'\d{2,4}[/-]\d{1,2}[/-]\d{1,2}', x))
-            if matches >= len(sample) * 0.3:
-                converted = pd.to_datetime(df[col], format='mixed', errors='coerce', dayfirst=True)
-                if converted.notna().sum() > 0:
-                    df[col] = converted
-                    count += 1
-        if count > 0: report_log.append(f"📅 Standardized dates in {count} columns")
+            if col in state["exclusions"]: continue
+            if preset is not None:
+                if col not in preset: continue
+            else:
+                sample = df[col].dropna().astype(str).head(15).tolist()
+                if not sample: continue
+                matches = sum(1 for x in sample if re.search(r'\d{2,4}[/-]\d{1,2}[/-]\d{1,2}', x))
+                if matches < len(sample) * 0.3: continue
+            converted = pd.to_datetime(df[col], format='mixed', errors='coerce', dayfirst=True)
+            if preset is not None or converted.notna().sum() > 0:
+                df[col] = converted
+                detected.append(col)
+        state["detected"]["fix_dates"] = detected
+        if detected: state["log"].append(f"📅 Standardized dates in {len(detected)} columns")
+    return df
 
+def _step_clean_money(df, config, state):
     # 4. Money
     if config.get("clean_money"):
-        count = 0
+        preset = state["detected"].get("clean_money")
+        detected = []
         for col in df.columns:
-            if col in final_exclusions: continue
+            if col in state["exclusions"]: continue
+            if preset is not None:
+                if col in preset:
+                    df[col] = df[col].apply(clean_currency_value)
+                    detected.append(col)
+                continue
             # HARDCODED SAFETY: Never touch these columns for money
             if any(x in col.lower() for x in ['email', 'phone', 'id', 'date', 'year', 'day', 'zip', 'address', 'street', 'location']): continue
             
-            if df[col].dtype == 'object':
+            if df[col].dtype == 'object' or pd.api.types.is_string_dtype(df[col]):
                 sample = df[col].dropna().astype(str).head(15).tolist()
                 if not sample: continue
                 # Strict check: Must have digit AND currency symbol OR 'k/m/b' suffix
@@ -155,86 +166,255 @@ def clean_dataframe(df: pd.DataFrame, config: dict, dry_run=False, exclude_cols=
                 
                 if money_matches >= len(sample) * 0.3:
                     df[col] = df[col].apply(clean_currency_value)
-                    count += 1
-        if count > 0: report_log.append(f"💰 Parsed currency in {count} columns")
+                    detected.append(col)
+        state["detected"]["clean_money"] = detected
+        if detected: state["log"].append(f"💰 Parsed currency in {len(detected)} columns")
+    return df
 
+def _step_fix_emails(df, config, state):
     # 5. Emails
     if config.get("fix_emails"):
         for col in df.columns:
-            if col in final_exclusions: continue
+            if col in state["exclusions"]: continue
             if any(k in col.lower() for k in ["email", "mail"]):
                 df[col] = df[col].apply(validate_email)
+    return df
 
+def _step_fix_phones(df, config, state):
     # 6. Phones
     if config.get("fix_phones"):
         for col in df.columns:
-            if col in final_exclusions: continue
+            if col in state["exclusions"]: continue
             if any(k in col.lower() for k in ["phone", "mobile", "tel", "cell"]):
                 df[col] = df[col].apply(clean_phone_number)
+    return df
 
+def _step_remove_special_chars(df, config, state):
     # 7. Special Chars
     if config.get("remove_special_chars"):
-        for col in df.select_dtypes(include=['object']).columns:
-            if col in final_exclusions: continue
+        for col in df.select_dtypes(include=['object', 'string']).columns:
+            if col in state["exclusions"]: continue
             df[col] = df[col].apply(remove_special_characters)
+    return df
 
+def _step_clean_arabic(df, config, state):
     # 8. Arabic
     if config.get("clean_arabic"):
-        for col in df.select_dtypes(include=['object']).columns:
-            if col in final_exclusions: continue
-            if re.search(r'[\u0600-\u06FF]', df[col].dropna().astype(str).sum()):
-                df[col] = df[col].apply(normalize_arabic)
+        preset = state["detected"].get("clean_arabic")
+        detected = []
+        for col in df.select_dtypes(include=['object', 'string']).columns:
+            if col in state["exclusions"]: continue
+            if preset is not None:
+                if col not in preset: continue
+            elif not re.search(r'[\u0600-\u06FF]', df[col].dropna().astype(str).sum()):
+                continue
+            df[col] = df[col].apply(normalize_arabic)
+            detected.append(col)
+        state["detected"]["clean_arabic"] = detected
+    return df
 
+def _step_fill_missing(df, config, state):
     # 9. Missing
     fill_rules = config.get("fill_missing", {})
     if "numeric" in fill_rules and fill_rules["numeric"]:
         for col in df.columns:
-            if col in final_exclusions: continue
+            if col in state["exclusions"]: continue
             if df[col].dtype.kind in 'biufc' and df[col].isnull().sum() > 0:
                 m = fill_rules["numeric"]
                 if m == "mean": df[col] = df[col].fillna(df[col].mean())
                 elif m == "median": df[col] = df[col].fillna(df[col].median())
                 elif m == "zero": df[col] = df[col].fillna(0)
+    return df
 
+def _drop_hashed_duplicates(df, state, keep="first", **kwargs):
+    """
+    find_duplicates + drop; the duplicate groups go to state["stats"]["duplicates"] for audit.
+    With state["dedupe_keys"] set, rows are not dropped: their key hashes are recorded instead
+    (the caller dedupes across batches, e.g. delta cleaning).
+    """
+    if state.get("dedupe_keys") is not None:
+        hashes = kwargs.get("hashes")
+        if hashes is None:
+            hashes = row_hashes(df, kwargs.get("columns"), kwargs.get("normalize", False))
+        # log_pos: where the caller's "Removed N duplicates" line goes, so the log keeps step order
+        state["dedupe_keys"].update(hashes=hashes, ignore=kwargs.get("ignore"), keep=keep,
+                                    log_pos=len(state["log"]))
+        return df
+    keep_mask, audit = find_duplicates(df, keep=keep, **kwargs)
+    if audit["removed"]:
+        df = df[keep_mask]
+        state["log"].append(f"✂️ Removed {audit['removed']} duplicates")
+    state["stats"]["duplicates"] = audit
+    return df
+
+def _step_dedupe(df, config, state):
     # 10. Dedupe
     if config.get("remove_duplicates"):
         d_col = config.get("dedupe_column", "ALL")
-        if d_col != "ALL" and config.get("standardize_columns"):
-            d_col = d_col.strip().lower().replace(" ", "_").replace("/", "_").replace("-", "_")
+        d_cols = config.get("dedupe_columns") or []
+        if config.get("standardize_columns"):
+            if d_col != "ALL": d_col = standardize_name(d_col)
+            d_cols = [standardize_name(c) for c in d_cols]
+        keep = config.get("dedupe_keep", "first")
+        ignore_case = config.get("dedupe_ignore_case", False)
 
-        if d_col == "ALL":
-            orig_len = len(df)
-            df.drop_duplicates(inplace=True)
-            if len(df) < orig_len: report_log.append(f"✂️ Removed {orig_len - len(df)} duplicates")
+        # Every path treats blank keys (missing, or empty once normalized) as equal: one blank row is kept
+        if d_cols or d_col == "ALL":
+            # Exact: entire row or a multi-column key, on 64-bit row hashes
+            subset = [c for c in d_cols if c in df.columns] or None
+            if not d_cols or subset:
+                df = _drop_hashed_duplicates(df, state, keep, columns=subset, normalize=ignore_case)
         elif d_col in df.columns:
+            # Normalized keys are cached and shared with the merge
+            arabic = config.get("normalize_keys_arabic", False)
+            unicode_fold = config.get("normalize_keys_unicode", False)
             if not config.get("fuzzy_dedupe"):
-                orig_len = len(df)
-                df.drop_duplicates(subset=[d_col], inplace=True)
-                if len(df) < orig_len: report_log.append(f"✂️ Removed {orig_len - len(df)} duplicates")
+                if config.get("dedupe_normalize"):
+                    keys = normalized_keys(df[d_col], arabic, unicode_fold)
+                    df = _drop_hashed_duplicates(df, state, keep, hashes=pd.util.hash_array(keys))
+                else:
+                    df = _drop_hashed_duplicates(df, state, keep, columns=[d_col], normalize=ignore_case)
             else:
                 # Fuzzy
+                keys = normalized_keys(df[d_col], arabic, unicode_fold)
+                scorer = config.get("dedupe_scorer", "wratio")
+                threshold = config.get("dedupe_threshold", 90.0)
                 to_drop = []
                 seen = []
-                for idx, val in df[d_col].items():
-                    s = str(val)
-                    if not s: continue
-                    if seen and process.extractOne(s, seen, scorer=fuzz.WRatio, score_cutoff=90):
+                seen_set = set()
+                exact = 0
+                scores = []
+                for idx, s in zip(df.index, keys):
+                    # Identical normalized keys are duplicates without scoring
+                    if s in seen_set:
+                        to_drop.append(idx)
+                        exact += 1
+                        continue
+                    if not s:
+                        # First blank key: kept, but never a fuzzy candidate
+                        seen_set.add(s)
+                        continue
+                    match = best_matches([s], seen, scorer, threshold)[0] if seen else None
+                    if match:
                         to_drop.append(idx)
+                        scores.append(match[1])
                     else:
                         seen.append(s)
+                        seen_set.add(s)
+                state["stats"]["dedupe"] = score_distribution(scores, exact=exact, unmatched=len(seen))
+                state["stats"]["dedupe"].update({"scorer": scorer, "threshold": threshold})
                 if to_drop:
-                    df.drop(index=to_drop, inplace=True)
-                    report_log.append(f"🧠 Fuzzy: Merged {len(to_drop)} rows")
+                    df = df.drop(index=to_drop)
+                    state["log"].append(f"🧠 Fuzzy: Merged {len(to_drop)} rows")
+    return df
 
+def _step_anonymize_pii(df, config, state):
     # 11. Privacy
     if config.get("anonymize_pii"):
         mask_c = 0
         for col in df.columns:
-            if col in final_exclusions: continue
+            if col in state["exclusions"]: continue
             cl = col.lower()
             if "mail" in cl: df[col] = df[col].apply(mask_email); mask_c+=1
             elif "phone" in cl: df[col] = df[col].apply(mask_phone); mask_c+=1
             elif any(x in cl for x in ['name', 'client']) and 'id' not in cl: df[col] = df[col].apply(mask_general); mask_c+=1
-        if mask_c: report_log.append(f"🛡️ Privacy: Masked PII in {mask_c} cols")
+        if mask_c: state["log"].append(f"🛡️ Privacy: Masked PII in {mask_c} cols")
+    return df
+
+# (name, function, config keys the step depends on)
+# A step's cached output is only reused when its own keys AND all earlier keys are unchanged.
+CLEANING_STEPS = [
+    ("sanitize", _step_sanitize, ["ignore_columns", "standardize_columns"]),
+    ("standardize_columns", _step_standardize_columns, ["standardize_columns"]),
+    ("drop_empty_rows", _step_drop_empty_rows, ["drop_empty_rows"]),
+    ("fix_dates", _step_fix_dates, ["fix_dates"]),
+    ("clean_money", _step_clean_money, ["clean_money"]),
+    ("fix_emails", _step_fix_emails, ["fix_emails"]),
+    ("fix_phones", _step_fix_phones, ["fix_phones"]),
+    ("remove_special_chars", _step_remove_special_chars, ["remove_special_chars"]),
+    ("clean_arabic", _step_clean_arabic, ["clean_arabic"]),
+    ("fill_missing", _step_fill_missing, ["fill_missing"]),
+    ("dedupe", _step_dedupe, ["remove_duplicates", "dedupe_column", "fuzzy_dedupe", "dedupe_normalize",
+                              "dedupe_columns", "dedupe_keep", "dedupe_ignore_case",
+                              "normalize_keys_arabic", "normalize_keys_unicode",
+                              "dedupe_scorer", "dedupe_threshold"]),
+    ("anonymize_pii", _step_anonymize_pii, ["anonymize_pii"]),
+]
+
+def cleaning_step_keys(input_key, config, exclude_cols=None):
+    """
+    Chained cache keys, one per cleaning step.
+    key[i] identifies the frame after step i for this input and config prefix.
+    """
+    keys = []
+    prev = fingerprint(input_key, sorted(exclude_cols or []))
+    for name, _, deps in CLEANING_STEPS:
+        prev = fingerprint(prev, name, {k: config.get(k) for k in deps})
+        keys.append(prev)
+    return keys
+
+# ==========================================
+# MAIN CLEANING ENGINE
+# ==========================================
+# --- MAIN ENGINE ---
+def clean_dataframe(df: pd.DataFrame, config: dict, dry_run=False, exclude_cols=None, cache=None, input_key=None, stats=None,
+                    check=None, detected=None, dedupe_keys=None):
+    """
+    Runs the cleaning steps in order.
+    If a StageCache and an input_key (fingerprint of df) are given, the longest
+    cached prefix of steps is reused and only the remaining steps run.
+    stats: optional dict, filled with per-step statistics (e.g. fuzzy dedupe score distribution).
+    check: optional callable run before every step; it may raise to abandon the run (e.g. superseded previews).
+    detected: optional dict of the columns each content-sniffing step (dates, money, arabic) converted.
+              It is filled in by the run; steps already present are applied to those columns without sniffing,
+              so a batch of new rows is converted like the batch it joins.
+    dedupe_keys: optional dict; exact dedupe then keeps every row and stores "hashes"/"ignore"/"keep" here
+                 instead, plus "log_pos", the log index its line belongs at (bypasses the cache).
+    """
+    report_log = []
+    
+    # 1. Build Exclusion List
+    # Combines system exclusions (from merge) + User selected exclusions
+    if exclude_cols is None: exclude_cols = []
+    
+    user_ignores = config.get("ignore_columns", [])
+    
+    # Normalize user ignores to match dataframe columns
+    if config.get("standardize_columns"):
+        user_ignores = [standardize_name(c) for c in user_ignores]
+    
+    # Combine lists
+    state = {"exclusions": list(set(exclude_cols + user_ignores)), "log": report_log, "stats": {},
+             "detected": detected if detected is not None else {}, "dedupe_keys": dedupe_keys}
+
+    # 2. Resume from the longest cached prefix (if any)
+    use_cache = cache is not None and input_key is not None and dedupe_keys is None
+    keys = cleaning_step_keys(input_key, config, exclude_cols) if use_cache else []
+    start = 0
+    if use_cache:
+        for i in range(len(keys) - 1, -1, -1):
+            hit = cache.get(keys[i])
+            if hit is not None:
+                cached_df, exclusions, log, step_stats, step_detected = hit
+                df = cached_df
+                state.update(exclusions=list(exclusions), log=list(log), stats=dict(step_stats))
+                state["detected"].update(step_detected)
+                start = i + 1
+                break
+
+    df = df.copy()
+
+    # 3. Run the remaining steps
+    for i in range(start, len(CLEANING_STEPS)):
+        name, step, deps = CLEANING_STEPS[i]
+        if check is not None: check()
+        log_len = len(state["log"])
+        df = step(df, config, state)
+        # Only snapshot steps that did something; no-op steps resolve to an earlier key
+        if use_cache and (any(config.get(k) for k in deps) or i == 0 or len(state["log"]) > log_len):
+            cache.put(keys[i], (df.copy(), list(state["exclusions"]), list(state["log"]), dict(state["stats"]),
+                                dict(state["detected"])))
 
-    return df, report_log
\ No newline at end of file
+    if stats is not None:
+        stats.update(state["stats"])
+    return df, state["log"]
@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_string_dtype, is_object_dtype
+from app.utils.json_utils import to_native
+
+# Keep policies for find_duplicates
+KEEP_POLICIES = ("first", "last", "most_complete")
+
+# Duplicate groups returned for audit (the counts always cover every group)
+AUDIT_GROUPS_MAX = 200
+
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _normalize_text(s):
+    """Lowercase + trim + collapse inner whitespace; non-string values are left as they are."""
+    if not (is_string_dtype(s) or is_object_dtype(s)):
+        return s
+    norm = s.str.strip().str.replace(r'\s+', ' ', regex=True).str.lower()
+    return norm.where(norm.notna(), s)
+
+
+def combine_hashes(h, column_hash):
+    """Order-dependent mix of a running row hash with the next column's hash (boost hash_combine, 64-bit)."""
+    with np.errstate(over="ignore"):
+        return h ^ (column_hash + _GOLDEN + (h << np.uint64(6)) + (h >> np.uint64(2)))
+
+
+def row_hashes(df, columns=None, normalize=False):
+    """
+    One uint64 hash per row over `columns` (default: all), built column by column with
+    pandas' vectorized hashing, so memory stays at one hash array (+ one column at a time).
+    normalize: compare text case- and whitespace-insensitively.
+    Missing values hash equal to each other (same as drop_duplicates).
+    """
+    cols = list(columns) if columns else list(df.columns)
+    h = np.zeros(len(df), dtype=np.uint64)
+    for i, col in enumerate(cols):
+        s = df[col] if columns else df.iloc[:, i]
+        if normalize:
+            s = _normalize_text(s)
+        h = combine_hashes(h, pd.util.hash_pandas_object(s, index=False).to_numpy())
+    return h
+
+
+def _completeness(df):
+    """Non-missing, non-empty cells per row."""
+    counts = np.zeros(len(df), dtype=np.int32)
+    for i in range(df.shape[1]):
+        s = df.iloc[:, i]
+        filled = s.notna().to_numpy()
+        if is_string_dtype(s) or is_object_dtype(s):
+            filled = filled & (s.to_numpy(dtype=object) != "")
+        counts += filled
+    return counts
+
+
+def find_duplicates(df, columns=None, normalize=False, keep="first", hashes=None, ignore=None):
+    """
+    Exact duplicate detection on 64-bit row/key hashes.
+    columns: key subset (default: entire row). hashes: precomputed key hashes (skips row_hashes).
+    keep: "first", "last" or "most_complete" (row with the most filled cells; ties -> first).
+    ignore: bool mask of rows that never count as duplicates (e.g. empty keys).
+    With 64-bit hashes a false match needs a collision (~n^2 / 2^65; negligible below billions of rows).
+
+    Returns (keep_mask, audit):
+      keep_mask: bool array aligned with df rows
+      audit: {"groups", "removed", "keep", "sample_groups": [{"kept", "removed": [...]}]} with index labels
+    """
+    if keep not in KEEP_POLICIES:
+        raise ValueError(f"Unknown keep policy: {keep}")
+    if hashes is None:
+        hashes = row_hashes(df, columns, normalize)
+
+    n = len(hashes)
+    candidates = np.ones(n, dtype=bool) if ignore is None else ~np.asarray(ignore, dtype=bool)
+    # Dense group id per row, in order of first appearance (-1: ignored rows)
+    codes, _ = pd.factorize(hashes)
+    codes[~candidates] = -1
+    # At least one bin, so sizes[...] below also works when every row is ignored
+    sizes = np.bincount(codes[candidates], minlength=int(codes.max(initial=0)) + 1)
+
+    # Only rows of duplicate groups need ordering; everything else is kept as is
+    in_dup = candidates & (sizes[np.maximum(codes, 0)] > 1)
+    rows = np.flatnonzero(in_dup)
+    if keep == "first":
+        preference = rows
+    elif keep == "last":
+        preference = -rows
+    else:
+        # Most filled cells first, ties -> first occurrence
+        preference = np.lexsort((rows, -_completeness(df.iloc[rows])))
+        preference = np.argsort(preference, kind="stable")
+    order = rows[np.lexsort((preference, codes[rows]))]
+    sorted_codes = codes[order]
+    group_start = np.r_[True, sorted_codes[1:] != sorted_codes[:-1]] if len(order) else np.zeros(0, dtype=bool)
+
+    keep_mask = ~in_dup
+    keep_mask[order[group_start]] = True
+
+    # Audit: duplicate groups (size > 1)
+    dup_groups = np.flatnonzero(sizes > 1)
+    audit = {
+        "groups": int(len(dup_groups)),
+        "removed": int(n - keep_mask.sum()),
+        "keep": keep,
+        "sample_groups": [],
+    }
+    if len(dup_groups):
+        # Group ids follow first appearance, so the sample is the earliest groups
+        in_sample = np.isin(sorted_codes, dup_groups[:AUDIT_GROUPS_MAX])
+        labels = df.index
+        for start in np.flatnonzero(group_start & in_sample):
+            members = order[start:start + sizes[sorted_codes[start]]]
+            audit["sample_groups"].append({
+                "kept": to_native(labels[members[0]]),
+                "removed": [to_native(l) for l in labels[np.sort(members[1:])]],
+            })
+    return keep_mask, audit
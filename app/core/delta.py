@@ -0,0 +1,292 @@
+"""
+Delta cleaning for recurring exports.
+
+A baseline stores, for the last cleaned export, every raw row's hash, its cleaned row and the
+row's dedupe key hash. The next export of the same baseline reuses the cleaned rows of every
+raw row seen before; only new/changed rows go through merge + cleaning. Dedupe then runs over
+the stored key hashes + the new rows' hashes, so nothing already stored is re-hashed.
+
+Baselines are swapped in under a per-baseline lock (shared by worker processes) and evicted
+least-recently-used beyond settings.BASELINE_MAX_BYTES or when unused for settings.BASELINE_MAX_AGE.
+
+Layout of a baseline directory:
+  meta.json        identity (config + columns + lookup), detected columns, merged columns, version
+  hashes.npy       raw row hash per stored row
+  ids.npy          row identity hash per stored row (delta key columns, or the row hash)
+  clean_pos.npy    position of each stored row in clean.pkl (-1: dropped by cleaning)
+  clean.pkl        cleaned rows, before dedupe
+  dedupe.npz       dedupe key hashes (+ empty-key mask) aligned with clean.pkl, when dedupe is on
+"""
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from app.config import settings
+from app.core.cache import fingerprint, dir_lock, swap_dir
+from app.core.dedupe import row_hashes
+from app.utils.json_utils import dumps
+
+# Config fields that only choose the baseline / row identity (not part of the cleaning result)
+DELTA_CONFIG_KEYS = ["delta_baseline", "delta_key"]
+
+# Cleaning steps that pick their columns from the first values of each column (see cleaner)
+SNIFFED_STEPS = ("fix_dates", "clean_money")
+SNIFF_SAMPLE = 15
+# Upper bound on the leading rows re-cleaned with every delta
+PROBE_ROWS_MAX = 1000
+
+_ARABIC = r"[\u0600-\u06FF]"
+
+# Leftover temp / swapped-out directories older than this are removed by eviction (seconds)
+LEFTOVER_AGE = 3600
+
+
+def baseline_path(name):
+    """Directory of a named baseline under settings.BASELINE_DIR."""
+    safe = re.sub(r"[^A-Za-z0-9_.-]", "_", name.strip())[:100]
+    return os.path.join(settings.BASELINE_DIR, safe)
+
+
+def delta_blocker(cfg):
+    """Why this config can't reuse stored rows (a step that looks at every row at once), or None."""
+    if (cfg.get("remove_duplicates") and cfg.get("fuzzy_dedupe") and not cfg.get("dedupe_columns")
+            and cfg.get("dedupe_column", "ALL") != "ALL"):
+        return "fuzzy dedupe compares every row with the others"
+    if (cfg.get("fill_missing") or {}).get("numeric") in ("mean", "median"):
+        return "mean/median fill depends on every row"
+    return None
+
+
+def probe_rows(raw_df):
+    """
+    Leading rows to re-clean with every delta: twice the rows holding the first SNIFF_SAMPLE values
+    of every column (margin for values sanitizing turns into blanks), at most PROBE_ROWS_MAX.
+    Cleaned together with the delta, they give SNIFFED_STEPS the same sample as a full run.
+    """
+    n = 0
+    for i in range(raw_df.shape[1]):
+        filled = np.flatnonzero(raw_df.iloc[:, i].notna().to_numpy())
+        n = max(n, filled[SNIFF_SAMPLE - 1] + 1 if len(filled) >= SNIFF_SAMPLE else len(raw_df))
+    return min(2 * n, PROBE_ROWS_MAX)
+
+
+def arabic_columns(df):
+    """Raw text columns holding Arabic letters in any row."""
+    return [str(c) for c in df.select_dtypes(include=["object", "string"]).columns
+            if df[c].astype(str).str.contains(_ARABIC, regex=True).any()]
+
+
+def baseline_identity(cfg, raw_df, lookup=None):
+    """Stored rows are only reusable when config, raw columns/dtypes and lookup are all unchanged."""
+    return fingerprint({k: v for k, v in cfg.items() if k not in DELTA_CONFIG_KEYS},
+                       [str(c) for c in raw_df.columns], [str(t) for t in raw_df.dtypes], lookup)
+
+
+def baseline_version(path):
+    """Version tag of the stored baseline (changes on every save), or None."""
+    try:
+        with open(os.path.join(path, "meta.json"), "rb") as f:
+            return json.loads(f.read())["version"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def load_baseline(path):
+    """The stored baseline as a dict (see save_baseline), or None if there is none."""
+    try:
+        # Under the lock, so a concurrent save never swaps files in mid-read
+        with dir_lock(path):
+            meta_path = os.path.join(path, "meta.json")
+            with open(meta_path, "rb") as f:
+                meta = json.loads(f.read())
+            baseline = {
+                "meta": meta,
+                "hashes": np.load(os.path.join(path, "hashes.npy")),
+                "ids": np.load(os.path.join(path, "ids.npy")),
+                "clean_pos": np.load(os.path.join(path, "clean_pos.npy")),
+                "clean": pd.read_pickle(os.path.join(path, "clean.pkl")),
+                "dedupe": None,
+            }
+            if meta.get("dedupe"):
+                with np.load(os.path.join(path, "dedupe.npz")) as z:
+                    baseline["dedupe"] = {"hashes": z["hashes"], "ignore": z["ignore"] if "ignore" in z else None}
+            # meta.json's mtime is the last use, for eviction
+            os.utime(meta_path)
+        return baseline
+    except (OSError, ValueError, KeyError) as e:
+        if os.path.exists(path):
+            print(f"Ignoring unreadable baseline {path}: {e}")
+        return None
+
+
+def save_baseline(path, baseline):
+    """
+    Writes a baseline dict (meta, hashes, ids, clean_pos, clean, dedupe) next to `path`, then swaps it in
+    (swap_dir, under the baseline lock): readers see either version, never none.
+    Evicts old baselines afterwards. Returns the meta dict.
+    """
+    tmp_dir = f"{path}.tmp-{uuid.uuid4().hex[:8]}"
+    os.makedirs(tmp_dir)
+    try:
+        meta = dict(baseline["meta"], version=uuid.uuid4().hex, dedupe=baseline["dedupe"] is not None)
+        for name in ("hashes", "ids", "clean_pos"):
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), baseline[name])
+        baseline["clean"].to_pickle(os.path.join(tmp_dir, "clean.pkl"))
+        if baseline["dedupe"] is not None:
+            arrays = {k: v for k, v in baseline["dedupe"].items() if v is not None}
+            np.savez(os.path.join(tmp_dir, "dedupe.npz"), **arrays)
+        with open(os.path.join(tmp_dir, "meta.json"), "wb") as f:
+            f.write(dumps(meta))
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    swap_dir(tmp_dir, path)
+    evict_baselines(keep=path)
+    return meta
+
+
+def _dir_size(path):
+    return sum(e.stat().st_size for e in os.scandir(path) if e.is_file())
+
+
+def evict_baselines(keep=None, max_bytes=None, max_age=None):
+    """
+    Deletes baselines unused for `max_age` seconds, then the least recently used ones until the rest fit
+    in `max_bytes` (defaults: settings.BASELINE_MAX_AGE / BASELINE_MAX_BYTES). `keep` is never evicted.
+    Also removes temp / swapped-out directories left behind by crashed saves. Returns the evicted names.
+    """
+    max_bytes = settings.BASELINE_MAX_BYTES if max_bytes is None else max_bytes
+    max_age = settings.BASELINE_MAX_AGE if max_age is None else max_age
+    now = time.time()
+    baselines, evicted = [], []
+    try:
+        entries = list(os.scandir(settings.BASELINE_DIR))
+    except OSError:
+        return evicted
+    for e in entries:
+        if not e.is_dir():
+            continue
+        try:
+            if re.search(r"\.(tmp|old)-[0-9a-f]{8}$", e.name):
+                if now - e.stat().st_mtime > LEFTOVER_AGE:
+                    shutil.rmtree(e.path, ignore_errors=True)
+            elif not e.name.endswith(".lock"):
+                last_used = os.path.getmtime(os.path.join(e.path, "meta.json"))
+                baselines.append((last_used, _dir_size(e.path), e.path))
+        except OSError:
+            continue
+
+    keep = os.path.abspath(keep) if keep else None
+    total = sum(size for _, size, _ in baselines)
+    for last_used, size, path in sorted(baselines):
+        if os.path.abspath(path) == keep:
+            continue
+        if now - last_used <= max_age and total <= max_bytes:
+            continue
+        try:
+            with dir_lock(path, timeout=0):
+                aside = f"{path}.old-{uuid.uuid4().hex[:8]}"
+                os.replace(path, aside)
+        except (TimeoutError, OSError):
+            # In use right now: try again next time
+            continue
+        shutil.rmtree(aside, ignore_errors=True)
+        total -= size
+        evicted.append(os.path.basename(path))
+    return evicted
+
+
+def match_rows(raw_df, baseline, key_columns=None):
+    """
+    Splits an export into reusable and to-clean rows.
+    Rows are reused when their full raw row hash is stored; key_columns only decide how the rest
+    is reported (changed: known key, new content / new: unknown key).
+
+    Returns a dict:
+      hashes, ids: raw row hash and row identity hash per row
+      source:      stored row per row (-1: must be cleaned)
+      stats:       {"rows", "reused", "cleaned", "new", "changed", "removed"}
+    """
+    missing = [c for c in key_columns or [] if c not in raw_df.columns]
+    if missing:
+        raise ValueError(f"Delta key column(s) not found: {missing}")
+    hashes = row_hashes(raw_df)
+    ids = row_hashes(raw_df, key_columns) if key_columns else hashes
+
+    source = np.full(len(raw_df), -1, dtype=np.int64)
+    new, changed, removed = len(raw_df), 0, 0
+    if baseline is not None:
+        # First stored occurrence of every row hash
+        stored, first = np.unique(baseline["hashes"], return_index=True)
+        loc = pd.Index(stored).get_indexer(hashes)
+        source = np.where(loc >= 0, first[np.maximum(loc, 0)], -1)
+        known = pd.Index(np.unique(baseline["ids"])).get_indexer(ids) >= 0
+        new = int((~known).sum())
+        changed = int((known & (source < 0)).sum())
+        removed = int((~np.isin(baseline["ids"], ids)).sum())
+
+    reused = int((source >= 0).sum())
+    return {
+        "hashes": hashes,
+        "ids": ids,
+        "source": source,
+        "stats": {"rows": len(raw_df), "reused": reused, "cleaned": len(raw_df) - reused,
+                  "new": new, "changed": changed, "removed": removed},
+    }
+
+
+def splice(raw_index, baseline, source, delta_clean, delta_keys=None):
+    """
+    Combines reused stored rows with freshly cleaned rows, in export order, before dedupe.
+    raw_index: index of the export. source: match_rows()["source"].
+    delta_clean: cleaned new/changed rows (labels from raw_index), or None.
+    delta_keys: their dedupe_keys from clean_dataframe ({} / None when dedupe didn't run).
+
+    Returns (combined, clean_pos, dedupe): combined frame labelled like the export,
+    each export row's position in it (-1: dropped), and the aligned {"hashes", "ignore"} or None.
+    """
+    parts, positions, key_parts, ignore_parts = [], [], [], []
+    stored_dedupe = baseline["dedupe"] if baseline is not None else None
+
+    rows = np.flatnonzero(source >= 0)
+    if len(rows):
+        stored_pos = baseline["clean_pos"][source[rows]]
+        kept = stored_pos >= 0
+        rows, stored_pos = rows[kept], stored_pos[kept]
+        parts.append(baseline["clean"].iloc[stored_pos].set_axis(raw_index[rows]))
+        positions.append(rows)
+        if stored_dedupe is not None:
+            key_parts.append(stored_dedupe["hashes"][stored_pos])
+            ignore = stored_dedupe["ignore"]
+            ignore_parts.append(ignore[stored_pos] if ignore is not None else np.zeros(len(rows), dtype=bool))
+
+    if delta_clean is not None and len(delta_clean):
+        parts.append(delta_clean)
+        positions.append(raw_index.get_indexer(delta_clean.index))
+        if delta_keys:
+            key_parts.append(np.asarray(delta_keys["hashes"], dtype=np.uint64))
+            ignore = delta_keys.get("ignore")
+            ignore_parts.append(np.asarray(ignore, dtype=bool) if ignore is not None
+                                else np.zeros(len(delta_clean), dtype=bool))
+
+    if not parts:
+        empty = delta_clean if delta_clean is not None else baseline["clean"].iloc[:0]
+        return empty, np.full(len(raw_index), -1, dtype=np.int64), None
+
+    combined = pd.concat(parts) if len(parts) > 1 else parts[0]
+    positions = np.concatenate(positions)
+    order = np.argsort(positions, kind="stable")
+    combined = combined.iloc[order]
+    clean_pos = np.full(len(raw_index), -1, dtype=np.int64)
+    clean_pos[positions[order]] = np.arange(len(order))
+
+    dedupe = None
+    if key_parts and sum(len(k) for k in key_parts) == len(order):
+        dedupe = {"hashes": np.concatenate(key_parts)[order], "ignore": np.concatenate(ignore_parts)[order]}
+    return combined, clean_pos, dedupe
@@ -0,0 +1,152 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from app.config import settings
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS key_index (
+    lookup_hash TEXT NOT NULL,
+    key_col TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (lookup_hash, key_col)
+);
+CREATE TABLE IF NOT EXISTS match_memo (
+    lookup_hash TEXT NOT NULL,
+    key_col TEXT NOT NULL,
+    scorer TEXT NOT NULL,
+    threshold REAL NOT NULL,
+    query TEXT NOT NULL,
+    match TEXT,
+    score REAL NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (lookup_hash, key_col, scorer, threshold, query)
+);
+CREATE INDEX IF NOT EXISTS match_memo_lru ON match_memo (last_used);
+"""
+
+
+class MatchCache:
+    """
+    On-disk cache shared across sessions (and days) for recurring lookup files.
+
+    * key_index:  normalized key index of a lookup file, keyed by the file's content hash
+    * match_memo: memoized fuzzy results (query key -> matched key, score) per scorer/threshold.
+                  Misses are stored too (match = NULL) since they are the most expensive to recompute.
+
+    Both tables are size-bounded and evict least-recently-used rows.
+    """
+
+    def __init__(self, path, max_matches=None, max_indexes=None):
+        self.path = path
+        self.max_matches = max_matches or settings.MATCH_CACHE_MAX_ENTRIES
+        self.max_indexes = max_indexes or settings.MATCH_CACHE_MAX_INDEXES
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:  # commit / rollback
+                yield conn
+        finally:
+            conn.close()
+
+    # --- Key Index ---
+    def get_index(self, lookup_hash, key_col):
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT payload FROM key_index WHERE lookup_hash=? AND key_col=?",
+                (lookup_hash, key_col)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE key_index SET last_used=? WHERE lookup_hash=? AND key_col=?",
+                (time.time(), lookup_hash, key_col)
+            )
+        return json.loads(row[0])
+
+    def put_index(self, lookup_hash, key_col, entries):
+        """entries: list of [normalized_key, row_position]"""
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO key_index VALUES (?, ?, ?, ?)",
+                (lookup_hash, key_col, json.dumps(entries), time.time())
+            )
+            conn.execute(
+                "DELETE FROM key_index WHERE rowid NOT IN "
+                "(SELECT rowid FROM key_index ORDER BY last_used DESC LIMIT ?)",
+                (self.max_indexes,)
+            )
+
+    # --- Fuzzy Match Memo ---
+    def get_matches(self, lookup_hash, key_col, scorer, threshold, queries):
+        """Returns {query: (match_or_None, score)} for the queries already resolved."""
+        found = {}
+        queries = list(queries)
+        if not queries:
+            return found
+        with self._lock, self._connect() as conn:
+            # SQLite caps the number of bound parameters; query in chunks
+            for i in range(0, len(queries), 500):
+                chunk = queries[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                rows = conn.execute(
+                    f"SELECT query, match, score FROM match_memo "
+                    f"WHERE lookup_hash=? AND key_col=? AND scorer=? AND threshold=? AND query IN ({marks})",
+                    [lookup_hash, key_col, scorer, float(threshold)] + chunk
+                ).fetchall()
+                for q, m, sc in rows:
+                    found[q] = (m, sc)
+            if found:
+                now = time.time()
+                conn.executemany(
+                    "UPDATE match_memo SET last_used=? WHERE lookup_hash=? AND key_col=? "
+                    "AND scorer=? AND threshold=? AND query=?",
+                    [(now, lookup_hash, key_col, scorer, float(threshold), q) for q in found]
+                )
+        return found
+
+    def put_matches(self, lookup_hash, key_col, scorer, threshold, results):
+        """results: {query: (match_or_None, score)}"""
+        if not results:
+            return
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO match_memo VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(lookup_hash, key_col, scorer, float(threshold), q, m, float(sc), now)
+                 for q, (m, sc) in results.items()]
+            )
+            count = conn.execute("SELECT COUNT(*) FROM match_memo").fetchone()[0]
+            if count > self.max_matches:
+                conn.execute(
+                    "DELETE FROM match_memo WHERE rowid IN "
+                    "(SELECT rowid FROM match_memo ORDER BY last_used ASC LIMIT ?)",
+                    (count - self.max_matches,)
+                )
+
+    def clear(self):
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM key_index")
+            conn.execute("DELETE FROM match_memo")
+
+
+_match_cache = None
+
+def get_match_cache():
+    """Process-wide MatchCache stored under settings.CACHE_DIR."""
+    global _match_cache
+    if _match_cache is None:
+        _match_cache = MatchCache(os.path.join(settings.CACHE_DIR, "match_cache.sqlite3"))
+    return _match_cache
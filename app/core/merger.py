@@ -1,7 +1,17 @@
+import hashlib
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-from rapidfuzz import process, fuzz
 import numpy as np
 import re
+from app.config import settings
+from app.core.arabic import normalize_arabic_series
+from app.core.cache import StageCache
+from app.core.scoring import best_matches, score_distribution
+
+# Separator between components of a composite key ("name" + "city")
+KEY_SEP = "\x1f"
 
 def normalize_key_for_merge(text):
     """
@@ -13,94 +23,333 @@ def normalize_key_for_merge(text):
     s = str(text).lower()
     return re.sub(r'[^\w]', '', s)
 
-def fuzzy_merge_datasets(df_main, df_sec, key_main, key_sec, fuzzy=True, threshold=75.0):
+# Latin/Greek/Cyrillic combining marks left behind by NFKD (accents, diaeresis, ...)
+_COMBINING_MARKS = r'[\u0300-\u036f\u1ab0-\u1aff\u1dc0-\u1dff\u20d0-\u20ff\ufe20-\ufe2f]'
+
+# Normalized key columns, shared by the merge and both dedupe paths
+KEY_CACHE = StageCache(settings.KEY_CACHE_BUDGET)
+
+def normalize_key_column(series, arabic=False, unicode_fold=False):
+    """
+    Vectorized normalize_key_for_merge over a whole column.
+    arabic: also apply normalize_arabic (Tashkeel, Alef/Yeh forms, Arabic digits).
+    unicode_fold: NFKC compatibility folding + accent stripping ('Café' -> 'cafe').
+    Returns a numpy object array; missing/empty values become "".
+    """
+    na = series.isna().to_numpy()
+    s = series.astype(str)
+    if unicode_fold:
+        s = s.str.normalize("NFKD").str.replace(_COMBINING_MARKS, "", regex=True).str.normalize("NFKC")
+    if arabic:
+        s = normalize_arabic_series(s)
+    s = s.str.lower().str.replace(r'[^\w]', '', regex=True)
+    out = s.to_numpy(dtype=object, na_value="")
+    out[na] = ""
+    return out
+
+def normalized_keys(series, arabic=False, unicode_fold=False, cache=KEY_CACHE):
+    """
+    normalize_key_column memoized on the column's content hash, so the merge, fuzzy dedupe and
+    exact subset dedupe reuse one normalized copy. Treat the returned array as read-only.
+    """
+    if cache is None:
+        return normalize_key_column(series, arabic, unicode_fold)
+    hashed = pd.util.hash_pandas_object(series, index=False).to_numpy()
+    key = (hashlib.sha1(hashed.tobytes()).hexdigest(), len(series), bool(arabic), bool(unicode_fold))
+    keys = cache.get(key)
+    if keys is None:
+        keys = normalize_key_column(series, arabic, unicode_fold)
+        cache.put(key, keys)
+    return keys
+
+def _norm_tag(arabic=False, unicode_fold=False):
+    """Suffix for persistent cache ids; empty for the default normalization."""
+    tag = ("a" if arabic else "") + ("u" if unicode_fold else "")
+    return f"#norm={tag}" if tag else ""
+
+def _as_key_list(keys):
+    if isinstance(keys, str):
+        return [keys] if keys else []
+    return list(keys or [])
+
+def composite_keys(df, cols, arabic=False, unicode_fold=False):
+    """
+    Normalized (composite) key per row as a numpy object array.
+    Rows where any component is empty get "" and never match.
+    """
+    parts = [normalized_keys(df[c], arabic, unicode_fold) for c in cols]
+    if len(parts) == 1:
+        return parts[0].copy()
+    joined = parts[0]
+    for p in parts[1:]:
+        joined = joined + KEY_SEP + p
+    empty = np.zeros(len(df), dtype=bool)
+    for p in parts:
+        empty |= (p == "")
+    joined[empty] = ""
+    return joined
+
+def build_lookup_index(df_sec, key_sec, lookup_hash=None, match_cache=None, arabic=False, unicode_fold=False):
+    """
+    Normalized key -> first row position in df_sec, plus the ordered key list used for fuzzy scoring.
+    key_sec may be a column name or a list of columns (composite key).
+    When the lookup file's content hash is known, the index is read from / written to the on-disk MatchCache.
+    """
+    keys = _as_key_list(key_sec)
+    cache_col = "|".join(keys) + _norm_tag(arabic, unicode_fold)
+    if lookup_hash and match_cache:
+        entries = match_cache.get_index(lookup_hash, cache_col)
+        if entries is not None:
+            return {k: pos for k, pos in entries}, [k for k, _ in entries]
+
+    # First occurrence of every non-empty key wins
+    norm = pd.Series(composite_keys(df_sec, keys, arabic, unicode_fold))
+    norm = norm[norm != ""].drop_duplicates(keep="first")
+    sec_keys_clean = norm.tolist()
+    sec_map = dict(zip(sec_keys_clean, norm.index.tolist()))
+
+    if lookup_hash and match_cache:
+        match_cache.put_index(lookup_hash, cache_col, [[k, sec_map[k]] for k in sec_keys_clean])
+    return sec_map, sec_keys_clean
+
+def _fuzzy_resolve(pending, sec_keys_clean, threshold, block_pos=None, scorer="wratio", bulk_scoring=False):
+    """
+    Scores the leftover (unmatched) keys against the lookup keys.
+    With block_pos, candidates are restricted to lookup keys sharing that exact key component,
+    and only the remaining components are scored.
+    Returns {query: (matched_key_or_None, score)}.
+    """
+    if block_pos is None:
+        groups = {None: (pending, [q.replace(KEY_SEP, " ") for q in pending], sec_keys_clean,
+                         [k.replace(KEY_SEP, " ") for k in sec_keys_clean])}
+    else:
+        def split(k):
+            parts = k.split(KEY_SEP)
+            return parts[block_pos], " ".join(p for i, p in enumerate(parts) if i != block_pos)
+
+        groups = {}
+        for k in sec_keys_clean:
+            block, rest = split(k)
+            groups.setdefault(block, ([], [], [], []))
+            groups[block][2].append(k)
+            groups[block][3].append(rest)
+        for q in pending:
+            block, rest = split(q)
+            if block in groups:
+                groups[block][0].append(q)
+                groups[block][1].append(rest)
+
+    results = {q: (None, 0.0) for q in pending}
+    for queries, query_strs, originals, choices in groups.values():
+        matches = best_matches(query_strs, choices, scorer, threshold, bulk_scoring)
+        for q, m in zip(queries, matches):
+            if m is not None:
+                results[q] = (originals[m[0]], m[1])
+    return results
+
+def _collision_renames(sec_columns, keys_sec, taken, suffix="_lookup"):
+    """
+    Lookup columns clashing with existing columns get `suffix` ("Email" -> "Email_lookup",
+    then "Email_lookup_1", ...). Key columns are never added, so they are never renamed.
+    """
+    rename_map = {}
+    for col in sec_columns:
+        if col in keys_sec: continue
+        if col in taken:
+            new_name = f"{col}{suffix}"
+            counter = 1
+            while new_name in taken:
+                new_name = f"{col}{suffix}_{counter}"
+                counter += 1
+            rename_map[col] = new_name
+    return rename_map
+
+def resolve_matches(main_norm, df_sec, keys_sec, fuzzy=True, threshold=75.0, lookup_hash=None, match_cache=None,
+                    block_pos=None, arabic=False, unicode_fold=False, scorer="wratio", bulk_scoring=False,
+                    lookup_index=None):
+    """
+    Lookup row position for every normalized main key (composite_keys output); -1 = no match.
+    Exact matches: vectorized hash join. Fuzzy scoring only runs on the leftovers.
+    Returns (match_pos, stats) with the score distribution and stage timings.
+    """
+    # 1. Lookup Map (row positions, reused from disk for known lookup files)
+    if lookup_index is None:
+        lookup_index = build_lookup_index(df_sec, keys_sec, lookup_hash, match_cache, arabic, unicode_fold)
+    sec_map, sec_keys_clean = lookup_index
+    sec_positions = np.array([sec_map[k] for k in sec_keys_clean], dtype=np.int64)
+
+    # 2. A) Exact Match: vectorized hash join on the normalized keys
+    t0 = time.perf_counter()
+    hit = pd.Index(sec_keys_clean).get_indexer(main_norm) if sec_keys_clean else np.full(len(main_norm), -1)
+    match_pos = np.where(hit >= 0, sec_positions[hit] if len(sec_positions) else -1, -1)
+    exact_count = int((match_pos >= 0).sum())
+    t1 = time.perf_counter()
+
+    # B) Fuzzy Match on the leftovers only (memoized per lookup file + scorer + threshold)
+    fuzzy_scores = []
+    if fuzzy and sec_keys_clean:
+        leftover = (match_pos < 0) & (main_norm != "")
+        pending = list(dict.fromkeys(main_norm[leftover].tolist()))
+        memo_col = "|".join(keys_sec) + _norm_tag(arabic, unicode_fold) + (f"#block={block_pos}" if block_pos is not None else "")
+        memo = {}
+        if lookup_hash and match_cache and pending:
+            memo = match_cache.get_matches(lookup_hash, memo_col, scorer, threshold, pending)
+        fresh = _fuzzy_resolve([q for q in pending if q not in memo], sec_keys_clean, threshold, block_pos,
+                               scorer, bulk_scoring)
+        if lookup_hash and match_cache:
+            match_cache.put_matches(lookup_hash, memo_col, scorer, threshold, fresh)
+        memo.update(fresh)
+        fuzzy_pos = {q: sec_map.get(memo[q][0], -1) for q in pending if memo[q][0] is not None}
+        if fuzzy_pos:
+            rows = np.flatnonzero(leftover)
+            match_pos[rows] = [fuzzy_pos.get(k, -1) for k in main_norm[rows]]
+            fuzzy_scores = [memo[k][1] for k in main_norm[rows] if fuzzy_pos.get(k, -1) >= 0]
+    t2 = time.perf_counter()
+
+    stats = score_distribution(fuzzy_scores, exact=exact_count, unmatched=int((match_pos < 0).sum()))
+    stats.update({
+        "scorer": scorer,
+        "threshold": threshold,
+        "exact_ms": round((t1 - t0) * 1000, 1),
+        "fuzzy_ms": round((t2 - t1) * 1000, 1),
+    })
+    return match_pos, stats
+
+def _copy_matched(df_main, df_sec, cols, match_pos):
+    """C) Copy Data (whole columns at once). Returns the matched row count."""
+    matched = match_pos >= 0
+    for col in cols:
+        values = np.full(len(df_main), None, dtype=object)
+        values[matched] = df_sec[col].to_numpy(dtype=object)[match_pos[matched]]
+        df_main[col] = values
+    return int(matched.sum())
+
+def _block_pos(keys_main, block_on):
+    return keys_main.index(block_on) if block_on in keys_main and len(keys_main) > 1 else None
+
+def fuzzy_merge_datasets(df_main, df_sec, key_main, key_sec, fuzzy=True, threshold=75.0, lookup_hash=None, match_cache=None, block_on=None,
+                         arabic=False, unicode_fold=False, scorer="wratio", bulk_scoring=False, stats=None,
+                         lookup_index=None):
     """
     Performs a Left Join (VLOOKUP) from df_sec into df_main.
+    key_main / key_sec: a column name, or lists of columns for a composite key (paired by position).
+    Exact matches are resolved with a vectorized hash join; fuzzy scoring only runs on leftover rows,
+    optionally restricted to candidates sharing the exact `block_on` component (a key_main column).
+    lookup_hash: content hash of the lookup file; enables the persistent MatchCache
+                 (key index + memoized fuzzy results) when a match_cache is given.
+    arabic / unicode_fold: extra key normalization, see normalize_key_column.
+    scorer / bulk_scoring: see app.core.scoring.best_matches.
+    stats: optional dict, filled with the match score distribution and stage timings.
+    lookup_index: prebuilt build_lookup_index(df_sec, key_sec, ...) result, e.g. shared by batch workers.
     """
     try:
         df_main = df_main.copy()
-        df_sec = df_sec.copy()
-        
+        keys_main = _as_key_list(key_main)
+        keys_sec = _as_key_list(key_sec)
+
         # 1. Handle Column Name Collisions
         # If File 2 has "Email" and File 1 has "Email", rename File 2's to "Email_lookup"
-        rename_map = {}
-        for col in df_sec.columns:
-            if col == key_sec: continue 
-            
-            if col in df_main.columns:
-                new_name = f"{col}_lookup"
-                counter = 1
-                while new_name in df_main.columns:
-                    new_name = f"{col}_lookup_{counter}"
-                    counter += 1
-                rename_map[col] = new_name
-        
-        if rename_map:
-            df_sec.rename(columns=rename_map, inplace=True)
+        df_sec = df_sec.rename(columns=_collision_renames(df_sec.columns, keys_sec, df_main.columns))
 
         # 2. Identify Columns to Add
-        cols_to_add = [c for c in df_sec.columns if c != key_sec]
-        
+        cols_to_add = [c for c in df_sec.columns if c not in keys_sec]
+
         # Initialize them in Main DF
         for col in cols_to_add:
             df_main[col] = None
 
-        if key_main not in df_main.columns or key_sec not in df_sec.columns:
+        if not keys_main or len(keys_main) != len(keys_sec) \
+                or any(k not in df_main.columns for k in keys_main) \
+                or any(k not in df_sec.columns for k in keys_sec):
             return df_main, 0, []
 
-        # 3. Build Lookup Map
-        sec_map = {}
-        sec_keys_clean = []
-        
-        for idx, val in df_sec[key_sec].items():
-            if pd.isna(val): continue
-            clean_k = normalize_key_for_merge(val)
-            if not clean_k: continue
-            
-            if clean_k not in sec_map:
-                sec_map[clean_k] = idx
-                sec_keys_clean.append(clean_k)
-
-        # 4. Perform Match
-        merged_count = 0
-        
-        for idx, row in df_main.iterrows():
-            val = row[key_main]
-            val_clean = normalize_key_for_merge(val)
-            
-            if not val_clean:
-                continue
-                
-            match_idx = None
-            
-            # A) Exact Match
-            if val_clean in sec_map:
-                match_idx = sec_map[val_clean]
-            
-            # B) Fuzzy Match
-            elif fuzzy:
-                res = process.extractOne(
-                    val_clean, 
-                    sec_keys_clean, 
-                    scorer=fuzz.WRatio, 
-                    score_cutoff=threshold
-                )
-                if res:
-                    match_clean_key = res[0]
-                    match_idx = sec_map[match_clean_key]
-            
-            # C) Copy Data
-            if match_idx is not None:
-                for col in cols_to_add:
-                    try:
-                        source_val = df_sec.at[match_idx, col]
-                        df_main.at[idx, col] = source_val
-                    except: pass
-                merged_count += 1
+        # 3. Resolve + 4. Copy
+        main_norm = composite_keys(df_main, keys_main, arabic, unicode_fold)
+        match_pos, match_stats = resolve_matches(
+            main_norm, df_sec, keys_sec, fuzzy, threshold, lookup_hash, match_cache, _block_pos(keys_main, block_on),
+            arabic, unicode_fold, scorer, bulk_scoring, lookup_index
+        )
+        merged_count = _copy_matched(df_main, df_sec, cols_to_add, match_pos)
+
+        if stats is not None:
+            stats.update(match_stats)
 
         return df_main, merged_count, cols_to_add
 
     except Exception as e:
-        import traceback
         traceback.print_exc()
-        return df_main, 0, []
\ No newline at end of file
+        return df_main, 0, []
+
+def merge_lookups(df_main, lookups, match_cache=None, arabic=False, unicode_fold=False, bulk_scoring=False,
+                  parallel=True):
+    """
+    Several VLOOKUPs in one pass.
+    lookups: list of dicts with "df" (lookup frame), "key_main", "key_sec" and optionally
+             fuzzy, threshold, scorer, block_on, lookup_hash, lookup_index (as in fuzzy_merge_datasets)
+             and "suffix" for colliding column names (default "_lookup", "_lookup2", ...).
+    Every distinct main key is normalized once; the lookups are all resolved against the main file
+    (in threads when parallel) and their columns attached in order, each lookup renaming its own collisions.
+    Returns (df, [{"merged", "added_cols", "stats", "error"} per lookup]).
+    A lookup that fails only reports its error; the other lookups are still merged.
+    """
+    df_main = df_main.copy()
+    main_columns = list(df_main.columns)
+    results = [{"merged": 0, "added_cols": [], "stats": {}, "error": None} for _ in lookups]
+
+    # 1. Normalize each main key once (shared by lookups joining on the same columns)
+    main_keys = {}
+    jobs = []
+    for i, lk in enumerate(lookups):
+        keys_main, keys_sec = _as_key_list(lk.get("key_main")), _as_key_list(lk.get("key_sec"))
+        missing = [k for k in keys_main if k not in main_columns] + [k for k in keys_sec if k not in lk["df"].columns]
+        if not keys_main or len(keys_main) != len(keys_sec) or missing:
+            results[i]["error"] = f"Key column(s) not found: {missing}" if missing else "Key columns don't pair up"
+            continue
+        norm_id = tuple(keys_main)
+        try:
+            if norm_id not in main_keys:
+                main_keys[norm_id] = composite_keys(df_main, keys_main, arabic, unicode_fold)
+        except Exception as e:
+            results[i]["error"] = f"Could not normalize the main keys: {e}"
+            continue
+        jobs.append((i, main_keys[norm_id], keys_main, keys_sec))
+
+    # 2. Resolve every lookup against the main keys
+    def resolve(job):
+        i, main_norm, keys_main, keys_sec = job
+        lk = lookups[i]
+        try:
+            return resolve_matches(
+                main_norm, lk["df"], keys_sec, lk.get("fuzzy", False), lk.get("threshold", 75.0),
+                lk.get("lookup_hash"), match_cache, _block_pos(keys_main, lk.get("block_on")),
+                arabic, unicode_fold, lk.get("scorer", "wratio"), bulk_scoring, lk.get("lookup_index")
+            )
+        except Exception as e:
+            traceback.print_exc()
+            return None, f"Match failed: {e}"
+
+    if parallel and len(jobs) > 1:
+        with ThreadPoolExecutor(max_workers=min(len(jobs), settings.WORK_THREADS)) as pool:
+            resolved = list(pool.map(resolve, jobs))
+    else:
+        resolved = [resolve(job) for job in jobs]
+
+    # 3. Attach columns lookup by lookup; collisions also count columns added by earlier lookups
+    for (i, _, _, keys_sec), (match_pos, match_stats) in zip(jobs, resolved):
+        if match_pos is None:
+            results[i]["error"] = match_stats
+            continue
+        lk = lookups[i]
+        suffix = lk.get("suffix") or ("_lookup" if i == 0 else f"_lookup{i + 1}")
+        before = list(df_main.columns)
+        try:
+            df_sec = lk["df"].rename(columns=_collision_renames(lk["df"].columns, keys_sec, df_main.columns, suffix))
+            cols_to_add = [c for c in df_sec.columns if c not in keys_sec]
+            results[i].update(merged=_copy_matched(df_main, df_sec, cols_to_add, match_pos),
+                              added_cols=cols_to_add, stats=match_stats)
+        except Exception as e:
+            traceback.print_exc()
+            # Drop whatever this lookup attached before failing
+            df_main = df_main[before]
+            results[i]["error"] = f"Could not copy the lookup columns: {e}"
+    return df_main, results
@@ -0,0 +1,418 @@
+import json
+import os
+
+from app.config import settings
+from app.core.blobs import PROFILE_SUFFIX
+from app.core.cache import StageCache, fingerprint, file_fingerprint, content_hash
+from app.core.cleaner import clean_dataframe, cleaning_step_keys
+from app.core.dedupe import find_duplicates
+from app.core.delta import (SNIFFED_STEPS, baseline_path, baseline_version, baseline_identity, delta_blocker,
+                            arabic_columns, probe_rows, load_baseline, save_baseline, match_rows, splice)
+from app.core.match_cache import get_match_cache
+from app.core.merger import merge_lookups
+from app.core.reporter import compute_diff, compute_change_mask
+from app.utils.file_handler import read_file_as_df, list_sheets
+from app.utils.json_utils import dumps, frame_to_records
+
+# Config fields that affect the merge stage (everything else only affects cleaning)
+MERGE_CONFIG_KEYS = ["merge_active", "merge_key_main", "merge_key_sec", "merge_fuzzy",
+                     "merge_keys_main", "merge_keys_sec", "merge_block_on",
+                     "normalize_keys_arabic", "normalize_keys_unicode",
+                     "merge_scorer", "merge_threshold", "fuzzy_bulk_scoring", "lookups"]
+
+# Parsed uploads, shared by every session of this process (uploads are content-addressed blobs)
+FRAME_CACHE = StageCache(settings.FRAME_CACHE_BUDGET)
+
+
+def merge_options(cfg):
+    """fuzzy_merge_datasets keyword arguments (keys, matching, normalization) from a config dict."""
+    return {
+        "key_main": cfg.get("merge_keys_main") or cfg.get("merge_key_main"),
+        "key_sec": cfg.get("merge_keys_sec") or cfg.get("merge_key_sec"),
+        "fuzzy": cfg.get("merge_fuzzy"),
+        "block_on": cfg.get("merge_block_on") or None,
+        "arabic": cfg.get("normalize_keys_arabic", False),
+        "unicode_fold": cfg.get("normalize_keys_unicode", False),
+        "threshold": cfg.get("merge_threshold", 75.0),
+        "scorer": cfg.get("merge_scorer", "wratio"),
+        "bulk_scoring": cfg.get("fuzzy_bulk_scoring", True),
+    }
+
+
+def merge_message(merged_count, source=None):
+    """Report log line for a merge result (source: which lookup, when there are several)."""
+    if merged_count > 0:
+        return f"🔗 Merged/Enriched {merged_count} rows from {source or 'Lookup File'}"
+    return f"⚠️ Merge active but 0 rows matched{f' in {source}' if source else ''} (check your keys?)"
+
+
+def lookup_specs(cfg):
+    """Join settings per configured lookup: cfg["lookups"], or the legacy merge_* fields as lookup 0."""
+    if not cfg.get("lookups"):
+        opts = merge_options(cfg)
+        return [{"file": 0, "key_main": opts["key_main"], "key_sec": opts["key_sec"], "fuzzy": opts["fuzzy"],
+                 "block_on": opts["block_on"], "scorer": opts["scorer"], "threshold": opts["threshold"], "suffix": ""}]
+    return [{
+        "file": lk.get("file", 0),
+        "key_main": lk.get("keys_main") or lk.get("key_main"),
+        "key_sec": lk.get("keys_sec") or lk.get("key_sec"),
+        "fuzzy": lk.get("fuzzy", False),
+        "block_on": lk.get("block_on") or None,
+        "scorer": lk.get("scorer", "wratio"),
+        "threshold": lk.get("threshold", 75.0),
+        "suffix": lk.get("suffix", ""),
+    } for lk in cfg["lookups"]]
+
+
+def lookup_role(i):
+    """Session files / read_options key of lookup file i (the first keeps the original "secondary")."""
+    return "secondary" if i == 0 else f"secondary:{i}"
+
+
+def session_lookups(files, read_options=None):
+    """[(path, read options)] of a session's lookup files, in upload order."""
+    read_options = read_options or {}
+    lookups = []
+    while lookup_role(len(lookups)) in files:
+        role = lookup_role(len(lookups))
+        lookups.append((files[role], read_options.get(role)))
+    return lookups
+
+
+def frame_key(path, options=None):
+    """Stage key of a loaded file: (path, size, mtime) + Excel read options (sheet, header_row)."""
+    if options:
+        return fingerprint("load", file_fingerprint(path), options)
+    return fingerprint("load", file_fingerprint(path))
+
+
+def load_frame(path, cache=None, options=None):
+    """
+    Reads a file, memoized on (path, size, mtime, read options). Always returns a private copy.
+    options: optional {"sheet", "header_row"} for Excel files.
+    """
+    options = options or {}
+    if cache is None:
+        return read_file_as_df(path, **options)
+    key = frame_key(path, options)
+    df = cache.get(key)
+    if df is None:
+        df = read_file_as_df(path, **options)
+        cache.put(key, df)
+    return df.copy()
+
+
+def profile_frame(df):
+    """Upload analysis shown in the UI: shape, missing values, dtypes and a 5-row preview."""
+    return {
+        "rows": len(df),
+        "columns": list(df.columns),
+        "missing_values": {c: int(v) for c, v in df.isnull().sum().items()},
+        "dtypes": {c: str(t) for c, t in df.dtypes.items()},
+        # In-memory size of the parsed frame (strings included), for admission control
+        "memory_bytes": int(df.memory_usage(deep=True).sum()),
+        "preview": frame_to_records(df.head(5))
+    }
+
+
+def load_profile(path, options=None):
+    """
+    profile_frame for a stored upload (plus its sheet list and read options), cached as JSON next to the file.
+    Re-uploading the same bytes skips parsing entirely.
+    """
+    options = options or {}
+    tag = f".{fingerprint(options)[:12]}" if options else ""
+    profile_path = path + tag + PROFILE_SUFFIX
+    try:
+        with open(profile_path, "rb") as f:
+            profile = json.loads(f.read())
+        if "sheets" in profile:
+            return profile
+    except (OSError, ValueError):
+        pass
+
+    profile = profile_frame(load_frame(path, FRAME_CACHE, options))
+    profile.update({
+        "sheets": list_sheets(path),
+        "sheet": options.get("sheet"),
+        "header_row": options.get("header_row", 0),
+    })
+    tmp_path = f"{profile_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(dumps(profile))
+    os.replace(tmp_path, profile_path)
+    return profile
+
+
+class PipelineCancelled(Exception):
+    """Raised by a run_pipeline `check` callback to abandon a run between stages."""
+
+
+def estimate_pipeline_bytes(files, read_options=None):
+    """
+    Rough peak memory of one run_pipeline call, used for admission control:
+    settings.ESTIMATE_COPIES live copies of every input, each the size of its parsed frame
+    (the profile's memory_bytes; twice the file size for profiles without it).
+    """
+    read_options = read_options or {}
+    total = 0
+    inputs = [(files.get("original"), read_options.get("original"))] + session_lookups(files, read_options)
+    for path, options in inputs:
+        if not path or not os.path.exists(path):
+            continue
+        profile = load_profile(path, options)
+        total += profile.get("memory_bytes") or os.path.getsize(path) * 2
+    return total * settings.ESTIMATE_COPIES
+
+
+def lookup_identity(path, options=None):
+    """Content identity of a lookup table; another sheet of the same workbook is another table."""
+    return content_hash(path) + (f"#{fingerprint(options)[:12]}" if options else "")
+
+
+def merge_lookup_files(df, lookups, cfg, frame_cache=None):
+    """
+    Merges a session's lookup files (session_lookups) into df in one pass, as configured by lookup_specs(cfg).
+    Returns (df, added_cols, log lines, stats) with stats["merge"], stats["merge_2"], ... per configured lookup.
+    """
+    specs = lookup_specs(cfg)
+    jobs, log = [], []
+    for spec in specs:
+        if not 0 <= spec["file"] < len(lookups):
+            log.append(f"⚠️ Lookup File {spec['file'] + 1} is not uploaded, skipped")
+            continue
+        path, options = lookups[spec["file"]]
+        jobs.append(dict(spec, df=load_frame(path, frame_cache, options), lookup_hash=lookup_identity(path, options)))
+
+    opts = merge_options(cfg)
+    df, results = merge_lookups(df, jobs, match_cache=get_match_cache(), arabic=opts["arabic"],
+                                unicode_fold=opts["unicode_fold"], bulk_scoring=opts["bulk_scoring"])
+    added_cols, stats = [], {}
+    for n, (job, result) in enumerate(zip(jobs, results)):
+        source = f"Lookup File {job['file'] + 1}" if len(specs) > 1 else None
+        log.append(merge_message(result["merged"], source))
+        if result["error"]:
+            print(f"Merge skipped ({source or 'Lookup File'}): {result['error']}")
+        else:
+            stats["merge" if n == 0 else f"merge_{n + 1}"] = result["stats"]
+        added_cols += result["added_cols"]
+    return df, added_cols, log, stats
+
+
+def run_pipeline(files, config, cache=None, dry_run=False, read_options=None, check=None):
+    """
+    Runs merge + cleaning for a session's files.
+    Every stage is memoized in `cache` (a StageCache) keyed by
+    (input fingerprint, stage, relevant config subset), so toggling a single
+    option only re-runs the stages downstream of it.
+
+    files: {"original", "secondary", "secondary:1", ...} (lookup files in upload order, see lookup_role).
+    read_options: optional {role: {"sheet", "header_row"}} for Excel inputs, keyed like files.
+    check: optional callable run between stages (load, merge, every cleaning step);
+           raise PipelineCancelled from it to stop early. Completed stages stay cached.
+
+    With cfg["delta_baseline"] set, only rows not in that baseline are merged and cleaned
+    (see run_delta_pipeline).
+
+    Returns a dict: raw, clean, log, added_cols, stats, key (fingerprint of the result).
+    """
+    cfg = config.model_dump() if hasattr(config, "model_dump") else dict(config)
+    read_options = read_options or {}
+    if cfg.get("delta_baseline"):
+        return run_delta_pipeline(files, cfg, cache, dry_run, read_options, check)
+    original_path = files["original"]
+
+    frame_cache = FRAME_CACHE if cache is not None else None
+    raw_df = load_frame(original_path, frame_cache, read_options.get("original"))
+    df = raw_df
+    report_log = []  # Collects actions for the UI
+    stats = {}  # Match score distributions (merge / fuzzy dedupe)
+
+    # 1. APPLY MERGE IF ACTIVE
+    if check is not None: check()
+    input_key = frame_key(original_path, read_options.get("original"))
+    added_cols = []
+    lookups = session_lookups(files, read_options)
+    if cfg.get("merge_active") and lookups:
+        merge_key = fingerprint(input_key, "merge", [frame_key(path, options) for path, options in lookups],
+                                {k: cfg.get(k) for k in MERGE_CONFIG_KEYS})
+        hit = cache.get(merge_key) if cache is not None else None
+        if hit is None:
+            hit = merge_lookup_files(df, lookups, cfg, frame_cache)
+            if cache is not None:
+                cache.put(merge_key, hit)
+        df, added_cols, merge_log, merge_stats = hit
+        stats.update(merge_stats)
+        input_key = merge_key
+        report_log += merge_log
+
+    # 2. DETERMINE EXCLUSIONS
+    # If user does NOT want to clean merged columns, we add them to exclusion list
+    exclude_list = []
+    if not cfg.get("clean_merged_columns", True):
+        exclude_list = list(added_cols)
+
+    # 3. RUN CLEANER (clean_dataframe copies its input, cached frames stay untouched)
+    df_clean, clean_log = clean_dataframe(df, cfg, dry_run=dry_run, exclude_cols=exclude_list,
+                                          cache=cache, input_key=input_key, stats=stats, check=check)
+
+    return {
+        "raw": raw_df,
+        "clean": df_clean,
+        "log": report_log + clean_log,
+        "added_cols": added_cols,
+        "stats": stats,
+        "key": cleaning_step_keys(input_key, cfg, exclude_list)[-1],
+    }
+
+
+def cached_change_mask(result, cache=None):
+    """compute_change_mask memoized on the pipeline result key (shared by every diff view)."""
+    if cache is None:
+        return compute_change_mask(result["raw"], result["clean"])
+    key = fingerprint(result["key"], "change_mask")
+    change_mask = cache.get(key)
+    if change_mask is None:
+        change_mask = compute_change_mask(result["raw"], result["clean"])
+        cache.put(key, change_mask)
+    return change_mask
+
+
+def cached_diff(result, max_items, cache=None):
+    """compute_diff memoized on the pipeline result key."""
+    if cache is None:
+        return compute_diff(result["raw"], result["clean"], max_items=max_items)
+    key = fingerprint(result["key"], "diff", max_items)
+    diff = cache.get(key)
+    if diff is None:
+        diff = compute_diff(result["raw"], result["clean"], max_items=max_items,
+                            change_mask=cached_change_mask(result, cache))
+        cache.put(key, diff)
+    return diff
+
+
+def run_delta_pipeline(files, cfg, cache=None, dry_run=False, read_options=None, check=None):
+    """
+    run_pipeline for a recurring export: rows already in the baseline cfg["delta_baseline"]
+    reuse their stored cleaned rows, only new/changed rows are merged and cleaned, and dedupe runs
+    over stored + new key hashes. A clean (dry_run=False) stores this export as the new baseline.
+    Configs that need every row at once (delta_blocker) or a changed config/lookup/columns
+    re-clean everything and start a fresh baseline.
+    """
+    read_options = read_options or {}
+    original_path = files["original"]
+    frame_cache = FRAME_CACHE if cache is not None else None
+    path = baseline_path(cfg["delta_baseline"])
+
+    lookups = session_lookups(files, read_options) if cfg.get("merge_active") else []
+    lookup = None
+    if lookups:
+        lookup = [[lookup_identity(p, o) for p, o in lookups], {k: cfg.get(k) for k in MERGE_CONFIG_KEYS}]
+
+    result_key = fingerprint(frame_key(original_path, read_options.get("original")), "delta", lookup, cfg,
+                             baseline_version(path))
+    hit = cache.get(result_key) if cache is not None else None
+    if hit is None:
+        hit = _delta_result(files, cfg, read_options, frame_cache, path, lookups, lookup, check)
+        if cache is not None:
+            cache.put(result_key, hit)
+    result, baseline = hit
+    if not dry_run:
+        save_baseline(path, baseline)
+    return dict(result, key=result_key)
+
+
+def _delta_result(files, cfg, read_options, frame_cache, path, lookups, lookup, check=None):
+    """(run_pipeline-style result, baseline to store) for run_delta_pipeline."""
+    raw_df = load_frame(files["original"], frame_cache, read_options.get("original"))
+    identity = baseline_identity(cfg, raw_df, lookup)
+    reason = delta_blocker(cfg)
+    baseline = load_baseline(path)
+    if baseline is not None and not reason and baseline["meta"].get("identity") != identity:
+        reason = "config, columns or lookup changed"
+    if reason:
+        baseline = None
+
+    # 1. SPLIT: stored rows are reused, the rest is merged + cleaned
+    if check is not None: check()
+    match = match_rows(raw_df, baseline, cfg.get("delta_key"))
+    source = match["source"].copy()
+    arabic = []
+    if cfg.get("clean_arabic"):
+        stored_arabic = baseline["meta"]["arabic"] if baseline is not None else []
+        arabic = sorted(set(stored_arabic) | set(arabic_columns(raw_df[source < 0])))
+        if baseline is not None and arabic != stored_arabic:
+            baseline, reason = None, "Arabic text in new columns"
+            source[:] = -1
+    if baseline is not None:
+        # Leading rows are cleaned again so date/money sniffing samples what a full run would
+        source[:probe_rows(raw_df)] = -1
+
+    cleaned = _clean_delta(raw_df[source < 0], cfg, frame_cache, lookups, check,
+                           baseline["meta"] if baseline is not None else None)
+    if baseline is not None and any(cleaned["detected"].get(k) != baseline["meta"]["detected"].get(k)
+                                    for k in SNIFFED_STEPS):
+        # The stored rows were converted differently; start over with every row
+        baseline, reason = None, "date/money columns detected differently"
+        source[:] = -1
+        cleaned = _clean_delta(raw_df, cfg, frame_cache, lookups, check, None)
+
+    # 2. SPLICE + DEDUPE over stored and new key hashes
+    combined, clean_pos, dedupe = splice(raw_df.index, baseline, source, cleaned["df"], cleaned["dedupe_keys"])
+    df_clean = combined
+    report_log, stats = cleaned["log"], cleaned["stats"]
+    if dedupe is not None:
+        keep_mask, audit = find_duplicates(combined, keep=cfg.get("dedupe_keep", "first"),
+                                           hashes=dedupe["hashes"], ignore=dedupe["ignore"])
+        if audit["removed"]:
+            df_clean = combined[keep_mask]
+            # Where step 10 would have logged it, before the lines of later steps
+            pos = cleaned["dedupe_log_pos"]
+            report_log.insert(len(report_log) if pos is None else pos, f"✂️ Removed {audit['removed']} duplicates")
+        stats["duplicates"] = audit
+
+    reused = int((source >= 0).sum())
+    delta_stats = dict(match["stats"], reused=reused, cleaned=len(raw_df) - reused,
+                       baseline=cfg["delta_baseline"], fresh=baseline is None)
+    if reason:
+        delta_stats["fresh_reason"] = reason
+    stats["delta"] = delta_stats
+    report_log.insert(0, f"♻️ Delta: reused {reused} stored rows, cleaned {len(raw_df) - reused} rows"
+                      + (f" (full run: {reason})" if reason else ""))
+
+    new_baseline = {
+        "meta": {"identity": identity, "detected": cleaned["detected"], "arabic": arabic,
+                 "added_cols": cleaned["added_cols"], "key": cfg.get("delta_key") or [], "rows": len(raw_df)},
+        "hashes": match["hashes"],
+        "ids": match["ids"],
+        "clean_pos": clean_pos,
+        "clean": combined,
+        "dedupe": dedupe,
+    }
+    result = {
+        "raw": raw_df,
+        "clean": df_clean,
+        "log": report_log,
+        "added_cols": cleaned["added_cols"],
+        "stats": stats,
+    }
+    return result, new_baseline
+
+
+def _clean_delta(delta, cfg, frame_cache, lookups, check=None, stored_meta=None):
+    """Merge + clean of the rows a delta run can't reuse; exact dedupe is deferred (dedupe_keys)."""
+    log, stats = [], {}
+    added_cols = list(stored_meta["added_cols"]) if stored_meta is not None else []
+    # Arabic detection scans whole columns, so the stored rows' choice is kept
+    detected = {}
+    if stored_meta is not None and "clean_arabic" in stored_meta["detected"]:
+        detected["clean_arabic"] = stored_meta["detected"]["clean_arabic"]
+    if lookups and len(delta):
+        delta, added_cols, log, stats = merge_lookup_files(delta, lookups, cfg, frame_cache)
+    exclude_list = [] if cfg.get("clean_merged_columns", True) else list(added_cols)
+    dedupe_keys = {}
+    df_clean, clean_log = clean_dataframe(delta, cfg, exclude_cols=exclude_list, stats=stats, check=check,
+                                          detected=detected, dedupe_keys=dedupe_keys)
+    dedupe_log_pos = len(log) + dedupe_keys["log_pos"] if "log_pos" in dedupe_keys else None
+    return {"df": df_clean, "dedupe_keys": dedupe_keys, "log": log + clean_log, "stats": stats,
+            "added_cols": added_cols, "detected": detected, "dedupe_log_pos": dedupe_log_pos}
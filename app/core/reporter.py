@@ -1,93 +1,213 @@
 import pandas as pd
 import numpy as np
+import json
 import math
-from app.utils.json_utils import make_json_safe
+import os
+import shutil
+import uuid
+from app.core.cache import dir_lock, swap_dir
+from app.utils.json_utils import dumps, column_to_list, frame_to_records, to_native
 
-def compute_diff(original_df, cleaned_df, max_items=50):
+# Rows per page served by read_diff_page
+DIFF_PAGE_MAX = 500
+
+def _comparable(s):
+    """(blank mask, stripped text) for one column; blank = NaN/None/"" (same rules as the old row loop)."""
+    values = s.astype(object)
+    blank = values.isna().to_numpy() | (values.to_numpy() == "")
+    text = values.astype(str).str.strip().to_numpy(dtype=object)
+    return blank, text
+
+def compute_change_mask(original_df, cleaned_df):
+    """
+    Vectorized comparison of two dataframes, columns paired by position.
+    Returns a dict:
+      common:  index labels present in both (sorted)
+      removed: index labels only in original_df (sorted)
+      columns: compared column names (cleaned names)
+      mask:    bool array (len(common), len(columns)), True where a cell changed
+    """
+    common = cleaned_df.index.intersection(original_df.index).sort_values()
+    removed = original_df.index.difference(cleaned_df.index).sort_values()
+
+    df_orig_common = original_df.loc[common]
+    df_clean_common = cleaned_df.loc[common]
+    num_cols_to_compare = min(original_df.shape[1], cleaned_df.shape[1])
+
+    mask = np.zeros((len(common), num_cols_to_compare), dtype=bool)
+    for i in range(num_cols_to_compare):
+        a_blank, a_text = _comparable(df_orig_common.iloc[:, i])
+        b_blank, b_text = _comparable(df_clean_common.iloc[:, i])
+        # Changed: blank on one side only, or different text when both have a value
+        mask[:, i] = (a_blank != b_blank) | (~a_blank & ~b_blank & (a_text != b_text))
+
+    return {
+        "common": common.to_numpy(),
+        "removed": removed.to_numpy(),
+        "columns": [to_native(c) for c in cleaned_df.columns[:num_cols_to_compare]],
+        "mask": mask,
+    }
+
+def _change_records(original_df, cleaned_df, columns, labels, mask):
+    """[{"row_index", "changes": {col: {before, after}}}] for the rows `labels`; mask: their changed cells."""
+    records = [{"row_index": int(label) + 1, "changes": {}} for label in labels]
+    if not len(records):
+        return records
+
+    df_orig = original_df.loc[labels]
+    df_clean = cleaned_df.loc[labels]
+    for i, col_name in enumerate(columns):
+        rows = np.flatnonzero(mask[:, i])
+        if not len(rows):
+            continue
+        before = column_to_list(df_orig.iloc[rows, i])
+        after = column_to_list(df_clean.iloc[rows, i])
+        for r, val_a, val_b in zip(rows, before, after):
+            records[r]["changes"][col_name] = {"before": val_a, "after": val_b}
+    return records
+
+def _removed_records(original_df, labels):
+    records = frame_to_records(original_df.loc[labels])
+    return [{"row_index": int(rid) + 1, "data": row_data} for rid, row_data in zip(labels, records)]
+
+def compute_diff(original_df, cleaned_df, max_items=50, change_mask=None):
     """
     Compares two dataframes.
     Counts ALL differences, but only returns previews for the first 'max_items'.
+    change_mask: precomputed compute_change_mask result (skips the comparison).
     """
-    orig_idx = set(original_df.index)
-    clean_idx = set(cleaned_df.index)
-    
-    removed_ids = list(orig_idx - clean_idx)
-    common_idx = list(orig_idx.intersection(clean_idx))
-    common_idx.sort()
-    
-    # Capture Removed Rows Data (Preview Limit 20)
+    if change_mask is None:
+        change_mask = compute_change_mask(original_df, cleaned_df)
+    changed_pos = np.flatnonzero(change_mask["mask"].any(axis=1))
+    removed_ids = change_mask["removed"]
+
+    # Capture Removed Rows Data (Preview Limit 20), converted column-wise
     removed_preview = []
-    for rid in removed_ids[:20]:
-        try:
-            row_data = original_df.loc[rid].to_dict()
-            removed_preview.append({
-                "row_index": int(rid) + 1,
-                "data": row_data
-            })
-        except:
-            pass
-
-    # Optimization
-    df_orig_common = original_df.loc[common_idx]
-    df_clean_common = cleaned_df.loc[common_idx]
-    
-    cols_orig = list(original_df.columns)
-    cols_clean = list(cleaned_df.columns)
-    
-    num_cols_to_compare = min(len(cols_orig), len(cols_clean))
-    
-    changed_rows = []
-    count_diffs = 0
-    truncated = False
-    
-    # Iterate through ALL common rows to get accurate stats
-    for idx in common_idx:
-        row_orig = df_orig_common.loc[idx]
-        row_clean = df_clean_common.loc[idx]
-        
-        row_changes = {}
-        has_change = False
-        
-        # Compare columns by position
-        for i in range(num_cols_to_compare):
-            col_name = cols_clean[i] 
-            val_a = row_orig.iloc[i]
-            val_b = row_clean.iloc[i]
-            
-            try:
-                is_diff = False
-                a_is_nan = pd.isna(val_a) or val_a is None or val_a == ""
-                b_is_nan = pd.isna(val_b) or val_b is None or val_b == ""
-                
-                # Compare Logic
-                if a_is_nan and b_is_nan: continue
-                if a_is_nan != b_is_nan: is_diff = True
-                elif str(val_a).strip() != str(val_b).strip(): is_diff = True
-                        
-                if is_diff:
-                    row_changes[col_name] = {"before": val_a, "after": val_b}
-                    has_change = True
-            except: pass
-        
-        if has_change:
-            count_diffs += 1
-            # Only add to preview if under limit
-            if len(changed_rows) < max_items:
-                changed_rows.append({
-                    "row_index": int(idx) + 1,
-                    "changes": row_changes
-                })
-            else:
-                truncated = True
-
-    return make_json_safe({
+    try:
+        removed_preview = _removed_records(original_df, removed_ids[:20])
+    except:
+        pass
+
+    shown = changed_pos[:max_items]
+    changed_rows = _change_records(original_df, cleaned_df, change_mask["columns"],
+                                   change_mask["common"][shown], change_mask["mask"][shown])
+
+    # Values are already JSON-native; no recursive make_json_safe pass needed
+    return {
         "stats": {
             "total_original": len(original_df),
             "total_cleaned": len(cleaned_df),
             "removed_count": len(removed_ids),
-            "changed_count": count_diffs # This is now the TRUE count
+            "changed_count": len(changed_pos) # This is now the TRUE count
         },
         "changed_rows": changed_rows,
         "removed_preview": removed_preview,
-        "truncated": truncated
-    })
\ No newline at end of file
+        "truncated": len(changed_pos) > max_items
+    }
+
+def write_diff_index(path, original_df, cleaned_df, change_mask=None, source=None):
+    """
+    Persists what is needed to serve any page of the diff later, without recomputing the comparison:
+      meta.json      columns, counts per column, totals, `source` (where the original frame comes from)
+      mask.npy       changed rows x columns, bit-packed (little bit order)
+      changed.npy    index labels of the changed rows
+      removed.npy    index labels of the removed rows
+      clean.pkl      the cleaned frame
+    Records are only built for the pages read (read_diff_page). The new directory is written next to the
+    old one and swapped in under the diff lock (swap_dir), which read_diff_page also holds.
+    Returns the meta dict.
+    """
+    if change_mask is None:
+        change_mask = compute_change_mask(original_df, cleaned_df)
+    changed_pos = np.flatnonzero(change_mask["mask"].any(axis=1))
+    changed_mask = change_mask["mask"][changed_pos]
+
+    meta = {
+        "version": uuid.uuid4().hex,
+        "source": source,
+        "columns": change_mask["columns"],
+        "column_counts": dict(zip(change_mask["columns"], changed_mask.sum(axis=0).tolist())),
+        "changed_count": len(changed_pos),
+        "removed_count": len(change_mask["removed"]),
+        "total_original": len(original_df),
+        "total_cleaned": len(cleaned_df),
+    }
+
+    tmp_dir = f"{path}.tmp-{uuid.uuid4().hex[:8]}"
+    os.makedirs(tmp_dir)
+    try:
+        np.save(os.path.join(tmp_dir, "mask.npy"), np.packbits(changed_mask, axis=1, bitorder="little"))
+        np.save(os.path.join(tmp_dir, "changed.npy"), change_mask["common"][changed_pos], allow_pickle=True)
+        np.save(os.path.join(tmp_dir, "removed.npy"), change_mask["removed"], allow_pickle=True)
+        cleaned_df.to_pickle(os.path.join(tmp_dir, "clean.pkl"))
+        with open(os.path.join(tmp_dir, "meta.json"), "wb") as f:
+            f.write(dumps(meta))
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    swap_dir(tmp_dir, path)
+    return meta
+
+def read_diff_meta(path):
+    with open(os.path.join(path, "meta.json"), "rb") as f:
+        return json.loads(f.read())
+
+def read_diff_page(path, load_original, kind="changed", page=1, page_size=50, column=None, cache=None):
+    """
+    One page of a persisted diff (see write_diff_index); only that page's records are built.
+    Reads under the diff lock, so a concurrent write_diff_index never mixes two versions.
+    load_original(source): the frame the diff was computed from (meta["source"] tells where it was read from).
+    kind: "changed" or "removed". column: only modified rows where this column changed
+    (and only that column's change).
+    cache: optional StageCache for the stored cleaned frame (reused across pages).
+    """
+    with dir_lock(path):
+        return _read_diff_page(path, load_original, kind, page, page_size, column, cache)
+
+def _read_diff_page(path, load_original, kind, page, page_size, column, cache):
+    meta = read_diff_meta(path)
+
+    if kind == "removed":
+        positions = np.arange(meta["removed_count"])
+    elif column:
+        if column not in meta["columns"]:
+            raise ValueError(f"Unknown column: {column}")
+        i = meta["columns"].index(column)
+        bits = np.load(os.path.join(path, "mask.npy"), mmap_mode="r")[:, i // 8]
+        positions = np.flatnonzero((bits >> (i % 8)) & 1)
+    else:
+        positions = np.arange(meta["changed_count"])
+
+    page_size = max(1, min(int(page_size), DIFF_PAGE_MAX))
+    page = max(1, int(page))
+    selected = positions[(page - 1) * page_size: page * page_size]
+
+    if kind == "removed":
+        labels = np.load(os.path.join(path, "removed.npy"), allow_pickle=True)[selected]
+        items = _removed_records(load_original(meta["source"]), labels)
+    else:
+        labels = np.load(os.path.join(path, "changed.npy"), allow_pickle=True)[selected]
+        packed = np.load(os.path.join(path, "mask.npy"), mmap_mode="r")[selected]
+        mask = np.unpackbits(packed, axis=1, count=len(meta["columns"]), bitorder="little").astype(bool)
+        if column:
+            only = np.zeros(len(meta["columns"]), dtype=bool)
+            only[meta["columns"].index(column)] = True
+            mask &= only
+        key = f"diff-clean:{meta['version']}"
+        cleaned_df = cache.get(key) if cache is not None else None
+        if cleaned_df is None:
+            cleaned_df = pd.read_pickle(os.path.join(path, "clean.pkl"))
+            if cache is not None:
+                cache.put(key, cleaned_df)
+        items = _change_records(load_original(meta["source"]), cleaned_df, meta["columns"], labels, mask)
+
+    return {
+        "kind": "removed" if kind == "removed" else "changed",
+        "column": column if kind != "removed" else None,
+        "page": page,
+        "page_size": page_size,
+        "total": len(positions),
+        "pages": math.ceil(len(positions) / page_size),
+        "columns": meta["column_counts"],
+        "items": items,
+    }
@@ -0,0 +1,70 @@
+import numpy as np
+from rapidfuzz import process, fuzz
+from rapidfuzz.distance import JaroWinkler, Levenshtein
+
+# name -> (rapidfuzz scorer, multiplier to bring its result onto the 0-100 scale)
+SCORERS = {
+    "wratio": (fuzz.WRatio, 1.0),
+    "ratio": (fuzz.ratio, 1.0),
+    "token_sort": (fuzz.token_sort_ratio, 1.0),
+    "token_set": (fuzz.token_set_ratio, 1.0),
+    "partial": (fuzz.partial_ratio, 1.0),
+    "jaro_winkler": (JaroWinkler.normalized_similarity, 100.0),
+    "levenshtein": (Levenshtein.normalized_similarity, 100.0),
+}
+
+# Max cells scored per cdist batch (float64 scores: 16 MB) when scoring many queries at once
+_BATCH_CELLS = 2_000_000
+
+
+def _score_one(query, choices, scorer, scale, threshold):
+    res = process.extractOne(query, choices, scorer=scorer, score_cutoff=threshold / scale)
+    return (res[2], res[1] * scale) if res else None
+
+
+def best_matches(queries, choices, scorer_name="wratio", threshold=75.0, bulk_scoring=False):
+    """
+    Best choice for every query.
+    Returns a list aligned with queries of (choice_index, score) or None when below threshold.
+
+    With bulk_scoring, the queries are scored in bulk with the chosen scorer (rapidfuzz cdist across all
+    cores, with score_cutoff so pairs that can't reach the threshold exit early) instead of one
+    extractOne call per query. Same results (first best choice wins ties), much faster on many queries.
+    """
+    scorer, scale = SCORERS.get(scorer_name, SCORERS["wratio"])
+    if not queries or not choices:
+        return [None] * len(queries)
+    if not bulk_scoring or len(queries) == 1:
+        return [_score_one(q, choices, scorer, scale, threshold) for q in queries]
+
+    results = []
+    cutoff = threshold / scale
+    batch = max(1, _BATCH_CELLS // len(choices))
+    for start in range(0, len(queries), batch):
+        chunk = queries[start:start + batch]
+        scores = process.cdist(chunk, choices, scorer=scorer, score_cutoff=cutoff, dtype=np.float64, workers=-1)
+        best = scores.argmax(axis=1)
+        top = scores[np.arange(len(chunk)), best]
+        results.extend((int(i), float(sc) * scale) if sc >= cutoff else None for i, sc in zip(best, top))
+    return results
+
+
+def score_distribution(scores, exact=0, unmatched=0, bucket=10):
+    """Summary of match scores for tuning thresholds: counts, percentiles and a histogram."""
+    scores = np.asarray(scores, dtype=float)
+    summary = {
+        "exact": int(exact),
+        "fuzzy": int(len(scores)),
+        "unmatched": int(unmatched),
+        "histogram": {},
+    }
+    if len(scores):
+        summary.update({
+            "min": round(float(scores.min()), 1),
+            "median": round(float(np.median(scores)), 1),
+            "mean": round(float(scores.mean()), 1),
+        })
+        edges = np.minimum((scores // bucket) * bucket, 100 - bucket).astype(int)
+        for edge, count in zip(*np.unique(edges, return_counts=True)):
+            summary["histogram"][f"{edge}-{edge + bucket}"] = int(count)
+    return summary
@@ -1,25 +1,35 @@
+import asyncio
 import os
 import threading
 import time
 import shutil
 import traceback
 import uuid
+from contextlib import asynccontextmanager
+from typing import Optional
 import pandas as pd
-from fastapi import FastAPI, File, UploadFile, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request
 from fastapi.responses import FileResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 import signal
+import socket
 # App specific imports
 from app.config import settings
-from app.utils.file_handler import read_file_as_df
-from app.core.cleaner import clean_dataframe
-from app.core.reporter import compute_diff
-from app.schemas import CleaningConfig
-from app.utils.json_utils import make_json_safe
-from app.core.merger import fuzzy_merge_datasets
+from app.core.blobs import store_upload, remove_blob
+from app.core.cache import StageCache, fingerprint, dir_lock
+from app.core.pipeline import (run_pipeline, cached_diff, cached_change_mask, load_profile, load_frame, frame_key,
+                               estimate_pipeline_bytes, lookup_role, session_lookups, PipelineCancelled,
+                               FRAME_CACHE)
+from app.core.reporter import write_diff_index, read_diff_page
+from app.scheduler import scheduler, Overloaded
+from app.schemas import CleaningConfig, SheetSelection
+from app.sessions import get_session_backend
+from app.utils.file_handler import write_df
+from app.utils.json_utils import FastJSONResponse, frame_to_records
 
-app = FastAPI(title=settings.APP_NAME, version=settings.VERSION)
+app = FastAPI(title=settings.APP_NAME, version=settings.VERSION, default_response_class=FastJSONResponse)
 
 # CORS (Localhost access)
 app.add_middleware(
@@ -30,27 +40,50 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Global Session Store (In-Memory)
-SESSIONS = {}
+# Session Store: pluggable backend shared by all worker processes (see app/sessions.py)
+sessions = get_session_backend()
+
+# Identity of this worker process, used for the cleanup lease
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# Memoized stage outputs are process-local and shared by all sessions under one budget;
+# keys are derived from file content and config, so sessions with the same inputs share entries
+STAGE_CACHE = StageCache(settings.STAGE_CACHE_BUDGET)
+
+def get_session(session_id):
+    session_data = sessions.get(session_id)
+    if session_data is None:
+        raise HTTPException(404, "Session not found")
+    return session_data
+
+def release_unused_blobs(session_id, paths, session_data):
+    """Releases the session's references to these uploaded files unless one of its roles still uses them."""
+    in_use = set(session_data["files"].values()) if session_data else set()
+    unused = [os.path.basename(p) for p in paths if p and p not in in_use]
+    if unused:
+        sessions.release_blobs(session_id, remove_blob, blobs=unused)
 
 def cleanup_sessions():
     """Background task to remove expired sessions and files."""
     while True:
         try:
-            now = time.time()
-            expired_ids = []
-            for sid, data in SESSIONS.items():
-                if now - data['created_at'] > settings.SESSION_TIMEOUT:
-                    expired_ids.append(sid)
+            # Only the lease holder expires sessions; other workers just skip this part
+            if sessions.acquire_lease("cleanup", WORKER_ID, ttl=settings.CLEANUP_INTERVAL * 3):
+                for sid in sessions.expired(settings.SESSION_TIMEOUT):
+                    session_dir = os.path.join(settings.TEMP_DIR, sid)
+                    if os.path.exists(session_dir):
+                        shutil.rmtree(session_dir, ignore_errors=True)
+                    # Uploaded blobs are shared; only the last session referencing one deletes it
+                    sessions.release_blobs(sid, remove_blob)
+                    sessions.delete(sid)
             
-            for sid in expired_ids:
-                session_dir = os.path.join(settings.TEMP_DIR, sid)
-                if os.path.exists(session_dir):
-                    shutil.rmtree(session_dir, ignore_errors=True)
-                del SESSIONS[sid]
+            # Every worker drops its local state of sessions that are gone
+            for sid in scheduler.session_ids():
+                if sid not in sessions:
+                    scheduler.forget(sid)
         except Exception as e:
             print(f"Cleanup error: {e}")
-        time.sleep(60)
+        time.sleep(settings.CLEANUP_INTERVAL)
 
 # Start cleanup thread
 cleanup_thread = threading.Thread(target=cleanup_sessions, daemon=True)
@@ -58,165 +91,212 @@ cleanup_thread.start()
 
 
 @app.post("/api/upload")
-async def upload_file(file: UploadFile = File(...)):
-    if file.size and file.size > settings.MAX_UPLOAD_SIZE:
-        raise HTTPException(400, "File too large")
-    
-    ext = os.path.splitext(file.filename)[1].lower()
-    if ext not in settings.ALLOWED_EXTENSIONS:
-        raise HTTPException(400, "Unsupported file type")
-
+async def upload_file(request: Request):
+    """Multipart upload (field "file"), streamed from the request body into the blob store."""
     session_id = str(uuid.uuid4())
     session_dir = os.path.join(settings.TEMP_DIR, session_id)
     os.makedirs(session_dir, exist_ok=True)
     
-    file_path = os.path.join(session_dir, f"original{ext}")
-    
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    # Stream into the content-addressed store (identical uploads share one file)
+    try:
+        file_path, filename = await store_upload(request, claim=lambda blob: sessions.add_blob_ref(session_id, blob),
+                                                 max_bytes=settings.MAX_UPLOAD_SIZE)
+    except ValueError as e:
+        shutil.rmtree(session_dir)
+        raise HTTPException(400, str(e))
     
-    # Initial Analysis
+    # Initial Analysis (cached per blob; also seeds the shared frame cache)
     try:
-        df = read_file_as_df(file_path)
+        analysis = await run_in_threadpool(load_profile, file_path)
     except Exception as e:
         shutil.rmtree(session_dir)
+        sessions.release_blobs(session_id, remove_blob)
         raise HTTPException(400, f"Failed to read file: {str(e)}")
 
     # Store in session
-    SESSIONS[session_id] = {
+    sessions.create(session_id, {
         "created_at": time.time(),
         "files": {"original": file_path},
-        "original_filename": file.filename
-    }
-    
-    analysis = {
-        "rows": len(df),
-        "columns": list(df.columns),
-        "missing_values": df.isnull().sum().to_dict(),
-        "dtypes": df.dtypes.apply(lambda x: str(x)).to_dict(),
-        "preview": df.head(5).to_dict(orient="records")
-    }
+        "original_filename": filename
+    })
     
-    return make_json_safe({
+    return FastJSONResponse({
         "session_id": session_id, 
         "analysis": analysis
     })
 
 
 @app.post("/api/upload-secondary/{session_id}")
-async def upload_secondary(session_id: str, file: UploadFile = File(...)):
-    if session_id not in SESSIONS:
-        raise HTTPException(404, "Session not found")
-        
-    session_dir = os.path.join(settings.TEMP_DIR, session_id)
-    ext = os.path.splitext(file.filename)[1].lower()
-    file_path = os.path.join(session_dir, f"secondary{ext}")
+async def upload_secondary(session_id: str, request: Request, lookup: Optional[int] = None, append: bool = False):
+    """
+    Uploads a lookup file. lookup: slot to replace (default: the first one).
+    append: add it after the session's other lookup files instead; the response reports its slot.
+    """
+    session_data = get_session(session_id)
+    index = lookup or 0
+    if not append and not 0 <= index <= len(session_lookups(session_data["files"])):
+        raise HTTPException(400, "Invalid lookup number")
     
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    try:
+        file_path, _ = await store_upload(request, claim=lambda blob: sessions.add_blob_ref(session_id, blob),
+                                          max_bytes=settings.MAX_UPLOAD_SIZE)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
         
     # Analyze quickly
     try:
-        df = read_file_as_df(file_path)
+        analysis = await run_in_threadpool(load_profile, file_path)
     except Exception as e:
+        release_unused_blobs(session_id, [file_path], sessions.get(session_id))
         raise HTTPException(400, "Invalid Secondary File")
-        
-    SESSIONS[session_id]["files"]["secondary"] = file_path
     
-    return make_json_safe({
-        "columns": list(df.columns),
-        "rows": len(df)
+    slot = {"index": index, "replaced": None}
+    def attach(data):
+        # Appends pick their slot under the session lock, so concurrent uploads never share one
+        if append:
+            slot["index"] = len(session_lookups(data["files"]))
+        role = lookup_role(slot["index"])
+        slot["replaced"] = data["files"].get(role)
+        data["files"][role] = file_path
+        # A new lookup file starts from its first sheet again
+        data.setdefault("read_options", {}).pop(role, None)
+    updated = sessions.update(session_id, attach)
+    release_unused_blobs(session_id, [slot["replaced"]], updated)
+    
+    return FastJSONResponse({
+        "lookup": slot["index"],
+        "columns": analysis["columns"],
+        "rows": analysis["rows"],
+        "sheets": analysis["sheets"]
     })
 
 
-@app.post("/api/preview/{session_id}")
-async def preview_cleaning(session_id: str, config: CleaningConfig):
-    if session_id not in SESSIONS:
+@app.delete("/api/lookup/{session_id}/{index}")
+async def remove_lookup(session_id: str, index: int):
+    """Removes a lookup file; the ones uploaded after it move up one slot."""
+    slot = {"count": 0, "removed": None}
+    def detach(data):
+        # Counted and validated under the session lock, so a concurrent upload or removal can't shift the slots
+        files, read_options = data["files"], data.setdefault("read_options", {})
+        count = slot["count"] = len(session_lookups(files))
+        if not 0 <= index < count:
+            return
+        slot["removed"] = files.get(lookup_role(index))
+        for i in range(index, count - 1):
+            files[lookup_role(i)] = files[lookup_role(i + 1)]
+            if lookup_role(i + 1) in read_options:
+                read_options[lookup_role(i)] = read_options[lookup_role(i + 1)]
+            else:
+                read_options.pop(lookup_role(i), None)
+        files.pop(lookup_role(count - 1), None)
+        read_options.pop(lookup_role(count - 1), None)
+    updated = sessions.update(session_id, detach)
+    if updated is None:
         raise HTTPException(404, "Session not found")
+    if slot["removed"] is None:
+        raise HTTPException(404, "Lookup file not found")
+    release_unused_blobs(session_id, [slot["removed"]], updated)
     
-    session_data = SESSIONS[session_id]
-    original_path = session_data["files"]["original"]
+    return {"lookups": slot["count"] - 1}
+
+
+@app.post("/api/sheet/{session_id}")
+async def select_sheet(session_id: str, selection: SheetSelection):
+    """Re-reads an uploaded Excel file with another sheet and/or header row."""
+    session_data = get_session(session_id)
+    role = "original" if selection.target == "original" else lookup_role(selection.lookup)
+    file_path = session_data["files"].get(role)
+    if file_path is None:
+        raise HTTPException(404, "File not uploaded yet")
+    if selection.header_row < 0:
+        raise HTTPException(400, "Invalid header row")
     
+    options = {"sheet": selection.sheet, "header_row": selection.header_row} \
+        if selection.sheet or selection.header_row else None
     try:
-        df_orig = read_file_as_df(original_path)
-        report_log = [] # Collects actions for the UI
-        
-        # 1. APPLY MERGE IF ACTIVE
-        added_cols = []
-        if config.merge_active and "secondary" in session_data["files"]:
-            sec_path = session_data["files"]["secondary"]
-            df_sec = read_file_as_df(sec_path)
-            
-            # Unpack 3 values (df, count, columns_added)
-            df_orig, merged_count, added_cols = fuzzy_merge_datasets(
-                df_orig, df_sec, 
-                config.merge_key_main, config.merge_key_sec, config.merge_fuzzy
-            )
-            if merged_count > 0:
-                report_log.append(f"🔗 Merged/Enriched {merged_count} rows from Lookup File")
-            else:
-                report_log.append("⚠️ Merge active but 0 rows matched (check your keys?)")
+        analysis = await run_in_threadpool(load_profile, file_path, options)
+    except Exception as e:
+        raise HTTPException(400, f"Failed to read sheet: {str(e)}")
+    
+    def choose(data):
+        read_options = data.setdefault("read_options", {})
+        if options:
+            read_options[role] = options
+        else:
+            read_options.pop(role, None)
+    sessions.update(session_id, choose)
+    
+    return FastJSONResponse({"analysis": analysis})
 
-        # 2. DETERMINE EXCLUSIONS
-        # If user does NOT want to clean merged columns, we add them to exclusion list
-        exclude_list = []
-        if not config.clean_merged_columns:
-            exclude_list = added_cols
 
-        # 3. RUN CLEANER
-        df_clean, clean_log = clean_dataframe(df_orig, config.model_dump(), dry_run=True, exclude_cols=exclude_list)
-        
-        # Combine logs
-        full_log = report_log + clean_log
+@asynccontextmanager
+async def clean_lock(session_id):
+    """Per-session lock shared by worker processes, awaited without tying up a pipeline thread."""
+    path = os.path.join(settings.TEMP_DIR, session_id, "clean")
+    while True:
+        lock = dir_lock(path, timeout=0, stale=settings.SESSION_TIMEOUT)
+        try:
+            lock.__enter__()
+            break
+        except TimeoutError:
+            await asyncio.sleep(0.05)
+    try:
+        yield
+    finally:
+        lock.__exit__(None, None, None)
+
+def work_key(kind, session_id, session_data, config):
+    """Coalescing identity: same session, inputs and config -> same result."""
+    return (kind, session_id, fingerprint(session_data["files"], session_data.get("read_options"), config.model_dump()))
 
-        # 4. COMPUTE DIFF
-        # Reload raw for accurate Diff (Raw vs Cleaned)
-        raw_df = read_file_as_df(original_path) 
-        diff = compute_diff(raw_df, df_clean, max_items=20)
+async def schedule(kind, session_id, session_data, config, fn, supersede=False):
+    """Runs fn(check) through the work scheduler; maps its errors to HTTP responses."""
+    try:
+        estimate = await run_in_threadpool(estimate_pipeline_bytes, session_data["files"], session_data.get("read_options"))
+        return await scheduler.submit(work_key(kind, session_id, session_data, config), session_id, estimate, fn,
+                                      supersede=supersede)
+    except PipelineCancelled:
+        raise HTTPException(409, "Superseded by a newer preview")
+    except Overloaded as e:
+        raise HTTPException(503, str(e))
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(500, f"{'Processing error' if kind == 'preview' else 'Cleaning failed'}: {str(e)}")
+
+
+@app.post("/api/preview/{session_id}")
+async def preview_cleaning(session_id: str, config: CleaningConfig):
+    session_data = get_session(session_id)
+    
+    def work(check):
+        result = run_pipeline(session_data["files"], config, cache=STAGE_CACHE, dry_run=True,
+                              read_options=session_data.get("read_options"), check=check)
+        df_clean = result["clean"]
+        full_log = result["log"]
+
+        # 4. COMPUTE DIFF (Raw vs Cleaned)
+        diff = cached_diff(result, max_items=20, cache=STAGE_CACHE)
         
         return {
             "diff_summary": diff,
             "report_log": full_log, # Send log to frontend
-            "preview_clean": make_json_safe(df_clean.head(5).to_dict(orient="records"))
+            "match_stats": result["stats"],
+            "preview_clean": frame_to_records(df_clean.head(5))
         }
-    except Exception as e:
-        traceback.print_exc()
-        raise HTTPException(500, f"Processing error: {str(e)}")
+
+    # A newer preview of the same session cancels this one at its next stage boundary
+    return FastJSONResponse(await schedule("preview", session_id, session_data, config, work, supersede=True))
 
 
 @app.post("/api/clean/{session_id}")
 async def apply_cleaning(session_id: str, config: CleaningConfig):
-    if session_id not in SESSIONS:
-        raise HTTPException(404, "Session not found")
-        
-    session_data = SESSIONS[session_id]
-    original_path = session_data["files"]["original"]
+    session_data = get_session(session_id)
     
-    try:
-        df_orig = read_file_as_df(original_path)
-        report_log = []
-        
-        # 1. APPLY MERGE
-        added_cols = []
-        if config.merge_active and "secondary" in session_data["files"]:
-            sec_path = session_data["files"]["secondary"]
-            df_sec = read_file_as_df(sec_path)
-            
-            df_orig, merged_count, added_cols = fuzzy_merge_datasets(
-                df_orig, df_sec, 
-                config.merge_key_main, config.merge_key_sec, config.merge_fuzzy
-            )
-            report_log.append(f"🔗 Merged/Enriched {merged_count} rows from Lookup File")
-
-        # 2. DETERMINE EXCLUSIONS
-        exclude_list = []
-        if not config.clean_merged_columns:
-            exclude_list = added_cols
-            
-        # 3. RUN CLEANER
-        df_clean, clean_log = clean_dataframe(df_orig, config.model_dump(), exclude_cols=exclude_list)
-        
-        report_log.extend(clean_log)
+    def work(check):
+        result = run_pipeline(session_data["files"], config, cache=STAGE_CACHE,
+                              read_options=session_data.get("read_options"), check=check)
+        df_clean = result["clean"]
+        report_log = result["log"]
         
         # 4. SAVE RESULT
         orig_filename = session_data["original_filename"]
@@ -224,36 +304,66 @@ async def apply_cleaning(session_id: str, config: CleaningConfig):
         cleaned_filename = f"{base}_cleaned{ext}"
         cleaned_path = os.path.join(settings.TEMP_DIR, session_id, cleaned_filename)
         
-        if ext == ".csv":
-            df_clean.to_csv(cleaned_path, index=False, encoding='utf-8-sig', na_rep='')
-        else:
-            df_clean.to_excel(cleaned_path, index=False)
+        # Swapped in whole, so a download never serves a half-written file
+        write_df(df_clean, cleaned_path)
             
-        session_data["files"]["cleaned"] = cleaned_path
+        sessions.update(session_id, lambda d: d["files"].update(cleaned=cleaned_path))
         
-        # 5. GENERATE DIFF
-        raw_df = read_file_as_df(original_path)
-        diff = compute_diff(raw_df, df_clean, max_items=100)
+        # 5. GENERATE DIFF (+ persist the full diff for paginated browsing)
+        diff = cached_diff(result, max_items=100, cache=STAGE_CACHE)
+        source = {"path": session_data["files"]["original"],
+                  "options": (session_data.get("read_options") or {}).get("original")}
+        write_diff_index(os.path.join(settings.TEMP_DIR, session_id, "diff"), result["raw"], df_clean,
+                         cached_change_mask(result, STAGE_CACHE), source=source)
         
         return {
             "status": "success",
             "cleaned_rows": len(df_clean),
             "report_log": report_log,
             "diff_summary": diff,
-            "download_url": f"/api/download/{session_id}/cleaned"
+            "match_stats": result["stats"],
+            "download_url": f"/api/download/{session_id}/cleaned",
+            "diff_url": f"/api/diff/{session_id}"
         }
-        
-    except Exception as e:
-        traceback.print_exc()
-        raise HTTPException(500, f"Cleaning failed: {str(e)}")
+
+    # One clean per session at a time: runs write the same output file and diff index.
+    # A repeated identical clean (double click, retry) then finds every stage in the stage cache.
+    async with clean_lock(session_id):
+        return FastJSONResponse(await schedule("clean", session_id, session_data, config, work))
+
+
+@app.get("/api/diff/{session_id}")
+async def browse_diff(session_id: str, kind: str = "changed", page: int = 1, page_size: int = 50, column: Optional[str] = None):
+    """Any page of the last cleaning run's modified / removed rows (optionally one column only)."""
+    get_session(session_id)
+    diff_dir = os.path.join(settings.TEMP_DIR, session_id, "diff")
+    if not os.path.exists(os.path.join(diff_dir, "meta.json")):
+        raise HTTPException(404, "Run cleaning first")
+    if kind not in ("changed", "removed"):
+        raise HTTPException(400, "Invalid diff kind")
+    
+    def load_original(source):
+        # Read-only use, so the shared parsed frame is used as is (load_frame would copy it)
+        original_df = FRAME_CACHE.get(frame_key(source["path"], source["options"]))
+        if original_df is None:
+            original_df = load_frame(source["path"], FRAME_CACHE, source["options"])
+        return original_df
+
+    # Records are built for this page only, from the original upload + the stored cleaned frame
+    try:
+        return FastJSONResponse(await run_in_threadpool(read_diff_page, diff_dir, load_original, kind, page,
+                                                        page_size, column, STAGE_CACHE))
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    except FileNotFoundError:
+        raise HTTPException(404, "Run cleaning first")
+    except TimeoutError:
+        raise HTTPException(503, "Diff is being rewritten, try again shortly")
 
 
 @app.get("/api/download/{session_id}/{file_type}")
 async def download_file(session_id: str, file_type: str):
-    if session_id not in SESSIONS:
-        raise HTTPException(404, "Session not found")
-        
-    files = SESSIONS[session_id]["files"]
+    files = get_session(session_id)["files"]
     
     if file_type == "cleaned":
         if "cleaned" not in files:
@@ -268,7 +378,7 @@ async def download_file(session_id: str, file_type: str):
 @app.get("/api/health")
 async def health_check():
     """Used by the launcher to see if the app is already running."""
-    return {"status": "ok", "app": "DataForg"}
+    return {"status": "ok", "app": settings.HEALTH_APP_ID}
 
 @app.post("/api/shutdown")
 async def shutdown():
@@ -276,7 +386,8 @@ async def shutdown():
     # Run in a thread to allow the response to return first
     def kill():
         time.sleep(1)
-        os.kill(os.getpid(), signal.SIGTERM)
+        # With several workers, stop the supervisor so every worker exits
+        os.kill(os.getppid() if settings.WORKERS > 1 else os.getpid(), signal.SIGTERM)
     
     threading.Thread(target=kill).start()
     return {"message": "Shutting down..."}
@@ -0,0 +1,129 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from app.config import settings
+from app.core.pipeline import PipelineCancelled
+
+
+class Overloaded(Exception):
+    """Work can't be admitted within the memory budget (mapped to HTTP 503)."""
+
+
+class WorkScheduler:
+    """
+    Runs expensive pipeline work (preview / clean) off the event loop with:
+      * coalescing: identical in-flight requests (same key) share one computation and its result
+      * superseding: a newer preview for a session cancels older ones at the next stage boundary
+      * admission control: work only starts while the sum of running estimates fits the memory budget;
+        otherwise it queues for up to `timeout` seconds, then fails with Overloaded.
+        A job estimated above the whole budget is not refused: it waits until it can run alone
+
+    Uses thread-safe futures and polling instead of loop-bound asyncio primitives,
+    so callers on different event loops (e.g. test clients) can share one scheduler.
+    """
+
+    def __init__(self, memory_budget, timeout, threads):
+        self.memory_budget = memory_budget
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="pipeline")
+        self._lock = threading.Lock()
+        self._inflight = {}  # key -> Future
+        self._generations = {}  # session id -> latest superseding generation
+        self._reserved = 0
+        self.stats = {"started": 0, "coalesced": 0, "superseded": 0, "rejected": 0}
+
+    def _checker(self, session_id, generation):
+        def check():
+            if generation is not None and self._generations.get(session_id) != generation:
+                raise PipelineCancelled("Superseded by a newer request")
+        return check
+
+    async def _admit(self, estimate, check):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            check()
+            with self._lock:
+                if self._reserved + estimate <= self.memory_budget:
+                    self._reserved += estimate
+                    return
+            if time.monotonic() > deadline:
+                raise Overloaded("Server busy, try again shortly")
+            await asyncio.sleep(0.05)
+
+    def _run(self, key, future, fn, check, estimate):
+        try:
+            result, error = fn(check), None
+        except BaseException as e:
+            result, error = None, e
+        # Release before resolving: waiters woken by the result must see the budget and key freed
+        with self._lock:
+            self._reserved -= estimate
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+    async def submit(self, key, session_id, estimate, fn, supersede=False):
+        """
+        Runs fn(check) in the worker pool and returns its result.
+        key: identity for coalescing, e.g. ("preview", session_id, config fingerprint).
+        supersede: cancel this session's older superseding requests (fn must call check() between stages).
+        Raises PipelineCancelled when superseded, Overloaded when not admitted.
+        """
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+                generation = None
+                if supersede:
+                    generation = self._generations[session_id] = self._generations.get(session_id, 0) + 1
+                    # Older requests of this session are being cancelled; nobody may join them anymore
+                    for other in [k for k in self._inflight if k != key and k[:2] == key[:2]]:
+                        del self._inflight[other]
+            else:
+                self.stats["coalesced"] += 1
+
+        if leader:
+            check = self._checker(session_id, generation)
+            # Estimates are rough; an oversized job just takes the whole budget
+            estimate = min(estimate, self.memory_budget)
+            try:
+                await self._admit(estimate, check)
+            except BaseException as e:
+                with self._lock:
+                    if self._inflight.get(key) is future:
+                        del self._inflight[key]
+                    if isinstance(e, Overloaded):
+                        self.stats["rejected"] += 1
+                    elif isinstance(e, PipelineCancelled):
+                        self.stats["superseded"] += 1
+                future.set_exception(e)
+                raise
+            self.stats["started"] += 1
+            self._executor.submit(self._run, key, future, fn, check, estimate)
+
+        try:
+            # Shielded: a disconnecting client must not cancel work other requests are waiting for
+            return await asyncio.shield(asyncio.wrap_future(future))
+        except PipelineCancelled:
+            if leader:
+                self.stats["superseded"] += 1
+            raise
+
+    def session_ids(self):
+        """Sessions this scheduler holds state for."""
+        with self._lock:
+            return list(self._generations)
+
+    def forget(self, session_id):
+        """Drops per-session state once the session is gone."""
+        with self._lock:
+            self._generations.pop(session_id, None)
+
+
+scheduler = WorkScheduler(settings.WORK_MEMORY_BUDGET, settings.ADMISSION_TIMEOUT, settings.WORK_THREADS)
@@ -1,5 +1,24 @@
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Literal
+
+# See app.core.scoring.SCORERS
+ScorerName = Literal["wratio", "ratio", "token_sort", "token_set", "partial", "jaro_winkler", "levenshtein"]
+
+class LookupConfig(BaseModel):
+    """One lookup file of a multi-lookup merge and how its keys map to the main file."""
+    # Session lookup number, in upload order (0 = the first / legacy lookup file)
+    file: int = 0
+    key_main: str = ""
+    key_sec: str = ""
+    # Composite keys, paired by position (override key_main/key_sec when set)
+    keys_main: List[str] = []
+    keys_sec: List[str] = []
+    fuzzy: bool = False
+    block_on: str = ""
+    scorer: ScorerName = "wratio"
+    threshold: float = 75.0
+    # Appended to lookup columns that clash with existing ones (default "_lookup", "_lookup2", ...)
+    suffix: str = ""
 
 class CleaningConfig(BaseModel):
     standardize_columns: bool = False
@@ -9,11 +28,38 @@ class CleaningConfig(BaseModel):
     remove_duplicates: bool = False
     dedupe_column: str = "ALL"
     fuzzy_dedupe: bool = False
+    # Exact column dedupe on normalized keys (case/punctuation-insensitive)
+    dedupe_normalize: bool = False
+    # Multi-column dedupe key (overrides dedupe_column when set)
+    dedupe_columns: List[str] = []
+    # Which row of a duplicate group survives
+    dedupe_keep: Literal["first", "last", "most_complete"] = "first"
+    # Exact dedupe ignoring case and extra whitespace
+    dedupe_ignore_case: bool = False
     
     merge_active: bool = False
     merge_key_main: str = ""
     merge_key_sec: str = ""
     merge_fuzzy: bool = False
+    # Composite keys (e.g. name + city), paired by position. Override merge_key_main/merge_key_sec when set.
+    merge_keys_main: List[str] = []
+    merge_keys_sec: List[str] = []
+    # Optional main key component that must match exactly before fuzzy scoring the rest
+    merge_block_on: str = ""
+    # Several lookup files in one pass; when empty, the merge_* fields above describe lookup 0
+    lookups: List[LookupConfig] = []
+    
+    # Fuzzy scoring (merge + fuzzy dedupe). Thresholds are on a 0-100 scale for every scorer.
+    merge_scorer: ScorerName = "wratio"
+    merge_threshold: float = 75.0
+    dedupe_scorer: ScorerName = "wratio"
+    dedupe_threshold: float = 90.0
+    # Merge: score all leftover keys in one parallel cdist pass with score_cutoff (same matches, faster).
+    fuzzy_bulk_scoring: bool = True
+    
+    # Extra key normalization for merge + dedupe keys
+    normalize_keys_arabic: bool = False
+    normalize_keys_unicode: bool = False
     clean_merged_columns: bool = True
     
     clean_money: bool = False
@@ -26,4 +72,18 @@ class CleaningConfig(BaseModel):
     # NEW: List of columns to skip entirely
     ignore_columns: List[str] = [] 
     
-    fill_missing: Dict[str, str] = {}
\ No newline at end of file
+    fill_missing: Dict[str, str] = {}
+
+    # Recurring exports: reuse the cleaned rows stored under this baseline name, clean only new/changed rows
+    delta_baseline: str = ""
+    # Row identity for the delta report (new vs changed vs removed); empty = entire row
+    delta_key: List[str] = []
+
+class SheetSelection(BaseModel):
+    """Which sheet / header row to read from an uploaded Excel file."""
+    target: Literal["original", "secondary"] = "original"
+    # Which lookup file (upload order) when target is "secondary"
+    lookup: int = 0
+    sheet: Optional[str] = None
+    # 0-based row holding the column names (rows above it are skipped)
+    header_row: int = 0
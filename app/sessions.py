@@ -0,0 +1,191 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing, contextmanager
+
+from app.config import settings
+
+
+class MemorySessionBackend:
+    """
+    Sessions in a process-local dict (single worker only).
+    Session data is a JSON-able dict: {"created_at", "files", "original_filename", ...}
+    """
+
+    def __init__(self):
+        self._sessions = {}
+        self._blob_refs = {}  # blob name -> set of session ids
+        self._lock = threading.Lock()
+
+    def create(self, session_id, data):
+        with self._lock:
+            self._sessions[session_id] = json.loads(json.dumps(data))
+
+    def get(self, session_id):
+        with self._lock:
+            data = self._sessions.get(session_id)
+            return json.loads(json.dumps(data)) if data is not None else None
+
+    def update(self, session_id, fn):
+        """Applies fn(data) atomically. Returns the new data, or None if the session is gone."""
+        with self._lock:
+            data = self._sessions.get(session_id)
+            if data is None:
+                return None
+            fn(data)
+            return json.loads(json.dumps(data))
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def expired(self, timeout):
+        now = time.time()
+        with self._lock:
+            return [sid for sid, d in self._sessions.items() if now - d["created_at"] > timeout]
+
+    def add_blob_ref(self, session_id, blob):
+        with self._lock:
+            self._blob_refs.setdefault(blob, set()).add(session_id)
+
+    def release_blobs(self, session_id, on_orphan, blobs=None):
+        """
+        Drops the session's blob references (only those in `blobs` when given);
+        on_orphan(blob) runs for blobs nobody references anymore.
+        """
+        with self._lock:
+            for blob in list(self._blob_refs if blobs is None else blobs):
+                refs = self._blob_refs.get(blob, set())
+                if session_id in refs:
+                    refs.discard(session_id)
+                    if not refs:
+                        del self._blob_refs[blob]
+                        on_orphan(blob)
+
+    def acquire_lease(self, name, owner, ttl):
+        # Only one process can see this backend
+        return True
+
+    def __contains__(self, session_id):
+        with self._lock:
+            return session_id in self._sessions
+
+
+class SQLiteSessionBackend:
+    """
+    Sessions in a local SQLite file shared by every worker process on the machine,
+    so any worker can serve any session. Cleanup is coordinated through a lease row:
+    only the current holder expires sessions.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with closing(sqlite3.connect(self.path, timeout=30)) as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    id TEXT PRIMARY KEY,
+                    created_at REAL NOT NULL,
+                    data TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS blob_refs (
+                    blob TEXT NOT NULL,
+                    session_id TEXT NOT NULL,
+                    PRIMARY KEY (blob, session_id)
+                );
+                CREATE INDEX IF NOT EXISTS blob_refs_session ON blob_refs (session_id);
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                );
+            """)
+
+    @contextmanager
+    def _connect(self, immediate=False):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            # BEGIN IMMEDIATE takes the write lock up front (read-modify-write without races)
+            conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+
+    def create(self, session_id, data):
+        with self._connect(immediate=True) as conn:
+            conn.execute("INSERT INTO sessions VALUES (?, ?, ?)",
+                         (session_id, data["created_at"], json.dumps(data)))
+
+    def get(self, session_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT data FROM sessions WHERE id=?", (session_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update(self, session_id, fn):
+        """Applies fn(data) atomically. Returns the new data, or None if the session is gone."""
+        with self._connect(immediate=True) as conn:
+            row = conn.execute("SELECT data FROM sessions WHERE id=?", (session_id,)).fetchone()
+            if row is None:
+                return None
+            data = json.loads(row[0])
+            fn(data)
+            conn.execute("UPDATE sessions SET data=? WHERE id=?", (json.dumps(data), session_id))
+        return data
+
+    def delete(self, session_id):
+        with self._connect(immediate=True) as conn:
+            conn.execute("DELETE FROM sessions WHERE id=?", (session_id,))
+
+    def expired(self, timeout):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT id FROM sessions WHERE created_at < ?",
+                                (time.time() - timeout,)).fetchall()
+        return [r[0] for r in rows]
+
+    def add_blob_ref(self, session_id, blob):
+        with self._connect(immediate=True) as conn:
+            conn.execute("INSERT OR IGNORE INTO blob_refs VALUES (?, ?)", (blob, session_id))
+
+    def release_blobs(self, session_id, on_orphan, blobs=None):
+        """
+        Drops the session's blob references (only those in `blobs` when given);
+        on_orphan(blob) runs for blobs nobody references anymore.
+        It runs inside the write transaction, so a concurrent add_blob_ref waits until the file is gone.
+        """
+        with self._connect(immediate=True) as conn:
+            held = [r[0] for r in conn.execute("SELECT blob FROM blob_refs WHERE session_id=?", (session_id,))]
+            blobs = held if blobs is None else [b for b in held if b in blobs]
+            conn.executemany("DELETE FROM blob_refs WHERE blob=? AND session_id=?", [(b, session_id) for b in blobs])
+            for blob in blobs:
+                if conn.execute("SELECT 1 FROM blob_refs WHERE blob=?", (blob,)).fetchone() is None:
+                    on_orphan(blob)
+
+    def acquire_lease(self, name, owner, ttl):
+        """True if `owner` holds (or just took over) the named lease for the next `ttl` seconds."""
+        now = time.time()
+        with self._connect(immediate=True) as conn:
+            row = conn.execute("SELECT owner, expires_at FROM leases WHERE name=?", (name,)).fetchone()
+            if row is not None and row[0] != owner and row[1] > now:
+                return False
+            conn.execute("INSERT OR REPLACE INTO leases VALUES (?, ?, ?)", (name, owner, now + ttl))
+        return True
+
+    def __contains__(self, session_id):
+        with self._connect() as conn:
+            return conn.execute("SELECT 1 FROM sessions WHERE id=?", (session_id,)).fetchone() is not None
+
+
+def get_session_backend():
+    """Backend selected by settings.SESSION_BACKEND ("sqlite" by default, "memory" for a single process)."""
+    if settings.SESSION_BACKEND == "memory":
+        return MemorySessionBackend()
+    return SQLiteSessionBackend(settings.SESSION_DB)
@@ -7,6 +7,7 @@ const secFileInput = document.getElementById("sec-file-input");
 const btnUploadSec = document.getElementById("btn-upload-sec");
 
 let sessionId = null;
+let mainColumns = [];
 
 // ==========================================
 // 1. UPLOAD LOGIC (Main File)
@@ -47,59 +48,8 @@ async function handleUpload(e) {
     const data = await res.json();
     sessionId = data.session_id;
 
-    // --- POPULATE COLUMN DROPDOWNS ---
-    const mainSelect = document.getElementById("merge-key-main");
-    if (mainSelect) {
-      mainSelect.innerHTML = "";
-      data.analysis.columns.forEach((col) => {
-        const opt = document.createElement("option");
-        opt.value = col;
-        opt.innerText = col;
-        mainSelect.appendChild(opt);
-      });
-    }
-
-    const colSelect = document.getElementById("dedupe-col");
-    if (colSelect) {
-      colSelect.innerHTML =
-        '<option value="ALL">ALL Columns (Entire Row)</option>';
-      data.analysis.columns.forEach((col) => {
-        const option = document.createElement("option");
-        option.value = col;
-        option.innerText = `Only "${col}"`;
-        colSelect.appendChild(option);
-      });
-    }
-    // ... (keep existing populate logic for mainSelect and dedupe-col) ...
-
-    // 2. NEW: Populate "Ignore Columns" Checkboxes
-    const ignoreList = document.getElementById("ignore-col-list");
-    ignoreList.innerHTML = "";
-
-    data.analysis.columns.forEach((col) => {
-      const label = document.createElement("label");
-      label.style.fontSize = "0.85rem";
-      label.style.display = "flex";
-      label.style.alignItems = "center";
-
-      const checkbox = document.createElement("input");
-      checkbox.type = "checkbox";
-      checkbox.value = col;
-      checkbox.style.marginRight = "5px";
-
-      // Auto-check columns that usually shouldn't be touched
-      if (
-        ["id", "address", "desc", "comment"].some((k) =>
-          col.toLowerCase().includes(k)
-        )
-      ) {
-        checkbox.checked = true;
-      }
-
-      label.appendChild(checkbox);
-      label.appendChild(document.createTextNode(col));
-      ignoreList.appendChild(label);
-    });
+    renderMainAnalysis(data.analysis);
+    setupSheetPicker("", "original", data.analysis, renderMainAnalysis);
 
     dropContent.innerHTML = `
         <p style="color:#059669; font-weight:bold;">✅ ${file.name}</p>
@@ -114,6 +64,127 @@ async function handleUpload(e) {
   }
 }
 
+// Fills every column-based control from the main file's analysis
+function renderMainAnalysis(analysis) {
+  mainColumns = analysis.columns;
+  // --- POPULATE COLUMN DROPDOWNS ---
+  const mainSelect = document.getElementById("merge-key-main");
+  if (mainSelect) {
+    mainSelect.innerHTML = "";
+    analysis.columns.forEach((col) => {
+      const opt = document.createElement("option");
+      opt.value = col;
+      opt.innerText = col;
+      mainSelect.appendChild(opt);
+    });
+  }
+  fillOptionalKeySelect("merge-key-main-2", analysis.columns);
+
+  const colSelect = document.getElementById("dedupe-col");
+  if (colSelect) {
+    colSelect.innerHTML =
+      '<option value="ALL">ALL Columns (Entire Row)</option>';
+    analysis.columns.forEach((col) => {
+      const option = document.createElement("option");
+      option.value = col;
+      option.innerText = `Only "${col}"`;
+      colSelect.appendChild(option);
+    });
+  }
+  fillOptionalKeySelect("dedupe-col-2", analysis.columns);
+  fillOptionalKeySelect("delta-key", analysis.columns);
+  document.querySelectorAll("#extra-lookups .lookup-key-main").forEach((select) => {
+    fillKeySelect(select, analysis.columns);
+  });
+  // ... (keep existing populate logic for mainSelect and dedupe-col) ...
+
+  // 2. NEW: Populate "Ignore Columns" Checkboxes
+  const ignoreList = document.getElementById("ignore-col-list");
+  ignoreList.innerHTML = "";
+
+  analysis.columns.forEach((col) => {
+    const label = document.createElement("label");
+    label.style.fontSize = "0.85rem";
+    label.style.display = "flex";
+    label.style.alignItems = "center";
+
+    const checkbox = document.createElement("input");
+    checkbox.type = "checkbox";
+    checkbox.value = col;
+    checkbox.style.marginRight = "5px";
+
+    // Auto-check columns that usually shouldn't be touched
+    if (
+      ["id", "address", "desc", "comment"].some((k) =>
+        col.toLowerCase().includes(k)
+      )
+    ) {
+      checkbox.checked = true;
+    }
+
+    label.appendChild(checkbox);
+    label.appendChild(document.createTextNode(col));
+    ignoreList.appendChild(label);
+  });
+}
+
+// Excel files: choose another sheet / header row, then refresh the dependent controls
+function setupSheetPicker(prefix, target, analysis, onLoaded) {
+  const picker = document.getElementById(`${prefix}sheet-picker`);
+  const sheetSelect = document.getElementById(`${prefix}sheet-select`);
+  const headerInput = document.getElementById(`${prefix}header-row`);
+  if (!picker) return;
+
+  if (!analysis.sheets || analysis.sheets.length === 0) {
+    picker.classList.add("hidden");
+    return;
+  }
+  sheetSelect.innerHTML = "";
+  analysis.sheets.forEach((name) => {
+    const opt = document.createElement("option");
+    opt.value = name;
+    opt.innerText = name;
+    sheetSelect.appendChild(opt);
+  });
+  sheetSelect.value = analysis.sheet || analysis.sheets[0];
+  headerInput.value = (analysis.header_row || 0) + 1;
+  picker.classList.remove("hidden");
+
+  const reload = async () => {
+    try {
+      const res = await fetch(`/api/sheet/${sessionId}`, {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({
+          target: target,
+          sheet: sheetSelect.value,
+          header_row: Math.max(parseInt(headerInput.value || "1", 10) - 1, 0),
+        }),
+      });
+      if (!res.ok) throw new Error((await res.json()).detail || "Sheet read failed");
+      const data = await res.json();
+      onLoaded(data.analysis);
+    } catch (err) {
+      alert(err.message);
+    }
+  };
+  sheetSelect.onchange = reload;
+  headerInput.onchange = reload;
+}
+
+// Composite key dropdowns start with an empty "(none)" choice
+function fillOptionalKeySelect(id, columns) {
+  const select = document.getElementById(id);
+  if (!select) return;
+  select.innerHTML = '<option value="">(none)</option>';
+  columns.forEach((col) => {
+    const opt = document.createElement("option");
+    opt.value = col;
+    opt.innerText = col;
+    select.appendChild(opt);
+  });
+}
+
 // ==========================================
 // 2. SECONDARY FILE LOGIC (Merge)
 // ==========================================
@@ -144,14 +215,12 @@ secFileInput.addEventListener("change", async (e) => {
     ).innerText = `✅ ${file.name} (${data.rows} rows)`;
     document.getElementById("merge-config").classList.remove("hidden");
 
-    // Populate Secondary Dropdown
-    const secSelect = document.getElementById("merge-key-sec");
-    secSelect.innerHTML = "";
-    data.columns.forEach((col) => {
-      const opt = document.createElement("option");
-      opt.value = col;
-      opt.innerText = col;
-      secSelect.appendChild(opt);
+    renderSecondaryColumns(data.columns);
+    setupSheetPicker("sec-", "secondary", data, (analysis) => {
+      renderSecondaryColumns(analysis.columns);
+      document.getElementById(
+        "sec-file-status"
+      ).innerText = `✅ ${file.name} (${analysis.rows} rows)`;
     });
   } catch (err) {
     alert(err.message);
@@ -159,6 +228,87 @@ secFileInput.addEventListener("change", async (e) => {
   }
 });
 
+// Populate Secondary Dropdown
+function renderSecondaryColumns(columns) {
+  const secSelect = document.getElementById("merge-key-sec");
+  secSelect.innerHTML = "";
+  columns.forEach((col) => {
+    const opt = document.createElement("option");
+    opt.value = col;
+    opt.innerText = col;
+    secSelect.appendChild(opt);
+  });
+  fillOptionalKeySelect("merge-key-sec-2", columns);
+}
+
+// Additional lookup files: each row keeps the session slot the server gave its file (data-slot)
+function fillKeySelect(select, columns) {
+  const current = select.value;
+  select.innerHTML = "";
+  columns.forEach((col) => {
+    const opt = document.createElement("option");
+    opt.value = col;
+    opt.innerText = col;
+    select.appendChild(opt);
+  });
+  if (columns.includes(current)) select.value = current;
+}
+
+document.getElementById("btn-add-lookup").addEventListener("click", () => {
+  const row = document.createElement("div");
+  row.className = "lookup-row";
+  row.style.cssText = "display:grid; grid-template-columns: 1fr 1fr 1fr auto auto; gap:8px; align-items:center; margin-top:8px; font-size:0.85rem;";
+  row.innerHTML = `
+    <span><input type="file" class="lookup-file" accept=".csv,.xlsx,.xls" style="width:100%"><span class="lookup-status" style="color:#666;"></span></span>
+    <label>Main column: <select class="lookup-key-main" style="width:100%"></select></label>
+    <label>Lookup column: <select class="lookup-key-sec" style="width:100%"></select></label>
+    <label><input type="checkbox" class="lookup-fuzzy"> Fuzzy</label>
+    <button class="secondary lookup-remove" style="padding: 2px 8px;">✖</button>`;
+  document.getElementById("extra-lookups").appendChild(row);
+  fillKeySelect(row.querySelector(".lookup-key-main"), mainColumns);
+
+  row.querySelector(".lookup-file").addEventListener("change", async (e) => {
+    const file = e.target.files[0];
+    if (!file || !sessionId) return;
+    const status = row.querySelector(".lookup-status");
+    const formData = new FormData();
+    formData.append("file", file);
+    status.innerText = "Uploading...";
+    try {
+      // First upload of a row appends a slot; later ones replace the row's file in place
+      const target = row.dataset.slot ? `lookup=${row.dataset.slot}` : "append=true";
+      const res = await fetch(`/api/upload-secondary/${sessionId}?${target}`, {
+        method: "POST",
+        body: formData,
+      });
+      if (!res.ok) throw new Error((await res.json()).detail || "Upload failed");
+      const data = await res.json();
+      fillKeySelect(row.querySelector(".lookup-key-sec"), data.columns);
+      row.dataset.slot = data.lookup;
+      status.innerText = `✅ ${data.rows} rows`;
+    } catch (err) {
+      alert(err.message);
+      status.innerText = "Error.";
+    }
+  });
+
+  row.querySelector(".lookup-remove").addEventListener("click", async () => {
+    if (row.dataset.slot) {
+      const removed = Number(row.dataset.slot);
+      const res = await fetch(`/api/lookup/${sessionId}/${removed}`, { method: "DELETE" });
+      if (!res.ok) {
+        alert((await res.json()).detail || "Remove failed");
+        return;
+      }
+      // The server moved the later lookup files up one slot
+      document.querySelectorAll("#extra-lookups .lookup-row").forEach((other) => {
+        if (Number(other.dataset.slot) > removed) other.dataset.slot = Number(other.dataset.slot) - 1;
+      });
+    }
+    row.remove();
+  });
+});
+
 // ==========================================
 // 3. UI TOGGLES
 // ==========================================
@@ -180,6 +330,26 @@ function getConfig() {
   const mergeKeyMain = document.getElementById("merge-key-main");
   const mergeKeySec = document.getElementById("merge-key-sec");
   const dedupeColEl = document.getElementById("dedupe-col");
+  const dedupeCol2El = document.getElementById("dedupe-col-2");
+  const dedupeMulti =
+    dedupeColEl && dedupeCol2El && dedupeColEl.value !== "ALL" && dedupeCol2El.value;
+  const mergeKeyMain2 = document.getElementById("merge-key-main-2");
+  const mergeKeySec2 = document.getElementById("merge-key-sec-2");
+  const composite =
+    mergeKeyMain && mergeKeySec && mergeKeyMain2 && mergeKeySec2 &&
+    mergeKeyMain2.value && mergeKeySec2.value;
+  const extraLookups = [];
+  document.querySelectorAll("#extra-lookups .lookup-row").forEach((row) => {
+    if (!row.dataset.slot) return;
+    extraLookups.push({
+      file: Number(row.dataset.slot),
+      key_main: row.querySelector(".lookup-key-main").value,
+      key_sec: row.querySelector(".lookup-key-sec").value,
+      fuzzy: row.querySelector(".lookup-fuzzy").checked,
+      scorer: document.getElementById("merge-scorer").value,
+      threshold: parseFloat(document.getElementById("merge-threshold").value) || 75,
+    });
+  });
   const ignored = [];
   document.querySelectorAll("#ignore-col-list input:checked").forEach((cb) => {
     ignored.push(cb.value);
@@ -194,14 +364,45 @@ function getConfig() {
     // DEDUPE
     remove_duplicates: document.getElementById("opt-duplicates").checked,
     dedupe_column: dedupeColEl ? dedupeColEl.value : "ALL",
+    dedupe_columns: dedupeMulti ? [dedupeColEl.value, dedupeCol2El.value] : [],
+    dedupe_keep: document.getElementById("dedupe-keep").value,
+    dedupe_ignore_case: document.getElementById("opt-dedupe-ignore-case").checked,
     fuzzy_dedupe: document.getElementById("opt-fuzzy").checked,
+    dedupe_scorer: document.getElementById("dedupe-scorer").value,
+    dedupe_threshold: parseFloat(document.getElementById("dedupe-threshold").value) || 90,
 
     // MERGE
     merge_active: document.getElementById("opt-merge").checked,
     merge_key_main: mergeKeyMain ? mergeKeyMain.value : "",
     merge_key_sec: mergeKeySec ? mergeKeySec.value : "",
     merge_fuzzy: document.getElementById("opt-merge-fuzzy").checked,
+    merge_keys_main: composite ? [mergeKeyMain.value, mergeKeyMain2.value] : [],
+    merge_keys_sec: composite ? [mergeKeySec.value, mergeKeySec2.value] : [],
+    merge_scorer: document.getElementById("merge-scorer").value,
+    merge_threshold: parseFloat(document.getElementById("merge-threshold").value) || 75,
+    merge_block_on:
+      composite && document.getElementById("opt-merge-block").checked
+        ? mergeKeyMain2.value
+        : "",
     clean_merged_columns: document.getElementById("opt-clean-merged").checked,
+    // With extra lookups, the controls above describe lookup 0 of the list
+    lookups: extraLookups.length
+      ? [
+          {
+            file: 0,
+            key_main: mergeKeyMain ? mergeKeyMain.value : "",
+            key_sec: mergeKeySec ? mergeKeySec.value : "",
+            keys_main: composite ? [mergeKeyMain.value, mergeKeyMain2.value] : [],
+            keys_sec: composite ? [mergeKeySec.value, mergeKeySec2.value] : [],
+            fuzzy: document.getElementById("opt-merge-fuzzy").checked,
+            block_on:
+              composite && document.getElementById("opt-merge-block").checked ? mergeKeyMain2.value : "",
+            scorer: document.getElementById("merge-scorer").value,
+            threshold: parseFloat(document.getElementById("merge-threshold").value) || 75,
+          },
+          ...extraLookups,
+        ]
+      : [],
 
     // PRIVACY & CLEANING
     anonymize_pii: document.getElementById("opt-privacy").checked,
@@ -214,6 +415,10 @@ function getConfig() {
       numeric: document.getElementById("opt-numeric-fill").value,
     },
     ignore_columns: ignored,
+    delta_baseline: document.getElementById("delta-baseline").value.trim(),
+    delta_key: document.getElementById("delta-key").value
+      ? [document.getElementById("delta-key").value]
+      : [],
     fill_missing: {
       numeric: document.getElementById("opt-numeric-fill").value,
     },
@@ -244,6 +449,48 @@ function renderLogs(logs) {
   });
 }
 
+// Score distribution of fuzzy matches (helps tuning scorer + min score)
+function renderMatchStats(stats) {
+  if (!stats) return;
+  const logEl = document.getElementById("process-log");
+  const labels = { merge: "Lookup match", dedupe: "Fuzzy dedupe" };
+  Object.entries(stats).forEach(([kind, s]) => {
+    const li = document.createElement("li");
+    li.style.color = "#93c5fd";
+    if (kind === "duplicates") {
+      // Exact dedupe audit: groups and a few example rows
+      const examples = s.sample_groups
+        .slice(0, 5)
+        .map((g) => `row ${g.kept + 1} ← ${g.removed.map((r) => r + 1).join("/")}`)
+        .join("; ");
+      li.innerText =
+        `> 📊 Duplicate groups (keep ${s.keep}): ${s.groups} groups, ${s.removed} rows removed` +
+        (examples ? ` [${examples}]` : "");
+      logEl.appendChild(li);
+      return;
+    }
+    if (kind === "delta") {
+      li.innerText =
+        `> 📊 Baseline "${s.baseline}": ${s.reused}/${s.rows} rows reused, ` +
+        `${s.new} new, ${s.changed} changed, ${s.removed} removed` +
+        (s.fresh ? " (new baseline)" : "");
+      logEl.appendChild(li);
+      return;
+    }
+    const buckets = Object.entries(s.histogram || {})
+      .map(([range, n]) => `${range}: ${n}`)
+      .join(", ");
+    const label = kind.startsWith("merge_") ? `Lookup ${kind.slice(6)} match` : labels[kind] || kind;
+    li.innerText =
+      `> 📊 ${label} (${s.scorer} ≥ ${s.threshold}): ` +
+      `${s.exact} exact, ${s.fuzzy} fuzzy` +
+      (s.fuzzy ? ` (median score ${s.median})` : "") +
+      `, ${s.unmatched} unmatched` +
+      (buckets ? ` [${buckets}]` : "");
+    logEl.appendChild(li);
+  });
+}
+
 // ==========================================
 // 6. ACTION: PREVIEW
 // ==========================================
@@ -261,17 +508,22 @@ document.getElementById("btn-preview").addEventListener("click", async () => {
       body: JSON.stringify(getConfig()),
     });
     const data = await res.json();
+    // 409: a newer preview replaced this one, its own response will render
+    if (res.status !== 409) {
+      if (!res.ok) throw new Error(data.detail || "Preview failed");
 
-    document.getElementById("download-area").classList.add("hidden");
+      document.getElementById("download-area").classList.add("hidden");
 
-    // RENDER LOGS
-    renderLogs(data.report_log);
+      // RENDER LOGS
+      renderLogs(data.report_log);
+      renderMatchStats(data.match_stats);
 
-    renderDashboard(data.diff_summary, false);
-    document.getElementById("results-section").classList.remove("hidden");
-    document
-      .getElementById("results-section")
-      .scrollIntoView({ behavior: "smooth" });
+      renderDashboard(data.diff_summary, false);
+      document.getElementById("results-section").classList.remove("hidden");
+      document
+        .getElementById("results-section")
+        .scrollIntoView({ behavior: "smooth" });
+    }
   } catch (e) {
     alert(e);
   }
@@ -306,6 +558,7 @@ document.getElementById("btn-clean").addEventListener("click", async () => {
 
     // RENDER LOGS
     renderLogs(data.report_log);
+    renderMatchStats(data.match_stats);
 
     renderDashboard(data.diff_summary, true);
     document.getElementById("results-section").classList.remove("hidden");
@@ -340,28 +593,22 @@ function renderDashboard(diff, isFinal) {
     `;
 
   let html = "";
-  const formatVal = (val) => {
-    if (val === null || val === "" || val === "nan" || val === undefined)
-      return '<span style="color:#9ca3af; font-style:italic;">(empty)</span>';
-    return val;
-  };
 
   // Removed Rows Section
   if (diff.removed_preview && diff.removed_preview.length > 0) {
     html += `<h4 style="color:#ef4444; margin-top:20px;">🗑️ Removed Rows (Preview first 20)</h4>`;
     html += `<table class="diff-table" style="border-color:#fecaca;">
             <thead><tr style="background:#fef2f2;"><th>Row</th><th>Data (First 3 Columns)</th></tr></thead>
-            <tbody>`;
+            <tbody id="removed-body">`;
 
     diff.removed_preview.forEach((row) => {
-      const keys = Object.keys(row.data);
-      const previewText = keys
-        .slice(0, 3)
-        .map((k) => `<b>${k}:</b> ${formatVal(row.data[k])}`)
-        .join(", ");
-      html += `<tr><td>${row.row_index}</td><td style="color:#7f1d1d;">${previewText} ...</td></tr>`;
+      html += removedRowHtml(row);
     });
-    html += `</tbody></table><hr style="border:0; border-top:1px solid #eee; margin:20px 0;">`;
+    html += `</tbody></table>`;
+    if (isFinal && diff.stats.removed_count > diff.removed_preview.length) {
+      html += `<button id="btn-more-removed" class="secondary" style="font-size:0.85rem; padding:5px 10px; margin-top:8px;">Load more removed rows</button>`;
+    }
+    html += `<hr style="border:0; border-top:1px solid #eee; margin:20px 0;">`;
   }
 
   html += `<h4>📝 Modified Rows (Sample)</h4>`;
@@ -369,6 +616,12 @@ function renderDashboard(diff, isFinal) {
   if (diff.changed_rows.length === 0) {
     html += `<p style="text-align:center; color:#6b7280;">No modified rows detected.</p>`;
   } else {
+    if (isFinal) {
+      html += `<div style="margin-bottom:8px; font-size:0.85rem;">
+                <label>Column: <select id="diff-column"><option value="">All columns</option></select></label>
+                <span id="diff-progress" style="margin-left:10px; color:#6b7280;"></span>
+            </div>`;
+    }
     html += `<table class="diff-table">
             <thead>
                 <tr>
@@ -377,12 +630,41 @@ function renderDashboard(diff, isFinal) {
                     <th>Transformation (Before &rarr; After)</th>
                 </tr>
             </thead>
-            <tbody>`;
+            <tbody id="changed-body">`;
 
     const sample = diff.changed_rows.slice(0, 50);
     sample.forEach((row) => {
-      for (const [col, val] of Object.entries(row.changes)) {
-        html += `
+      html += changedRowHtml(row);
+    });
+    html += `</tbody></table>`;
+    if (isFinal) {
+      html += `<button id="btn-more-changed" class="secondary" style="font-size:0.85rem; padding:5px 10px; margin-top:8px;">Load more</button>`;
+    }
+  }
+
+  viewerEl.innerHTML = html;
+  if (isFinal) setupDiffBrowser(diff);
+}
+
+const formatVal = (val) => {
+  if (val === null || val === "" || val === "nan" || val === undefined)
+    return '<span style="color:#9ca3af; font-style:italic;">(empty)</span>';
+  return val;
+};
+
+function removedRowHtml(row) {
+  const keys = Object.keys(row.data);
+  const previewText = keys
+    .slice(0, 3)
+    .map((k) => `<b>${k}:</b> ${formatVal(row.data[k])}`)
+    .join(", ");
+  return `<tr><td>${row.row_index}</td><td style="color:#7f1d1d;">${previewText} ...</td></tr>`;
+}
+
+function changedRowHtml(row) {
+  let html = "";
+  for (const [col, val] of Object.entries(row.changes)) {
+    html += `
                 <tr>
                     <td><strong>${row.row_index}</strong></td>
                     <td>${col}</td>
@@ -397,12 +679,86 @@ function renderDashboard(diff, isFinal) {
                         </div>
                     </td>
                 </tr>`;
-      }
+  }
+  return html;
+}
+
+// After a clean run: page through the persisted diff (GET /api/diff), optionally by column
+function setupDiffBrowser(diff) {
+  const state = {
+    changed: { page: 1, pageSize: 50, column: "" },
+    removed: { page: 1, pageSize: 20 },
+  };
+
+  const fetchPage = async (kind, page, pageSize, column) => {
+    const params = new URLSearchParams({ kind, page, page_size: pageSize });
+    if (column) params.set("column", column);
+    const res = await fetch(`/api/diff/${sessionId}?${params}`);
+    if (!res.ok) throw new Error("Could not load diff page");
+    return res.json();
+  };
+
+  const progress = (data) => {
+    const el = document.getElementById("diff-progress");
+    if (el) el.innerText = `Showing ${Math.min(data.page * data.page_size, data.total)} of ${data.total}`;
+    const btn = document.getElementById("btn-more-changed");
+    if (btn) btn.classList.toggle("hidden", data.page >= data.pages);
+  };
+
+  const loadChanged = async (reset) => {
+    const st = state.changed;
+    st.page = reset ? 1 : st.page + 1;
+    try {
+      const data = await fetchPage("changed", st.page, st.pageSize, st.column);
+      const body = document.getElementById("changed-body");
+      if (reset) body.innerHTML = "";
+      data.items.forEach((row) => body.insertAdjacentHTML("beforeend", changedRowHtml(row)));
+      progress(data);
+    } catch (err) {
+      alert(err.message);
+    }
+  };
+
+  const columnSelect = document.getElementById("diff-column");
+  if (columnSelect) {
+    // Column list (with change counts) comes with the first page
+    fetchPage("changed", 1, 1, "")
+      .then((data) => {
+        Object.entries(data.columns)
+          .filter(([, count]) => count > 0)
+          .forEach(([col, count]) => {
+            const opt = document.createElement("option");
+            opt.value = col;
+            opt.innerText = `${col} (${count})`;
+            columnSelect.appendChild(opt);
+          });
+        progress({ page: 1, page_size: state.changed.pageSize, total: diff.stats.changed_count, pages: Math.ceil(diff.stats.changed_count / state.changed.pageSize) });
+      })
+      .catch(() => {});
+    columnSelect.addEventListener("change", () => {
+      state.changed.column = columnSelect.value;
+      loadChanged(true);
     });
-    html += `</tbody></table>`;
   }
 
-  viewerEl.innerHTML = html;
+  const btnChanged = document.getElementById("btn-more-changed");
+  if (btnChanged) btnChanged.addEventListener("click", () => loadChanged(false));
+
+  const btnRemoved = document.getElementById("btn-more-removed");
+  if (btnRemoved) {
+    btnRemoved.addEventListener("click", async () => {
+      const st = state.removed;
+      st.page += 1;
+      try {
+        const data = await fetchPage("removed", st.page, st.pageSize);
+        const body = document.getElementById("removed-body");
+        data.items.forEach((row) => body.insertAdjacentHTML("beforeend", removedRowHtml(row)));
+        if (st.page >= data.pages) btnRemoved.classList.add("hidden");
+      } catch (err) {
+        alert(err.message);
+      }
+    });
+  }
 }
 
 // ... existing code ...
@@ -1,18 +1,23 @@
 import pandas as pd
 import csv
+import importlib.util
 import io
 import os
 
-def read_file_as_df(file_path):
+# Rust-backed Excel engine (pip install python-calamine); openpyxl read-only streaming otherwise
+HAS_CALAMINE = importlib.util.find_spec("python_calamine") is not None
+
+def read_file_as_df(file_path, sheet=None, header_row=0):
     """
     Reads CSV or Excel.
     Includes SMART REPAIR for bad CSV lines (e.g. "$3,500" unquoted).
+    sheet / header_row: Excel only; sheet name (default: first sheet) and 0-based header row.
     """
     ext = os.path.splitext(file_path)[1].lower()
     
     if ext in ['.xlsx', '.xls']:
         try:
-            return pd.read_excel(file_path)
+            return _read_excel(file_path, ext, sheet, header_row or 0)
         except Exception as e:
             raise ValueError(f"Excel read error: {e}")
     
@@ -26,6 +31,75 @@ def read_file_as_df(file_path):
             
     raise ValueError("Unsupported file format")
 
+def list_sheets(file_path):
+    """Sheet names of an Excel file (empty list for CSV)."""
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext not in ['.xlsx', '.xls']:
+        return []
+    if HAS_CALAMINE:
+        from python_calamine import CalamineWorkbook
+        return list(CalamineWorkbook.from_path(file_path).sheet_names)
+    if ext == '.xlsx':
+        from openpyxl import load_workbook
+        wb = load_workbook(file_path, read_only=True, data_only=True, keep_links=False)
+        try:
+            return list(wb.sheetnames)
+        finally:
+            wb.close()
+    return list(pd.ExcelFile(file_path).sheet_names)
+
+def _read_excel(file_path, ext, sheet, header_row):
+    # 1. Fast path: calamine reads xlsx/xls/xlsb natively
+    if HAS_CALAMINE:
+        return pd.read_excel(file_path, sheet_name=sheet or 0, header=header_row, engine="calamine")
+    # 2. Legacy .xls has no streaming reader (xlrd)
+    if ext != '.xlsx':
+        return pd.read_excel(file_path, sheet_name=sheet or 0, header=header_row)
+    return _read_xlsx_streaming(file_path, sheet, header_row)
+
+def _read_xlsx_streaming(file_path, sheet, header_row):
+    """
+    openpyxl read-only mode: rows are streamed as plain values (no Cell objects, no styles),
+    and only the used range is kept: trailing empty rows/columns (formatting leftovers) are dropped.
+    """
+    from openpyxl import load_workbook
+    from pandas.io.parsers import TextParser
+
+    wb = load_workbook(file_path, read_only=True, data_only=True, keep_links=False)
+    try:
+        ws = wb[sheet] if sheet else wb.worksheets[0]
+        rows = []
+        width = 0
+        last_row = 0
+        for values in ws.iter_rows(values_only=True):
+            row = list(values)
+            # Used width of this row (ignore trailing empty cells)
+            used = len(row)
+            while used and (row[used - 1] is None or row[used - 1] == ""):
+                used -= 1
+            if used:
+                width = max(width, used)
+                last_row = len(rows) + 1
+            rows.append(row)
+    finally:
+        wb.close()
+
+    rows = [r[:width] + [None] * (width - len(r)) for r in rows[:last_row]]
+    if len(rows) <= header_row:
+        return pd.DataFrame()
+    # Same header handling / type inference as pd.read_excel (Unnamed: n, duplicate names, dtypes)
+    return TextParser(rows, header=header_row).read()
+
+def write_df(df, path):
+    """Writes a cleaned frame (.csv or Excel) next to `path` first, so readers never see a partial file."""
+    base, ext = os.path.splitext(path)
+    tmp_path = f"{base}.partial{ext}"
+    if ext.lower() == ".csv":
+        df.to_csv(tmp_path, index=False, encoding='utf-8-sig', na_rep='')
+    else:
+        df.to_excel(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
 def _read_csv_robust(file_path):
     """
     Manually parses CSV to recover rows with extra commas (common in money fields).
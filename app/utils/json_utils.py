@@ -1,6 +1,14 @@
+import json
 import pandas as pd
 import numpy as np
 from datetime import datetime, date
+from fastapi.responses import JSONResponse
+
+# Optional fast encoder (Rust). Falls back to the stdlib json module.
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 def make_json_safe(obj):
     """Recursively convert numpy/pandas types to Python native types."""
@@ -38,4 +46,82 @@ def make_json_safe(obj):
     if isinstance(obj, (np.floating, float)):
         return float(obj)
         
-    return obj
\ No newline at end of file
+    return obj
+
+
+# ==========================================
+# FAST PATH (column-wise, no recursion)
+# ==========================================
+
+def to_native(val):
+    """Single scalar -> JSON-native value (NaN/NaT -> None, timestamps -> ISO, numpy -> Python)."""
+    if val is None or isinstance(val, (str, bool, int)):
+        return val
+    if isinstance(val, float):
+        return None if val != val else val
+    if isinstance(val, np.generic):
+        return to_native(val.item())
+    if isinstance(val, (pd.Timestamp, datetime, date)):
+        return None if val is pd.NaT else val.isoformat()
+    try:
+        if pd.isna(val):
+            return None
+    except (TypeError, ValueError):
+        pass
+    return val
+
+def column_to_list(s: pd.Series):
+    """Converts a whole column to a list of JSON-native values using vectorized ops where possible."""
+    kind = s.dtype.kind
+    na = s.isna().to_numpy()
+
+    if kind == "M" and getattr(s.dtype, "tz", None) is None:
+        values = s.to_numpy()
+        # Same text as Timestamp.isoformat() (seconds, or microseconds when present)
+        ticks = values.astype("datetime64[us]").astype(np.int64)
+        unit = "s" if not np.any(ticks[~na] % 1_000_000) else "us"
+        out = np.datetime_as_string(values, unit=unit).tolist()
+    elif kind in "iub":
+        return s.to_numpy().tolist()
+    elif kind == "f":
+        out = s.to_numpy().tolist()
+    else:
+        out = s.to_numpy(dtype=object).tolist()
+        if any(not isinstance(v, (str, int, float)) for v in out if v is not None):
+            out = [to_native(v) for v in out]
+
+    if na.any():
+        for i in np.flatnonzero(na):
+            out[i] = None
+    return out
+
+def frame_to_records(df: pd.DataFrame):
+    """DataFrame slice -> list of JSON-native record dicts, converted column by column."""
+    keys = [to_native(c) for c in df.columns]
+    columns = [column_to_list(df.iloc[:, i]) for i in range(df.shape[1])]
+    return [dict(zip(keys, row)) for row in zip(*columns)] if columns else [{} for _ in range(len(df))]
+
+def _default(obj):
+    """Encoder hook for anything the fast path left behind."""
+    if isinstance(obj, pd.DataFrame):
+        return frame_to_records(obj)
+    if isinstance(obj, (pd.Series, np.ndarray)):
+        return column_to_list(pd.Series(obj))
+    value = to_native(obj)
+    if value is obj:
+        return str(obj)
+    return value
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=_default,
+                            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSONResponse rendered with orjson when installed (NaN -> null, numpy and datetime aware).
+    Return it directly from endpoints to skip FastAPI's recursive jsonable_encoder pass.
+    """
+    def render(self, content) -> bytes:
+        return dumps(content)
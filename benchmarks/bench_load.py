@@ -0,0 +1,316 @@
+"""
+Concurrent-session load test.
+
+Simulates N analysts, each running the full flow on synthetic files:
+    upload -> upload-secondary -> preview (x P, with changing options) -> clean -> download
+and reports, per endpoint, p50/p95/p99 latency, plus throughput, event-loop stall and peak RSS.
+
+Targets:
+  * in-process (default): the FastAPI app through httpx.ASGITransport, same event loop as the clients,
+    so "loop lag" is exactly the time the server blocked the loop
+  * --url http://127.0.0.1:8000: an already running instance
+  * --spawn [--workers W]: starts uvicorn on a free port for the run (RSS covers the server processes)
+
+In every mode a background probe hits /api/health every 50 ms; its latency shows how long requests
+wait behind blocking work on the server.
+
+Usage:
+    python benchmarks/bench_load.py --users 8 --previews 4 --rows 20000
+    python benchmarks/bench_load.py --spawn --workers 4 --users 16 --json results.json
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+try:
+    import resource  # Unix only
+except ImportError:
+    resource = None
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+FIRST_NAMES = ["Ahmed", "Mohamed", "Sara", "Mona", "Omar", "Laila", "Youssef", "Nour", "Karim", "Hana"]
+LAST_NAMES = ["Ali", "Hassan", "Ibrahim", "Mahmoud", "Saleh", "Farouk", "Nabil", "Adel"]
+CITIES = ["Cairo", "Giza", "Alexandria", "Mansoura", "Aswan"]
+
+# Option sets cycled through the repeated previews (each one invalidates a different stage)
+PREVIEW_CONFIGS = [
+    {"remove_duplicates": True, "fix_emails": True},
+    {"remove_duplicates": True, "fix_emails": True, "clean_money": True},
+    {"remove_duplicates": True, "fix_emails": True, "clean_money": True, "fix_phones": True},
+    {"remove_duplicates": True, "fix_emails": True, "clean_money": True, "anonymize_pii": True},
+]
+MERGE_CONFIG = {"merge_active": True, "merge_key_main": "customer", "merge_key_sec": "customer", "merge_fuzzy": True}
+
+
+# ==========================================
+# SYNTHETIC DATA
+# ==========================================
+def _typo(rng, s):
+    if len(s) < 4 or rng.random() > 0.5:
+        return s.lower()
+    i = rng.randrange(1, len(s) - 1)
+    return s[:i] + s[i + 1:]
+
+
+def make_main_csv(rows, seed):
+    """Customers with messy emails/phones/amounts and ~5% duplicated rows."""
+    rng = random.Random(seed)
+    lines = ["id,customer,email,phone,amount,city"]
+    for i in range(rows):
+        if i and rng.random() < 0.05:
+            lines.append(lines[rng.randrange(1, len(lines))])
+            continue
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        name = f"{first} {last} {rng.randrange(500)}"
+        email = f"{first.lower()}.{last.lower()}{i}@{'@' if rng.random() < 0.05 else ''}example.com"
+        phone = f"(2{rng.randrange(10, 99)}) 555-{rng.randrange(1000, 9999)}"
+        amount = rng.choice([f"${rng.randrange(100, 9999)}", f"{rng.randrange(1, 9)}.{rng.randrange(9)}k", "", "nan"])
+        lines.append(f"{i},{name},{email},\"{phone}\",{amount},{rng.choice(CITIES)}")
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def make_lookup_csv(rows, seed):
+    """Lookup table keyed by (sometimes misspelled) customer names."""
+    rng = random.Random(seed + 1)
+    lines = ["customer,segment,region"]
+    for _ in range(rows):
+        name = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {rng.randrange(500)}"
+        lines.append(f"{_typo(rng, name)},{rng.choice(['A', 'B', 'C'])},{rng.choice(CITIES)}")
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+# ==========================================
+# MEASUREMENT
+# ==========================================
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * q / 100
+    lo, hi = int(k), min(int(k) + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}  # endpoint -> [ms]
+        self.errors = {}  # endpoint -> count
+
+    async def call(self, client, name, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            res = await client.request(method, url, **kwargs)
+            ok = res.status_code < 400
+        except httpx.HTTPError:
+            res, ok = None, False
+        self.latencies.setdefault(name, []).append((time.perf_counter() - start) * 1000)
+        if not ok:
+            self.errors[name] = self.errors.get(name, 0) + 1
+        return res if ok else None
+
+
+def _rss_kb(pid):
+    """Resident set size of pid and its descendants (Linux /proc), in KB."""
+    total, stack = 0, [pid]
+    while stack:
+        p = stack.pop()
+        try:
+            with open(f"/proc/{p}/status") as f:
+                total += next(int(l.split()[1]) for l in f if l.startswith("VmRSS:"))
+            for task in os.listdir(f"/proc/{p}/task"):
+                with open(f"/proc/{p}/task/{task}/children") as f:
+                    stack += [int(c) for c in f.read().split()]
+        except (OSError, StopIteration, ValueError):
+            pass
+    return total
+
+
+async def monitor(stop, server_pid, stats, interval=0.01):
+    """Event-loop lag (how late a short sleep wakes up) and peak RSS of the server process tree."""
+    last_rss = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = (time.perf_counter() - start - interval) * 1000
+        stats["loop_lag_ms"].append(max(lag, 0.0))
+        if server_pid and time.perf_counter() - last_rss > 0.1:
+            last_rss = time.perf_counter()
+            stats["peak_rss_mb"] = max(stats["peak_rss_mb"], _rss_kb(server_pid) / 1024)
+
+
+async def health_probe(client, stop, recorder, interval=0.05):
+    while not stop.is_set():
+        await recorder.call(client, "GET /api/health (probe)", "GET", "/api/health")
+        await asyncio.sleep(interval)
+
+
+async def user_flow(client, recorder, user, args, main_bytes, lookup_bytes):
+    files = {"file": (f"customers_{user}.csv", io.BytesIO(main_bytes), "text/csv")}
+    res = await recorder.call(client, "POST /api/upload", "POST", "/api/upload", files=files)
+    if res is None:
+        return False
+    session_id = res.json()["session_id"]
+
+    files = {"file": ("lookup.csv", io.BytesIO(lookup_bytes), "text/csv")}
+    if await recorder.call(client, "POST /api/upload-secondary", "POST",
+                           f"/api/upload-secondary/{session_id}", files=files) is None:
+        return False
+
+    for i in range(args.previews):
+        config = {**PREVIEW_CONFIGS[i % len(PREVIEW_CONFIGS)], **MERGE_CONFIG}
+        await recorder.call(client, "POST /api/preview", "POST", f"/api/preview/{session_id}", json=config)
+
+    config = {**PREVIEW_CONFIGS[(args.previews - 1) % len(PREVIEW_CONFIGS)], **MERGE_CONFIG}
+    res = await recorder.call(client, "POST /api/clean", "POST", f"/api/clean/{session_id}", json=config)
+    if res is None:
+        return False
+    return await recorder.call(client, "GET /api/download", "GET", res.json()["download_url"]) is not None
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def spawn_server(workers):
+    port = _free_port()
+    cmd = [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+           "--log-level", "warning", "--workers", str(workers)]
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=dict(os.environ, DATAFORGE_WORKERS=str(workers)))
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            if httpx.get(f"{url}/api/health", timeout=0.5).status_code == 200:
+                return proc, url
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError("server did not start")
+
+
+async def run(args):
+    proc = None
+    if args.spawn:
+        proc, url = spawn_server(args.workers)
+        transport, base_url, server_pid, mode = None, url, proc.pid, f"spawned uvicorn x{args.workers}"
+    elif args.url:
+        transport, base_url, server_pid, mode = None, args.url, args.pid, args.url
+    else:
+        from app.main import app
+        transport, base_url, server_pid, mode = httpx.ASGITransport(app=app), "http://loadtest", None, "in-process"
+
+    lookup_bytes = make_lookup_csv(args.lookup_rows, args.seed)
+    shared_main = make_main_csv(args.rows, args.seed)
+    mains = [shared_main if args.same_file else make_main_csv(args.rows, args.seed + u) for u in range(args.users)]
+
+    recorder = Recorder()
+    stats = {"loop_lag_ms": [], "peak_rss_mb": 0.0}
+    stop = asyncio.Event()
+    limits = httpx.Limits(max_connections=args.users + 4)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=args.timeout, limits=limits) as client:
+            background = [asyncio.create_task(monitor(stop, server_pid, stats)),
+                          asyncio.create_task(health_probe(client, stop, recorder))]
+            start = time.perf_counter()
+            results = await asyncio.gather(*[user_flow(client, recorder, u, args, mains[u], lookup_bytes)
+                                             for u in range(args.users)])
+            wall = time.perf_counter() - start
+            stop.set()
+            await asyncio.gather(*background)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    if server_pid is None and resource is not None:
+        # In-process: the server shares this process (clients included)
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        stats["peak_rss_mb"] = maxrss / (1024 * 1024) if sys.platform == "darwin" else maxrss / 1024
+
+    flow_requests = sum(len(v) for k, v in recorder.latencies.items() if "(probe)" not in k)
+    lags = sorted(stats["loop_lag_ms"])
+    return {
+        "mode": mode,
+        "users": args.users,
+        "previews_per_user": args.previews,
+        "rows": args.rows,
+        "lookup_rows": args.lookup_rows,
+        "wall_s": round(wall, 2),
+        "flows_completed": sum(1 for r in results if r),
+        "requests": flow_requests,
+        "throughput_rps": round(flow_requests / wall, 2),
+        "endpoints": {
+            name: {
+                "count": len(values),
+                "errors": recorder.errors.get(name, 0),
+                "p50_ms": round(percentile(sorted(values), 50), 1),
+                "p95_ms": round(percentile(sorted(values), 95), 1),
+                "p99_ms": round(percentile(sorted(values), 99), 1),
+                "max_ms": round(max(values), 1),
+            }
+            for name, values in recorder.latencies.items()
+        },
+        "loop_lag_ms": {
+            "p50": round(percentile(lags, 50) or 0, 1),
+            "p99": round(percentile(lags, 99) or 0, 1),
+            "max": round(lags[-1] if lags else 0, 1),
+            # Total time the loop was blocked beyond 50 ms at a stretch
+            "stalled_s": round(sum(l for l in lags if l > 50) / 1000, 2),
+        },
+        "peak_rss_mb": round(stats["peak_rss_mb"], 1) if stats["peak_rss_mb"] else None,
+    }
+
+
+def print_report(report):
+    print(f"== {report['mode']}: {report['users']} users x {report['previews_per_user']} previews, "
+          f"{report['rows']} rows (+{report['lookup_rows']} lookup) ==")
+    print(f"{'endpoint':32} {'n':>5} {'err':>4} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for name, e in report["endpoints"].items():
+        print(f"{name:32} {e['count']:5d} {e['errors']:4d} {e['p50_ms']:8.1f}ms {e['p95_ms']:8.1f}ms "
+              f"{e['p99_ms']:8.1f}ms {e['max_ms']:8.1f}ms")
+    lag = report["loop_lag_ms"]
+    print(f"\nflows completed: {report['flows_completed']}/{report['users']}   wall: {report['wall_s']} s   "
+          f"throughput: {report['throughput_rps']} req/s")
+    print(f"client loop lag: p50 {lag['p50']} ms  p99 {lag['p99']} ms  max {lag['max']} ms  "
+          f"stalled {lag['stalled_s']} s" + ("  (= server blocking, in-process)" if report["mode"] == "in-process" else ""))
+    print(f"peak RSS: {report['peak_rss_mb']} MB" if report["peak_rss_mb"] else "peak RSS: n/a (pass --pid)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=8, help="concurrent simulated analysts")
+    parser.add_argument("--previews", type=int, default=4, help="previews per user before cleaning")
+    parser.add_argument("--rows", type=int, default=20000, help="rows in each main file")
+    parser.add_argument("--lookup-rows", type=int, default=2000)
+    parser.add_argument("--same-file", action="store_true", help="every user uploads the same main file")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--timeout", type=float, default=300.0, help="per-request timeout (s)")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--url", help="running instance, e.g. http://127.0.0.1:8000")
+    target.add_argument("--spawn", action="store_true", help="start uvicorn for the duration of the run")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers with --spawn")
+    parser.add_argument("--pid", type=int, help="server pid for RSS sampling with --url (Linux)")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
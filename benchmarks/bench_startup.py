@@ -0,0 +1,108 @@
+"""
+Cold-start benchmark for the launcher.
+
+Measures, each in a fresh interpreter:
+  1. the launcher prelude (`import run`): what a second launch pays before it exits
+  2. the full app import (`import app.main`), with the slowest modules from `-X importtime`
+  3. end to end: `python run.py` until /api/health answers (browser disabled)
+
+Usage:
+    python benchmarks/bench_startup.py [--repeat 5] [--top 15] [--no-e2e]
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def time_import(module, repeat):
+    """Wall time of `import <module>` in a fresh interpreter (ms)."""
+    code = f"import time; t = time.perf_counter(); import {module}; print((time.perf_counter() - t) * 1000)"
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+        runs.append(float(out.stdout.strip().splitlines()[-1]))
+    return runs
+
+
+def import_profile(module, top):
+    """Top modules by cumulative import time (us) from `python -X importtime`."""
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                         cwd=ROOT, capture_output=True, text=True, check=True)
+    rows = []
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, self_us, cumulative_us, name = [p.strip() for p in line.replace("import time:", "|").split("|")]
+        rows.append((int(cumulative_us), int(self_us), name))
+    # Only report top-level packages to keep the table readable
+    roots = {}
+    for cumulative_us, self_us, name in rows:
+        root = name.split(".")[0]
+        roots[root] = max(roots.get(root, 0), cumulative_us)
+    return sorted(roots.items(), key=lambda r: r[1], reverse=True)[:top]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def time_to_health(timeout=60):
+    """Starts run.py and returns ms until /api/health responds."""
+    env = dict(os.environ, DATAFORGE_NO_BROWSER="1")
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "run.py"], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            for port in range(8000, 8010):
+                try:
+                    with urllib.request.urlopen(f"http://127.0.0.1:{port}/api/health", timeout=0.2) as r:
+                        if r.status == 200:
+                            return (time.perf_counter() - start) * 1000
+                except Exception:
+                    pass
+            time.sleep(0.02)
+        return None
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def summarize(runs):
+    return f"median {statistics.median(runs):7.1f} ms   min {min(runs):7.1f} ms   max {max(runs):7.1f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--no-e2e", action="store_true", help="skip the run.py -> /api/health measurement")
+    args = parser.parse_args()
+
+    print("== Launcher prelude (import run) ==")
+    print(summarize(time_import("run", args.repeat)))
+
+    print("\n== Full app (import app.main) ==")
+    print(summarize(time_import("app.main", args.repeat)))
+
+    print(f"\n== Slowest top-level packages under app.main (cumulative) ==")
+    for name, cumulative_us in import_profile("app.main", args.top):
+        print(f"{cumulative_us / 1000:8.1f} ms  {name}")
+
+    if not args.no_e2e:
+        print("\n== run.py until /api/health answers ==")
+        runs = [r for r in (time_to_health() for _ in range(args.repeat)) if r is not None]
+        print(summarize(runs) if runs else "server did not answer")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,18 @@
 import os
 import sys
-import uvicorn
+import json
 import webbrowser
 import threading
 import multiprocessing
 import socket
-import requests
 import time
-from fastapi.staticfiles import StaticFiles
-from app.main import app
+import urllib.request
+from app.config import settings  # stdlib-only module
+
+# NOTE: Keep this prelude stdlib-only. The heavy stack (fastapi, pandas, rapidfuzz, uvicorn)
+# is imported in __main__ only AFTER the single-instance check and port selection,
+# so a second launch exits in milliseconds and the splash shows while the real import runs.
+# See benchmarks/bench_startup.py for the import-time profile.
 
 
 # --- SPLASH SCREEN IMPORT ---
@@ -28,16 +32,23 @@ def find_free_port(start_port=8000, max_port=8010):
             return port
     return None
 
-def check_existing_instance(port=8000):
-    """Checks if the app is already running on the default port."""
+def get_health(port, timeout=1):
+    """Returns the /api/health JSON of whatever listens on the port, or None."""
     try:
-        if is_port_in_use(port):
-            # Something is there, check if it is US
-            response = requests.get(f"http://127.0.0.1:{port}/api/health", timeout=1)
-            if response.status_code == 200 and response.json().get("app") == "Dataforg":
-                return True
-    except:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/api/health", timeout=timeout) as response:
+            if response.status == 200:
+                return json.loads(response.read().decode("utf-8"))
+    except Exception:
         pass
+    return None
+
+def check_existing_instance(port=8000):
+    """Checks if the app is already running on the default port."""
+    if is_port_in_use(port):
+        # Something is there, check if it is US
+        health = get_health(port)
+        if health and health.get("app") == settings.HEALTH_APP_ID:
+            return True
     return False
 
 # --- WINDOWED MODE FIX ---
@@ -56,13 +67,36 @@ def get_resource_path(relative_path):
         base_path = os.path.abspath(".")
     return os.path.join(base_path, relative_path)
 
-def start_browser(url):
-    time.sleep(1.5) # Wait for server to boot
-    webbrowser.open(url)
+def wait_for_server(port, timeout=30):
+    """Polls /api/health until the server answers (instead of sleeping a fixed time)."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if get_health(port, timeout=0.5):
+            return True
+        time.sleep(0.05)
+    return False
+
+def start_browser(port):
+    wait_for_server(port)
+    if not os.environ.get("DATAFORGE_NO_BROWSER"):
+        webbrowser.open(f"http://127.0.0.1:{port}")
     # Close splash screen once browser launches
     if pyi_splash and pyi_splash.is_alive():
         pyi_splash.close()
 
+def warm_up():
+    """Imports the Excel reader uploads will use in the background, so the first .xlsx upload does not pay for it."""
+    try:
+        from app.utils.file_handler import HAS_CALAMINE
+        if HAS_CALAMINE:
+            import python_calamine  # noqa: F401
+            import pandas.io.excel._calamine  # noqa: F401
+        else:
+            import openpyxl  # noqa: F401
+            import pandas.io.excel._openpyxl  # noqa: F401
+    except Exception:
+        pass
+
 if __name__ == "__main__":
     multiprocessing.freeze_support()
 
@@ -82,14 +116,26 @@ if __name__ == "__main__":
         if pyi_splash: pyi_splash.close()
         sys.exit(1)
 
-    # 3. Setup Static Files
-    static_path = get_resource_path(os.path.join("app", "static"))
-    if not os.path.exists(static_path):
-        static_path = os.path.join(os.getcwd(), "app", "static")
-    app.mount("/", StaticFiles(directory=static_path, html=True), name="static")
+    # 3. Heavy imports (splash is still showing)
+    import uvicorn
 
-    # 4. Launch Browser & Close Splash
-    threading.Thread(target=start_browser, args=(f"http://127.0.0.1:{port}",), daemon=True).start()
+    # 4. Launch Browser once /api/health answers & Close Splash
+    threading.Thread(target=start_browser, args=(port,), daemon=True).start()
 
     # 5. Run Server
-    uvicorn.run(app, host="127.0.0.1", port=port, log_config=None)
\ No newline at end of file
+    if settings.WORKERS > 1:
+        # Each worker process imports app.main itself (static files are mounted there);
+        # sessions are shared through settings.SESSION_BACKEND
+        uvicorn.run("app.main:app", host="127.0.0.1", port=port, workers=settings.WORKERS, log_config=None)
+    else:
+        from fastapi.staticfiles import StaticFiles
+        from app.main import app
+
+        # Setup Static Files
+        static_path = get_resource_path(os.path.join("app", "static"))
+        if not os.path.exists(static_path):
+            static_path = os.path.join(os.getcwd(), "app", "static")
+        app.mount("/", StaticFiles(directory=static_path, html=True), name="static")
+
+        threading.Thread(target=warm_up, daemon=True).start()
+        uvicorn.run(app, host="127.0.0.1", port=port, log_config=None)
@@ -1,17 +1,56 @@
 import sys
 import os
+import asyncio
+import json
+import threading
+import time
+import uuid
+import numpy as np
+import pandas as pd
 import pytest
 from fastapi.testclient import TestClient
+from openpyxl import Workbook
 
 # Path fix
 current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
 sys.path.insert(0, parent_dir)
 
+from app import main as app_main
 from app.main import app
+from app.batch import main as batch_main
+from app.config import settings
+from app.core import merger, scoring
+from app.core.cache import StageCache
+from app.core.cleaner import clean_dataframe
+from app.core.dedupe import find_duplicates
+from app.core import delta, match_cache
+from app.core.match_cache import MatchCache
+from app.core.merger import fuzzy_merge_datasets, merge_lookups, normalize_key_column, normalize_key_for_merge
+from app.core.pipeline import run_pipeline, estimate_pipeline_bytes, PipelineCancelled
+from app.core.reporter import write_diff_index, read_diff_page
+from app.core.scoring import SCORERS, best_matches, score_distribution
+from app.schemas import CleaningConfig
+from app.scheduler import WorkScheduler, Overloaded, scheduler
+from app.sessions import SQLiteSessionBackend
+from app.utils import file_handler
+from app.utils.json_utils import frame_to_records, dumps
 
 client = TestClient(app)
 
+@pytest.fixture(autouse=True)
+def isolated_storage(tmp_path, monkeypatch):
+    """Keeps sessions, uploads and the persistent caches of every test under tmp_path (never in ~)."""
+    monkeypatch.setattr(settings, "TEMP_DIR", str(tmp_path / "sessions"))
+    monkeypatch.setattr(settings, "BLOB_DIR", str(tmp_path / "sessions" / "blobs"))
+    monkeypatch.setattr(settings, "SESSION_DB", str(tmp_path / "sessions" / "sessions.sqlite3"))
+    monkeypatch.setattr(settings, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(settings, "BASELINE_DIR", str(tmp_path / "cache" / "baselines"))
+    os.makedirs(settings.TEMP_DIR)
+    monkeypatch.setattr(app_main, "sessions", SQLiteSessionBackend(settings.SESSION_DB))
+    monkeypatch.setattr(match_cache, "_match_cache", None)
+    monkeypatch.setattr(app_main, "STAGE_CACHE", StageCache(settings.STAGE_CACHE_BUDGET))
+
 DATA_DIR = os.path.join(current_dir, "data")
 os.makedirs(DATA_DIR, exist_ok=True)
 CSV_PATH = os.path.join(DATA_DIR, "test.csv")
@@ -49,4 +88,556 @@ def test_clean():
     data = response.json()
     # Now this should pass: 3 original rows -> 2 unique rows
     assert data["cleaned_rows"] == 2
-    assert "download_url" in data
\ No newline at end of file
+    assert "download_url" in data
+
+def test_sessions_share_one_stage_cache():
+    config = {"remove_duplicates": True}
+    assert client.post(f"/api/preview/{test_upload()}", json=config).status_code == 200
+    cached_bytes, hits = app_main.STAGE_CACHE.current_bytes, app_main.STAGE_CACHE.hits
+
+    # Same upload and config in another session: served from the shared, process-wide budget
+    assert client.post(f"/api/preview/{test_upload()}", json=config).status_code == 200
+    assert app_main.STAGE_CACHE.hits > hits
+    assert app_main.STAGE_CACHE.current_bytes == cached_bytes <= settings.STAGE_CACHE_BUDGET
+
+def test_stage_cache_reuses_prefix():
+    df = pd.DataFrame({"name": ["Ahmed", "Mohamed", "Ahmed"], "phone": ["0100", "0111", "0100"]})
+    cache = StageCache(10 * 1024 * 1024)
+    config = {"remove_duplicates": True}
+    clean_dataframe(df, config, cache=cache, input_key="k")
+
+    # Toggling the last step must reuse the cached post-dedupe frame
+    config_pii = {"remove_duplicates": True, "anonymize_pii": True}
+    hits_before = cache.hits
+    cached, log = clean_dataframe(df, config_pii, cache=cache, input_key="k")
+    fresh, fresh_log = clean_dataframe(df, config_pii)
+    assert cache.hits == hits_before + 1
+    assert cached.equals(fresh)
+    assert log == fresh_log
+
+def test_match_cache_skips_rescoring(tmp_path, monkeypatch):
+    cache = MatchCache(str(tmp_path / "match_cache.sqlite3"))
+    main = pd.DataFrame({"name": ["Ahmed Ali", "Sara", "Unknown"]})
+    lookup = pd.DataFrame({"name": ["Ahmed Ali", "Sarah"], "region": ["Cairo", "Alex"]})
+    first, count, _ = merger.fuzzy_merge_datasets(main, lookup, "name", "name", True, lookup_hash="h1", match_cache=cache)
+    assert count == 2
+
+    # Second run must resolve hits AND misses from the memo, without rapidfuzz
+    def fail(*args, **kwargs):
+        raise AssertionError("rapidfuzz called")
+    monkeypatch.setattr(scoring.process, "extractOne", fail)
+    monkeypatch.setattr(scoring.process, "cdist", fail)
+    second, count, _ = merger.fuzzy_merge_datasets(main, lookup, "name", "name", True, lookup_hash="h1", match_cache=cache)
+    assert count == 2
+    assert second.equals(first)
+
+def test_composite_key_merge_with_block():
+    main = pd.DataFrame({"name": ["Ahmed Ali", "Ahmed Ali", "Sara"], "city": ["Cairo", "Giza", "Alex"]})
+    lookup = pd.DataFrame({"name": ["Ahmed Ali", "Ahmed Ali", "Sarah"], "city": ["Cairo", "Giza", "Giza"], "region": ["C", "G", "X"]})
+
+    exact, count, added = fuzzy_merge_datasets(main, lookup, ["name", "city"], ["name", "city"], fuzzy=False)
+    assert count == 2 and added == ["region"]
+    assert exact["region"].tolist()[:2] == ["C", "G"]
+
+    # "Sara" is only fuzzy-close to a lookup row in a different city block
+    blocked, count, _ = fuzzy_merge_datasets(main, lookup, ["name", "city"], ["name", "city"], fuzzy=True, block_on="city")
+    assert count == 2
+    assert pd.isna(blocked["region"].iloc[2])
+
+def test_normalize_key_column_matches_row_version():
+    values = ["Coca-Cola Co.", None, 1.5, "", "  Ahmed  Ali ", "أحْمَد"]
+    assert normalize_key_column(pd.Series(values)).tolist() == [normalize_key_for_merge(v) for v in values]
+    folded = normalize_key_column(pd.Series(["Café", "أحْمَد", "مصطفى"]), arabic=True, unicode_fold=True)
+    assert folded.tolist() == ["cafe", "احمد", "مصطفي"]
+
+def test_scorers_and_bulk_scoring():
+    choices = ["ahmedali", "mohamed", "sarah", "cocacola"]
+    queries = ["ahmadali", "sara", "zzzz"]
+    plain = best_matches(queries, choices, "token_sort", 80)
+    filtered = best_matches(queries, choices, "token_sort", 80, bulk_scoring=True)
+    assert [m and m[0] for m in plain] == [0, 2, None]
+    assert filtered == plain
+    # Distance-based scorers are reported on the same 0-100 scale
+    jw = best_matches(["sara"], choices, "jaro_winkler", 90)[0]
+    assert jw[0] == 2 and 90 <= jw[1] <= 100
+
+    summary = score_distribution([85.0, 95.0, 100.0], exact=3, unmatched=1)
+    assert summary["histogram"] == {"80-90": 1, "90-100": 2}
+    assert summary["fuzzy"] == 3 and summary["exact"] == 3
+
+def test_frame_to_records_is_json_native():
+    df = pd.DataFrame({
+        "n": [1, 2],
+        "f": [1.5, np.nan],
+        "s": ["x", None],
+        "d": pd.to_datetime(["2023-01-15", None]),
+    })
+    records = frame_to_records(df)
+    assert records == [
+        {"n": 1, "f": 1.5, "s": "x", "d": "2023-01-15T00:00:00"},
+        {"n": 2, "f": None, "s": None, "d": None},
+    ]
+    assert json.loads(dumps({"v": np.float64("nan"), "i": np.int64(3)})) == {"v": None, "i": 3}
+
+def test_sqlite_sessions_shared_between_workers(tmp_path):
+    db = str(tmp_path / "sessions.sqlite3")
+    worker_a, worker_b = SQLiteSessionBackend(db), SQLiteSessionBackend(db)
+
+    worker_a.create("s1", {"created_at": 0.0, "files": {"original": "a.csv"}})
+    worker_b.update("s1", lambda d: d["files"].update(secondary="b.csv"))
+    assert worker_a.get("s1")["files"] == {"original": "a.csv", "secondary": "b.csv"}
+    assert worker_b.expired(60) == ["s1"]
+
+    # Only one worker holds the cleanup lease at a time
+    assert worker_a.acquire_lease("cleanup", "a", ttl=60)
+    assert not worker_b.acquire_lease("cleanup", "b", ttl=60)
+    assert worker_a.acquire_lease("cleanup", "a", ttl=60)
+
+    worker_b.delete("s1")
+    assert "s1" not in worker_a and worker_a.get("s1") is None
+
+def test_identical_uploads_share_one_blob(tmp_path, monkeypatch):
+    upload = tmp_path / "same.csv"
+    upload.write_text(f"id,tag\n1,{uuid.uuid4().hex}\n")
+
+    sids, paths = [], []
+    for _ in range(2):
+        with open(upload, "rb") as f:
+            res = client.post("/api/upload", files={"file": ("test.csv", f, "text/csv")})
+        assert res.status_code == 200
+        sids.append(res.json()["session_id"])
+        paths.append(app_main.sessions.get(sids[-1])["files"]["original"])
+    assert paths[0] == paths[1] and os.path.dirname(paths[0]) == settings.BLOB_DIR
+
+    # The blob (and its profile) goes away with the last session that references it
+    removed = []
+    app_main.sessions.release_blobs(sids[0], removed.append)
+    assert removed == []
+    app_main.sessions.release_blobs(sids[1], removed.append)
+    assert removed == [os.path.basename(paths[0])]
+
+    # Chunked uploads (no Content-Length) are cut off once the file crosses the limit
+    monkeypatch.setattr(settings, "MAX_UPLOAD_SIZE", 2000)
+    def body():
+        yield b'--xx\r\nContent-Disposition: form-data; name="file"; filename="big.csv"\r\n\r\nid\n'
+        for i in range(100):
+            yield f"{i:099d}\n".encode()
+        yield b"\r\n--xx--\r\n"
+    res = client.post("/api/upload", content=body(), headers={"Content-Type": "multipart/form-data; boundary=xx"})
+    assert res.status_code == 400 and res.json()["detail"] == "File too large"
+    # Unsupported types are refused from the part headers, before any data is stored
+    res = client.post("/api/upload", files={"file": ("notes.txt", b"hello", "text/plain")})
+    assert res.status_code == 400 and res.json()["detail"] == "Unsupported file type"
+    assert not [n for n in os.listdir(settings.BLOB_DIR) if n.startswith(".upload-")]
+
+def test_excel_sheet_and_header_selection(tmp_path):
+    wb = Workbook()
+    wb.active.title = "Cover"
+    wb.active.append(["Quarterly report"])
+    data = wb.create_sheet("Data")
+    data.append(["exported by finance"])
+    data.append(["id", "name"])
+    data.append([1, "Ahmed"])
+    data.append([2, "Mona"])
+    data.cell(row=30, column=8).number_format = "0.00"  # formatted but empty: outside the used range
+    path = tmp_path / "book.xlsx"
+    wb.save(path)
+
+    with open(path, "rb") as f:
+        res = client.post("/api/upload", files={"file": ("book.xlsx", f, "application/vnd.ms-excel")})
+    assert res.status_code == 200
+    session_id = res.json()["session_id"]
+    assert res.json()["analysis"]["sheets"] == ["Cover", "Data"]
+
+    res = client.post(f"/api/sheet/{session_id}", json={"sheet": "Data", "header_row": 1})
+    assert res.status_code == 200
+    analysis = res.json()["analysis"]
+    assert analysis["columns"] == ["id", "name"] and analysis["rows"] == 2
+
+    # The pipeline reads the chosen sheet from now on
+    res = client.post(f"/api/preview/{session_id}", json={})
+    assert res.status_code == 200
+    assert res.json()["preview_clean"][1]["name"] == "Mona"
+
+@pytest.mark.parametrize("engine", ["openpyxl", "calamine"])
+def test_list_sheets_and_read_chosen_sheet(tmp_path, monkeypatch, engine):
+    if engine == "calamine":
+        pytest.importorskip("python_calamine")
+    monkeypatch.setattr(file_handler, "HAS_CALAMINE", engine == "calamine")
+    wb = Workbook()
+    wb.active.title = "Summary"
+    wb.active.append(["total", 3])
+    for name, rows in [("Q1", [["id", "amount"], [1, 10.5], [2, 20]]), ("Q2 (draft)", [["id", "amount"], [3, 5]])]:
+        sheet = wb.create_sheet(name)
+        for row in rows:
+            sheet.append(row)
+    path = str(tmp_path / "quarters.xlsx")
+    wb.save(path)
+
+    assert file_handler.list_sheets(path) == ["Summary", "Q1", "Q2 (draft)"]
+    assert file_handler.list_sheets(str(tmp_path / "plain.csv")) == []
+    pd.testing.assert_frame_equal(file_handler.read_file_as_df(path, sheet="Q1"),
+                                  pd.read_excel(path, sheet_name="Q1", engine="openpyxl"))
+    assert file_handler.read_file_as_df(path, sheet="Q2 (draft)")["id"].tolist() == [3]
+
+def test_batch_cli_merges_and_cleans_in_parallel(tmp_path):
+    inputs = tmp_path / "in"
+    inputs.mkdir()
+    for i in range(3):
+        (inputs / f"leads_{i}.csv").write_text("id,company\n1,Acme Corp\n2,Globex\n2,Globex\n")
+    (tmp_path / "regions.csv").write_text("company,region\nacme corp.,North\nGLOBEX,South\n")
+    config = tmp_path / "config.json"
+    config.write_text(json.dumps({"remove_duplicates": True, "merge_key_main": "company", "merge_key_sec": "company"}))
+
+    out = tmp_path / "out"
+    code = batch_main([str(inputs), "--config", str(config), "--lookup", str(tmp_path / "regions.csv"),
+                       "--out", str(out), "--workers", "2"])
+    assert code == 0
+
+    summary = json.loads((out / "summary.json").read_text())
+    assert summary["succeeded"] == 3 and summary["rows_out"] == 6
+    assert all(r["stats"]["merge"]["exact"] == 3 for r in summary["results"])
+    cleaned = pd.read_csv(out / "leads_0_cleaned.csv")
+    assert cleaned["region"].tolist() == ["North", "South"]
+
+def test_batch_outputs_never_overwrite_or_reprocess(tmp_path):
+    config = tmp_path / "config.json"
+    config.write_text(json.dumps({"remove_duplicates": True}))
+    for folder, rows in [("jan", "1\n1\n"), ("feb", "2\n3\n")]:
+        (tmp_path / folder).mkdir()
+        (tmp_path / folder / "leads.csv").write_text("id\n" + rows)
+
+    out = tmp_path / "out"
+    assert batch_main([str(tmp_path / "jan"), str(tmp_path / "feb"), "--config", str(config), "--out", str(out)]) == 0
+    assert pd.read_csv(out / "jan" / "leads_cleaned.csv")["id"].tolist() == [1]
+    assert pd.read_csv(out / "feb" / "leads_cleaned.csv")["id"].tolist() == [2, 3]
+
+    # Cleaning a folder in place twice only picks up the original input
+    jan = tmp_path / "jan"
+    for _ in range(2):
+        assert batch_main([str(jan), "--config", str(config), "--out", str(jan), "--workers", "1"]) == 0
+        summary = json.loads((jan / "summary.json").read_text())
+        assert [os.path.basename(r["input"]) for r in summary["results"]] == ["leads.csv"]
+    assert sorted(os.listdir(jan)) == ["leads.csv", "leads_cleaned.csv", "summary.json"]
+
+def test_diff_pages_are_served_from_persisted_index(tmp_path):
+    rows = "\n".join(f"{i},name{i}#,{i % 3}" for i in range(120))
+    upload = tmp_path / "many.csv"
+    upload.write_text("id,name,grp\n" + rows + "\n0,name0#,0\n")
+    with open(upload, "rb") as f:
+        session_id = client.post("/api/upload", files={"file": ("many.csv", f, "text/csv")}).json()["session_id"]
+
+    res = client.post(f"/api/clean/{session_id}", json={"remove_duplicates": True, "remove_special_chars": True})
+    assert res.status_code == 200
+    assert res.json()["diff_summary"]["stats"]["changed_count"] == 120
+    # Only the mask, row labels and cleaned frame are stored; records are built per page
+    diff_dir = os.path.join(settings.TEMP_DIR, session_id, "diff")
+    assert sorted(os.listdir(diff_dir)) == ["changed.npy", "clean.pkl", "mask.npy", "meta.json", "removed.npy"]
+
+    page = client.get(f"/api/diff/{session_id}", params={"page": 3, "page_size": 50}).json()
+    assert page["total"] == 120 and page["pages"] == 3 and len(page["items"]) == 20
+    assert page["items"][0]["row_index"] == 101
+    assert page["items"][0]["changes"]["name"] == {"before": "name100#", "after": "name100"}
+
+    by_column = client.get(f"/api/diff/{session_id}", params={"column": "grp"}).json()
+    assert by_column["total"] == 0 and by_column["columns"]["name"] == 120
+    removed = client.get(f"/api/diff/{session_id}", params={"kind": "removed"}).json()
+    assert [r["row_index"] for r in removed["items"]] == [121]
+
+def test_diff_index_rewrites_are_safe_under_concurrency(tmp_path):
+    original = pd.DataFrame({"v": [f"x{i}#" for i in range(50)]})
+    cleaned = [original.replace({"#": ""}, regex=True), original.replace({"x": "y"}, regex=True)]
+    path = str(tmp_path / "diffs" / "diff")
+    errors, pages = [], []
+    def writer(n):
+        try:
+            for _ in range(20):
+                write_diff_index(path, original, cleaned[n % 2])
+        except Exception as e:
+            errors.append(e)
+    def reader():
+        for _ in range(40):
+            try:
+                page = read_diff_page(path, lambda source: original, page_size=5)
+            except FileNotFoundError:
+                continue  # before the first write
+            after = {r["changes"]["v"]["after"][0] for r in page["items"]}
+            pages.append(page["total"] == 50 and len(after) == 1)
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(3)] + [threading.Thread(target=reader)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert not errors and all(pages)
+    assert os.listdir(tmp_path / "diffs") == ["diff"]
+
+def test_hash_dedupe_multi_column_keep_policies():
+    df = pd.DataFrame({
+        "name": ["Ahmed", "ahmed ", "Mona", "AHMED"],
+        "city": ["Cairo", "Cairo", "Giza", "Cairo"],
+        "phone": [None, "0100", None, "0100"],
+    })
+    base = {"remove_duplicates": True, "dedupe_columns": ["name", "city"], "dedupe_ignore_case": True, "drop_empty_rows": False}
+    stats = {}
+    kept, log = clean_dataframe(df, {**base, "dedupe_keep": "first"}, stats=stats)
+    assert kept.index.tolist() == [0, 2]
+    assert stats["duplicates"]["groups"] == 1
+    assert stats["duplicates"]["sample_groups"] == [{"kept": 0, "removed": [1, 3]}]
+
+    kept, _ = clean_dataframe(df, {**base, "dedupe_keep": "last"})
+    assert kept.index.tolist() == [2, 3]
+    kept, _ = clean_dataframe(df, {**base, "dedupe_keep": "most_complete"})
+    assert kept.index.tolist() == [1, 2]
+
+    # Case-sensitive by default: only identical keys collapse
+    kept, _ = clean_dataframe(df, {**base, "dedupe_ignore_case": False})
+    assert kept.index.tolist() == [0, 1, 2, 3]
+
+    # Every dedupe path collapses blank keys into the first blank row, even when no row has a key at all
+    blanks = pd.DataFrame({"name": [None, "Ahmed", None, "Mona", None], "n": range(5)})
+    for extra in [{}, {"dedupe_normalize": True}, {"fuzzy_dedupe": True}]:
+        kept, _ = clean_dataframe(blanks, {"remove_duplicates": True, "dedupe_column": "name", **extra})
+        assert kept["n"].tolist() == [0, 1, 3], extra
+    for extra in [{"dedupe_normalize": True}, {"fuzzy_dedupe": True}]:
+        punct = pd.DataFrame({"name": ["--", "!!", ""], "n": [1, 2, 3]})
+        kept, _ = clean_dataframe(punct, {"remove_duplicates": True, "dedupe_column": "name", **extra})
+        assert kept["n"].tolist() == [1], extra
+    keep_mask, audit = find_duplicates(df, hashes=np.zeros(4, dtype=np.uint64), ignore=np.ones(4, dtype=bool))
+    assert keep_mask.all() and audit["groups"] == 0
+
+def test_scheduler_coalesces_supersedes_and_admits():
+    sched = WorkScheduler(memory_budget=100, timeout=0.2, threads=2)
+    runs, release = [], threading.Event()
+
+    def slow(check):
+        runs.append(1)
+        release.wait(5)
+        check()
+        return {"ok": True}
+
+    async def scenario():
+        # Two identical requests share one run
+        same = [asyncio.ensure_future(sched.submit(("clean", "s1", "cfg"), "s1", 10, slow)) for _ in range(2)]
+        await asyncio.sleep(0.1)
+        release.set()
+        assert await asyncio.gather(*same) == [{"ok": True}] * 2
+        assert len(runs) == 1
+
+        # A newer preview cancels the older one at its next check
+        release.clear()
+        old = asyncio.ensure_future(sched.submit(("preview", "s1", "a"), "s1", 10, slow, supersede=True))
+        await asyncio.sleep(0.1)
+        new = asyncio.ensure_future(sched.submit(("preview", "s1", "b"), "s1", 10, slow, supersede=True))
+        await asyncio.sleep(0.1)
+        release.set()
+        assert await new == {"ok": True}
+        with pytest.raises(PipelineCancelled):
+            await old
+
+        # Over budget: rejected after queueing while the budget is taken
+        release.clear()
+        busy = asyncio.ensure_future(sched.submit(("clean", "s3", "x"), "s3", 80, slow))
+        await asyncio.sleep(0.1)
+        with pytest.raises(Overloaded):
+            await sched.submit(("clean", "s4", "x"), "s4", 80, slow)
+        # An estimate above the whole budget waits for the others, then runs alone
+        with pytest.raises(Overloaded):
+            await sched.submit(("clean", "s2", "x"), "s2", 500, slow)
+        release.set()
+        await busy
+        assert await sched.submit(("clean", "s2", "x"), "s2", 500, slow) == {"ok": True}
+        assert sched._reserved == 0
+
+    asyncio.run(scenario())
+    assert sched.stats["coalesced"] == 1 and sched.stats["rejected"] == 2
+
+def test_concurrent_cleans_of_one_session_are_serialized(tmp_path):
+    upload = tmp_path / "rows.csv"
+    upload.write_text("id,name\n" + "\n".join(f"{i % 40},name{i}#" for i in range(400)) + "\n")
+    with open(upload, "rb") as f:
+        session_id = client.post("/api/upload", files={"file": ("rows.csv", f, "text/csv")}).json()["session_id"]
+
+    configs = [{"remove_duplicates": bool(i % 2), "remove_special_chars": bool(i % 3)} for i in range(12)]
+    statuses = []
+    def clean(cfg):
+        statuses.append(client.post(f"/api/clean/{session_id}", json=cfg).status_code)
+    threads = [threading.Thread(target=clean, args=(cfg,)) for cfg in configs]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert statuses == [200] * len(configs)
+
+    session_dir = os.path.join(settings.TEMP_DIR, session_id)
+    assert sorted(os.listdir(session_dir)) == ["diff", "rows_cleaned.csv"]
+    assert client.get(f"/api/diff/{session_id}").status_code == 200
+
+def test_realistic_upload_is_admitted(tmp_path):
+    # A 1.5M rows x 5 columns export (~24 MB) at 1/10 scale
+    n = 150_000
+    rng = np.random.default_rng(0)
+    path = str(tmp_path / "export.csv")
+    pd.DataFrame({"id": np.arange(n), "amount": rng.random(n).round(2), "qty": rng.integers(0, 100, n),
+                  "store": rng.integers(0, 50, n), "flag": rng.integers(0, 2, n)}).to_csv(path, index=False)
+
+    estimate = estimate_pipeline_bytes({"original": path})
+    # Sized from the parsed dtypes, not a per-cell guess: a few times the file, well within the budget at full scale
+    assert estimate < 10 * os.path.getsize(path)
+    assert 10 * estimate < settings.WORK_MEMORY_BUDGET
+    assert asyncio.run(scheduler.submit(("clean", "s1", "x"), "s1", estimate, lambda check: "done")) == "done"
+
+def test_delta_cleaning_reuses_stored_rows(tmp_path):
+    day1 = pd.DataFrame({
+        "id": range(40),
+        "name": [f" Client {chr(65 + i % 26)} " for i in range(40)],
+        "amount": [f"${i}k" for i in range(40)],
+    })
+    day1.to_csv(tmp_path / "day1.csv", index=False)
+    # Day 2: one edited row, one removed row, a new row and a re-sent copy of a stored row
+    day2 = pd.concat([day1.drop(index=[5]), day1.iloc[[3]],
+                      pd.DataFrame({"id": [99], "name": ["New Client"], "amount": ["$7k"]})], ignore_index=True)
+    day2.loc[0, "name"] = "Renamed"
+    day2.to_csv(tmp_path / "day2.csv", index=False)
+
+    cfg = {"clean_money": True, "remove_duplicates": True, "dedupe_columns": ["id"], "anonymize_pii": True}
+    delta_cfg = {**cfg, "delta_baseline": "crm daily", "delta_key": ["id"]}
+    first = run_pipeline({"original": str(tmp_path / "day1.csv")}, delta_cfg)
+    assert first["stats"]["delta"]["fresh"] is True
+
+    result = run_pipeline({"original": str(tmp_path / "day2.csv")}, delta_cfg, dry_run=True)
+    delta = result["stats"]["delta"]
+    assert (delta["new"], delta["changed"], delta["removed"]) == (1, 1, 1)
+    assert delta["fresh"] is False and 0 < delta["cleaned"] < delta["rows"]
+    # Same output as cleaning the whole file, duplicates found against the stored key hashes
+    full = run_pipeline({"original": str(tmp_path / "day2.csv")}, cfg)
+    pd.testing.assert_frame_equal(result["clean"], full["clean"])
+    assert result["stats"]["duplicates"]["removed"] == 1
+    # The deferred dedupe logs in step order, before the later privacy step
+    assert result["log"][1:] == full["log"]
+
+    # Previews don't move the baseline; a clean does
+    again = run_pipeline({"original": str(tmp_path / "day2.csv")}, delta_cfg)
+    assert again["stats"]["delta"]["changed"] == 1
+    unchanged = run_pipeline({"original": str(tmp_path / "day2.csv")}, delta_cfg)["stats"]["delta"]
+    assert (unchanged["new"], unchanged["changed"], unchanged["removed"]) == (0, 0, 0)
+
+def test_baseline_swaps_are_safe_and_old_baselines_evicted(monkeypatch):
+    def baseline(n):
+        return {"meta": {"rows": n}, "hashes": np.arange(n, dtype=np.uint64), "ids": np.arange(n, dtype=np.uint64),
+                "clean_pos": np.arange(n), "clean": pd.DataFrame({"v": range(n)}), "dedupe": None}
+
+    # Concurrent saves never fail and readers always see a complete baseline
+    path = delta.baseline_path("shared")
+    delta.save_baseline(path, baseline(1))
+    errors, seen = [], []
+    def writer(n):
+        try:
+            for _ in range(10):
+                delta.save_baseline(path, baseline(n))
+        except Exception as e:
+            errors.append(e)
+    def reader():
+        for _ in range(20):
+            b = delta.load_baseline(path)
+            seen.append(b is not None and len(b["clean"]) == b["meta"]["rows"])
+    threads = [threading.Thread(target=writer, args=(n,)) for n in (2, 3)] + [threading.Thread(target=reader)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert not errors and all(seen)
+    assert sorted(os.listdir(settings.BASELINE_DIR)) == ["shared"]
+
+    # Oldest-used baselines go first once the total exceeds the budget; stale ones go regardless of size
+    for name in ["a", "b", "c"]:
+        delta.save_baseline(delta.baseline_path(name), baseline(1000))
+    old = time.time() - 3600
+    os.utime(os.path.join(delta.baseline_path("a"), "meta.json"), (old, old))
+    size = sum(e.stat().st_size for e in os.scandir(delta.baseline_path("b")))
+    assert delta.evict_baselines(max_bytes=3 * size) == ["a"]
+    os.utime(os.path.join(delta.baseline_path("b"), "meta.json"), (old, old))
+    assert delta.evict_baselines(max_age=60, keep=delta.baseline_path("shared")) == ["b"]
+    assert delta.load_baseline(delta.baseline_path("c")) is not None
+
+def test_multi_lookup_enrichment(tmp_path):
+    main = tmp_path / "main.csv"
+    main.write_text("id,name,city\n1,Ahmed,Cairo\n2,Mona,Giza\n3,Sara,Alex\n")
+    customers = tmp_path / "customers.csv"
+    customers.write_text("id,city,tier\n1,Cairo,gold\n3,Aswan,silver\n")
+    regions = tmp_path / "regions.csv"
+    regions.write_text("city,region,tier\nCairo,C,urban\nGiza,G,suburban\n")
+
+    with open(main, "rb") as f:
+        session_id = client.post("/api/upload", files={"file": ("main.csv", f, "text/csv")}).json()["session_id"]
+    # The first lookup takes slot 0; appended ones get the next free slot from the server
+    for query, path, slot in [("", customers, 0), ("?append=true", regions, 1)]:
+        with open(path, "rb") as f:
+            res = client.post(f"/api/upload-secondary/{session_id}{query}", files={"file": (path.name, f, "text/csv")})
+        assert res.status_code == 200 and res.json()["lookup"] == slot
+    with open(regions, "rb") as f:
+        res = client.post(f"/api/upload-secondary/{session_id}?lookup=5", files={"file": ("r.csv", f, "text/csv")})
+    assert res.status_code == 400
+
+    config = {"merge_active": True, "lookups": [
+        {"file": 0, "key_main": "id", "key_sec": "id"},
+        {"file": 1, "key_main": "city", "key_sec": "city"},
+    ]}
+    res = client.post(f"/api/preview/{session_id}", json=config)
+    assert res.status_code == 200
+    data = res.json()
+    # Each lookup renames its own collisions, including columns added by the lookups before it
+    rows = data["preview_clean"]
+    assert list(rows[0]) == ["id", "name", "city", "city_lookup", "tier", "region", "tier_lookup2"]
+    assert [r["tier"] for r in rows] == ["gold", None, "silver"]
+    assert [r["region"] for r in rows] == ["C", "G", None]
+    assert data["match_stats"]["merge"]["exact"] == 2 and data["match_stats"]["merge_2"]["exact"] == 2
+
+    # Removing the first lookup moves the second into its slot and frees the removed file
+    customers_blob = app_main.sessions.get(session_id)["files"]["secondary"]
+    assert client.delete(f"/api/lookup/{session_id}/0").json() == {"lookups": 1}
+    assert not os.path.exists(customers_blob)
+    assert client.delete(f"/api/lookup/{session_id}/1").status_code == 404
+    res = client.post(f"/api/preview/{session_id}",
+                      json={"merge_active": True, "merge_key_main": "city", "merge_key_sec": "city"})
+    assert list(res.json()["preview_clean"][0]) == ["id", "name", "city", "region", "tier"]
+
+    # Replacing a lookup frees the old file; one still used by another role is kept
+    regions_blob = app_main.sessions.get(session_id)["files"]["secondary"]
+    main_blob = app_main.sessions.get(session_id)["files"]["original"]
+    with open(main, "rb") as f:
+        assert client.post(f"/api/upload-secondary/{session_id}", files={"file": ("m.csv", f, "text/csv")}).status_code == 200
+    assert not os.path.exists(regions_blob)
+    with open(customers, "rb") as f:
+        assert client.post(f"/api/upload-secondary/{session_id}", files={"file": ("c.csv", f, "text/csv")}).status_code == 200
+    assert os.path.exists(main_blob)
+
+def test_lookup_errors_stay_with_their_lookup():
+    main = pd.DataFrame({"id": [1, 2], "city": ["Cairo", "Giza"]})
+    good = pd.DataFrame({"city": ["Cairo"], "region": ["C"]})
+    # Unhashable keys make the lookup index fail
+    bad = pd.DataFrame({"id": [[1], [2]], "tier": ["gold", "silver"]})
+    df, results = merge_lookups(main, [{"df": bad, "key_main": "id", "key_sec": "id"},
+                                       {"df": good, "key_main": "city", "key_sec": "city"}])
+    assert results[0]["error"] and results[0]["added_cols"] == []
+    assert results[1]["error"] is None and results[1]["merged"] == 1 and df["region"].iloc[0] == "C"
+    assert "tier" not in df.columns
+
+def test_default_bulk_scoring_keeps_partial_and_wratio_matches(tmp_path):
+    (tmp_path / "main.csv").write_text("company\nAcme\nGlobex Corporation\n")
+    (tmp_path / "lookup.csv").write_text("company,region\nAcme Corporation International,North\nGlobex,South\n")
+    files = {"original": str(tmp_path / "main.csv"), "secondary": str(tmp_path / "lookup.csv")}
+    for scorer in ["wratio", "partial"]:
+        config = CleaningConfig(merge_active=True, merge_key_main="company", merge_key_sec="company",
+                                merge_fuzzy=True, merge_scorer=scorer)
+        assert config.fuzzy_bulk_scoring
+        result = run_pipeline(files, config, dry_run=True)
+        assert result["clean"]["region"].tolist() == ["North", "South"], scorer
+
+    df = pd.DataFrame({"company": ["Acme Corporation International", "Acme", "Globex"]})
+    config = CleaningConfig(remove_duplicates=True, fuzzy_dedupe=True, dedupe_column="company", dedupe_scorer="partial")
+    kept, _ = clean_dataframe(df, config.model_dump())
+    assert kept["company"].tolist() == ["Acme Corporation International", "Globex"]
+
+    # Bulk scoring finds the same matches as scoring one query at a time, for every scorer
+    rng = np.random.default_rng(0)
+    words = ["".join(rng.choice(list("abcde "), rng.integers(3, 12))) for _ in range(300)]
+    for scorer in SCORERS:
+        for threshold in [60, 80, 95]:
+            bulk = best_matches(words[:100], words[100:], scorer, threshold, bulk_scoring=True)
+            single = best_matches(words[:100], words[100:], scorer, threshold)
+            assert [m and m[0] for m in bulk] == [m and m[0] for m in single], (scorer, threshold)
+            assert all(a is None or abs(a[1] - b[1]) < 1e-6 for a, b in zip(bulk, single))